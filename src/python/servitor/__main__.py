@@ -1,36 +1,72 @@
 import multiprocessing
 import multiprocessing.connection
+from os import getenv
 
+from servitor.dispatcher import JobDispatcher
 from servitor.framework.logging import log
-from servitor.framework.event_bus import EventBus
-from servitor.processes import handle_shutdown, start_job_worker, start_http_server
+from servitor.framework.event_bus import EventBus, set_event_bus_client
+from servitor.job_runner import LOG_BUFFER_SIZE, LOG_CAPTURE
+from servitor.log_compression import LogCompressor
+from servitor.log_search import LogIndexer
+from servitor.processes import (
+    JOBS_PER_WORKER,
+    handle_shutdown,
+    start_job_worker,
+    start_http_server,
+    start_scheduler,
+)
+from servitor.retention import RetentionCompactor
 from servitor.shared_memory import SharedMemory, set_shared_memory
+from servitor.state import state
 
 
 def start():
     log.info("starting")
     multiprocessing.set_start_method("spawn")
 
-    shared_memory = SharedMemory()
+    job_worker_count = int(
+        getenv("SERVITOR_JOB_WORKERS", str(max(multiprocessing.cpu_count(), 2)))
+    )
+    shared_memory = SharedMemory(
+        log_buffer_count=(
+            job_worker_count * JOBS_PER_WORKER if LOG_CAPTURE == "pipe" else 0
+        ),
+        log_buffer_size=LOG_BUFFER_SIZE,
+    )
     set_shared_memory(shared_memory)
 
     event_bus = EventBus()
+    event_bus_client = event_bus.spawn_client("Main")
+    set_event_bus_client(event_bus_client)
+    event_bus_client.start()
+
+    state.migrate()
+
+    job_dispatcher = JobDispatcher(shared_memory, job_worker_count * JOBS_PER_WORKER)
+    job_dispatcher.recover()
 
     processes = [
         multiprocessing.Process(
             name="HTTP_Server",
             target=start_http_server,
-            args=(shared_memory, event_bus.spawn_client()),
+            args=(shared_memory, event_bus.spawn_client("HTTP_Server")),
             daemon=True,
-        )
+        ),
+        multiprocessing.Process(
+            name="Scheduler",
+            target=start_scheduler,
+            args=(shared_memory, event_bus.spawn_client("Scheduler")),
+            daemon=True,
+        ),
     ]
 
-    for i in range(max(multiprocessing.cpu_count(), 2)):
+    for i in range(job_worker_count):
+        name = f"Job_Worker-{i+1}"
         processes.append(
             multiprocessing.Process(
-                name=f"Job_Worker-{i+1}",
+                name=name,
                 target=start_job_worker,
-                args=(shared_memory, event_bus.spawn_client()),
+                args=(shared_memory, event_bus.spawn_client(name)),
                 daemon=True,
             )
         )
@@ -38,6 +74,11 @@ def start():
     for process in processes:
         process.start()
 
+    job_dispatcher.start()
+    RetentionCompactor().start()
+    LogCompressor().start()
+    LogIndexer().start()
+
     def shutdown_handler():
         for process in processes:
             process.terminate()
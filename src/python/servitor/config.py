@@ -1,33 +1,96 @@
 import json
-from os import getcwd
-from os.path import join, relpath, isfile
+import threading
+from os import getcwd, getenv
+from os.path import join, relpath, isdir, isfile
 from glob import glob
 from stat import S_IXUSR
 from pathlib import Path
 
+from servitor.framework.fs_watch import (
+    InotifyWatcher,
+    PollingWatcher,
+    build_watcher,
+)
 from servitor.paths import JobPathsBuilder
 
+# How changes to job files are noticed: `inotify`, falling back to polling
+# when it's not available, or `poll`. inotify doesn't report changes made by
+# other clients of network filesystems like NFS, so those need `poll`.
+CONFIG_WATCH = getenv("SERVITOR_CONFIG_WATCH", "inotify")
 
 class Config:
+    _lock: threading.Lock
+    _watcher: InotifyWatcher | PollingWatcher | None
+    _jobs: dict[str, dict] | None
+    _jobs_generation: int | None
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._jobs = None
+        self._jobs_generation = None
+
     def get_jobs(self):
-        def gen():
-            for filename in glob(
-                join(getcwd(), "config", "jobs", "**/*"), recursive=True
+        return list(self._get_job_catalog().values())
+
+    def get_job(self, job_id: str):
+        jobs = self._get_job_catalog()
+        if job_id in jobs:
+            return jobs[job_id]
+        return self._read_job(job_id)
+
+    # Jobs missing from the catalog may have been added since it was scanned.
+    def has_job(self, job_id: str):
+        if job_id in self._get_job_catalog():
+            return True
+        return isfile(JobPathsBuilder(getcwd(), job_id).run_file)
+
+    def _get_job_catalog(self):
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = build_watcher(polling=CONFIG_WATCH == "poll")
+            if (
+                self._jobs is None
+                or self._jobs_generation != self._watcher.generation
             ):
-                if isfile(filename) and Path(filename).stat().st_mode & S_IXUSR:
-                    job_id = relpath(filename, join(getcwd(), "config", "jobs"))
-                    yield self.get_job(job_id)
+                self._jobs_generation = self._watcher.generation
+                self._jobs = self._scan_jobs()
+            return self._jobs
 
-        return sorted(list(gen()), key=lambda job: job["job_id"])
+    def _scan_jobs(self):
+        jobs_dir = join(getcwd(), "config", "jobs")
+        dirs = [jobs_dir]
+        files = []
+        jobs = []
+        for filename in glob(join(jobs_dir, "**/*"), recursive=True):
+            if isdir(filename):
+                dirs.append(filename)
+            elif isfile(filename):
+                files.append(filename)
+                if Path(filename).stat().st_mode & S_IXUSR:
+                    jobs.append(self._read_job(relpath(filename, jobs_dir)))
 
-    def get_job(self, job_id: str):
+        if not self._watcher.watch(dirs, files):
+            self._watcher.close()
+            self._watcher = PollingWatcher()
+            self._watcher.watch(dirs, files)
+            self._jobs_generation = self._watcher.generation
+
+        return {job["job_id"]: job for job in sorted(jobs, key=lambda j: j["job_id"])}
+
+    def _read_job(self, job_id: str):
         job_paths = JobPathsBuilder(getcwd(), job_id)
         try:
             with open(job_paths.input_spec_file, "r") as f:
                 input_spec = json.load(f)
         except FileNotFoundError:
             input_spec = {}
-        return {"job_id": job_id, "input_spec": input_spec}
+        try:
+            with open(job_paths.spec_file, "r") as f:
+                spec = json.load(f)
+        except FileNotFoundError:
+            spec = {}
+        return {"job_id": job_id, "input_spec": input_spec, "spec": spec}
 
 
 config = Config()
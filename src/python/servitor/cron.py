@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+
+MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+MONTH_NAMES = [
+    "jan",
+    "feb",
+    "mar",
+    "apr",
+    "may",
+    "jun",
+    "jul",
+    "aug",
+    "sep",
+    "oct",
+    "nov",
+    "dec",
+]
+DAY_NAMES = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+# Every valid expression matches at least once in this many years, as the
+# rarest one is the 29th of February.
+SEARCH_YEARS = 8
+
+
+# A cron expression with the usual five fields: minute, hour, day of month,
+# month and day of week, where Sunday is either 0 or 7. Fields take `*`,
+# numbers, names of months and days, ranges like `1-5`, steps like `*/15` or
+# `0-30/10`, and lists of those. When both the day of month and the day of
+# week are restricted, a day matching either of them matches, like in cron.
+class CronSchedule:
+    minutes: set[int]
+    hours: set[int]
+    days: set[int]
+    months: set[int]
+    weekdays: set[int]
+    _any_day: bool
+    _any_weekday: bool
+
+    def __init__(self, expression: str) -> None:
+        expression = MACROS.get(expression.strip(), expression)
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"expected 5 fields in cron expression: {expression}")
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12, MONTH_NAMES, 1)
+        self.weekdays = {
+            weekday % 7 for weekday in _parse_field(fields[4], 0, 7, DAY_NAMES, 0)
+        }
+        self._any_day = fields[2].startswith("*")
+        self._any_weekday = fields[4].startswith("*")
+
+    # Returns the first time matching the expression strictly after the given
+    # one, or None when it never matches, like on the 31st of February.
+    def next_after(self, time: datetime):
+        time = time.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        end_year = time.year + SEARCH_YEARS
+        while time.year <= end_year:
+            if time.month not in self.months:
+                time = _start_of_next_month(time)
+            elif not self._matches_day(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif time.hour not in self.hours:
+                time = time.replace(minute=0) + timedelta(hours=1)
+            elif time.minute not in self.minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        return None
+
+    def _matches_day(self, time: datetime):
+        day = time.day in self.days
+        # Python counts days of the week from Monday, and cron from Sunday.
+        weekday = (time.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def _parse_field(
+    field: str,
+    low: int,
+    high: int,
+    names: list[str] | None = None,
+    names_offset: int = 0,
+):
+    values = set()
+    for part in field.split(","):
+        [range_part, _, step_part] = part.partition("/")
+        step = int(step_part) if step_part else 1
+        if step < 1:
+            raise ValueError(f"invalid step in cron field: {field}")
+        if range_part == "*":
+            start, end = low, high
+        else:
+            [start_part, _, end_part] = range_part.partition("-")
+            start = _parse_value(start_part, names, names_offset)
+            if end_part:
+                end = _parse_value(end_part, names, names_offset)
+            elif step_part:
+                end = high
+            else:
+                end = start
+        if not low <= start <= end <= high:
+            raise ValueError(f"out of range value in cron field: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _parse_value(value: str, names: list[str] | None, names_offset: int):
+    if names is not None and value.lower() in names:
+        return names.index(value.lower()) + names_offset
+    return int(value)
+
+
+def _start_of_next_month(time: datetime):
+    if time.month == 12:
+        return time.replace(year=time.year + 1, month=1, day=1, hour=0, minute=0)
+    return time.replace(month=time.month + 1, day=1, hour=0, minute=0)
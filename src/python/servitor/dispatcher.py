@@ -0,0 +1,137 @@
+import threading
+from heapq import heappop, heappush
+
+from servitor.config import config
+from servitor.execution_feed import execution_feed
+from servitor.framework.logging import log
+from servitor.job_queue import job_queue_journal
+from servitor.shared_memory import JobFinished, JobQueueItem, SharedMemory
+from servitor.state import state
+from servitor.triggers import build_job_queue_item
+
+PRIORITIES = {"urgent": 0, "normal": 1, "bulk": 2}
+
+
+# Runs in the main process. Triggered executions arrive through `job_queue`,
+# wait in a priority queue, and are handed to `dispatch_queue` only when a job
+# worker is idle and the job is below its concurrency limit, so urgent
+# executions always skip ahead of anything that's still pending. Every step is
+# recorded in the job queue journal, so the queue survives restarts.
+class JobDispatcher:
+    _shared_memory: SharedMemory
+    _worker_count: int
+    _idle_workers: int
+    _pending: list[tuple[int, int, JobQueueItem]]
+    _sequence: int
+    _running: dict[str, int]
+
+    def __init__(self, shared_memory: SharedMemory, worker_count: int) -> None:
+        self._shared_memory = shared_memory
+        self._worker_count = worker_count
+        self._idle_workers = worker_count
+        self._pending = []
+        self._sequence = 0
+        self._running = {}
+        shared_memory.metrics.set_gauge("slots_total", worker_count)
+
+    # Executions left in the journal by a previous run are queued again if
+    # they never started. The ones that were running when Servitor stopped are
+    # marked as failed, as there's no way to know how far they got. Executions
+    # created right before a crash may never have reached the journal, so
+    # pending executions of every job that are missing from it are queued too.
+    def recover(self):
+        recovered = []
+        journaled = set()
+        for item, _ in job_queue_journal.read():
+            journaled.add((item.job_id, item.execution_id))
+            try:
+                status = state.get_job_execution_status(item.job_id, item.execution_id)
+            except FileNotFoundError:
+                continue
+            if status == "created":
+                recovered.append((item, False))
+                self._push(item)
+            elif status == "running":
+                log.info(f"marking interrupted job as failed: {item.job_id}")
+                job_id, execution_id = item.job_id, item.execution_id
+                state.set_job_execution_status(job_id, execution_id, "failure")
+                state.set_job_execution_result(
+                    job_id, execution_id, -1, "Interrupted by a restart"
+                )
+        for job in config.get_jobs():
+            executions = state.get_job_executions(job["job_id"], statuses=["created"])
+            for execution in reversed(executions):
+                if (job["job_id"], execution["execution_id"]) in journaled:
+                    continue
+                item = build_job_queue_item(job, execution["execution_id"], None)
+                recovered.append((item, False))
+                self._push(item)
+        job_queue_journal.write(recovered)
+        if len(recovered) > 0:
+            log.info(f"recovered {len(recovered)} queued executions")
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    # This is the only thread dispatching executions, so errors handling a
+    # message are logged instead of ending it.
+    def _run(self):
+        self._dispatch()
+        while True:
+            msg = self._shared_memory.job_queue.get()
+            try:
+                self._handle(msg)
+            except Exception:
+                log.exception("error handling job queue message")
+            try:
+                self._dispatch()
+            except Exception:
+                log.exception("error dispatching jobs")
+
+    def _handle(self, msg):
+        if isinstance(msg, JobQueueItem):
+            self._push(msg)
+        elif isinstance(msg, list):
+            for item in msg:
+                self._push(item)
+        elif isinstance(msg, JobFinished):
+            # The slot is released before anything that can fail.
+            running = self._running.get(msg.job_id, 0) - 1
+            if running > 0:
+                self._running[msg.job_id] = running
+            else:
+                self._running.pop(msg.job_id, None)
+            self._idle_workers = min(self._idle_workers + 1, self._worker_count)
+            job_queue_journal.append_finished(msg.job_id, msg.execution_id)
+            job_queue_journal.compact_if_needed()
+            execution_feed.compact_if_needed()
+
+    def _push(self, item: JobQueueItem):
+        priority = PRIORITIES.get(item.priority, PRIORITIES["normal"])
+        heappush(self._pending, (priority, self._sequence, item))
+        self._sequence += 1
+
+    def _dispatch(self):
+        blocked = []
+        while self._idle_workers > 0 and len(self._pending) > 0:
+            entry = heappop(self._pending)
+            item = entry[2]
+            running = self._running.get(item.job_id, 0)
+            if item.max_concurrency is not None and running >= item.max_concurrency:
+                blocked.append(entry)
+                continue
+            log.info(f"dispatching job: {item.job_id} ({item.priority})")
+            self._running[item.job_id] = running + 1
+            self._idle_workers -= 1
+            # An execution missing from the journal is only looked at again
+            # after a restart, so it's better to run it anyway.
+            try:
+                job_queue_journal.append_dispatched(item)
+            except Exception:
+                log.exception(f"error recording dispatched job: {item.job_id}")
+            self._shared_memory.dispatch_queue.put(item)
+        for entry in blocked:
+            heappush(self._pending, entry)
+        metrics = self._shared_memory.metrics
+        metrics.set_gauge("queue_pending", len(self._pending))
+        metrics.set_gauge("slots_busy", self._worker_count - self._idle_workers)
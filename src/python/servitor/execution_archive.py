@@ -0,0 +1,98 @@
+import shutil
+import threading
+import zipfile
+from os import listdir, makedirs, rename, walk
+from os.path import exists, join, relpath
+
+from servitor.paths import JobExecutionPathsBuilder, JobPathsBuilder
+
+SEGMENT_SIZE = 1000
+
+_write_lock = threading.Lock()
+
+
+# Executions removed by the retention policy of a job are moved into zip files
+# in its archive directory. Every zip file is a segment holding a fixed range
+# of SEGMENT_SIZE execution ids, named after it, like `1000-1999.zip`, so the
+# archive grows by one file per SEGMENT_SIZE executions and every execution is
+# in exactly one of them. Zip members are compressed individually and listed
+# in a central directory, so reading a single execution doesn't decompress the
+# rest of them.
+class ExecutionArchive:
+    _job_paths: JobPathsBuilder
+
+    def __init__(self, job_paths: JobPathsBuilder) -> None:
+        self._job_paths = job_paths
+
+    # Executions are appended to their segments. A segment is updated in a
+    # copy that replaces it when complete, so an interrupted write never
+    # corrupts executions archived before.
+    def write(self, execution_ids: list[str]):
+        segments: dict[int, list[str]] = {}
+        for execution_id in execution_ids:
+            segments.setdefault(self._segment(execution_id), []).append(execution_id)
+        makedirs(self._job_paths.archive_dir, exist_ok=True)
+        with _write_lock:
+            for first, segment_execution_ids in sorted(segments.items()):
+                self._append(first, segment_execution_ids)
+
+    # Returns the content of a file of an archived execution, given its path
+    # relative to the execution directory, or None if it isn't archived.
+    def read(self, execution_id: str, path: str):
+        try:
+            archive_file = self._segment_file(self._segment(execution_id))
+            with zipfile.ZipFile(archive_file) as archive:
+                return archive.read(f"{execution_id}/{path}")
+        except (FileNotFoundError, KeyError):
+            return None
+
+    # Returns the ids of every archived execution, in order.
+    def execution_ids(self):
+        execution_ids = set()
+        for archive_file in self._segment_files():
+            with zipfile.ZipFile(archive_file) as archive:
+                for name in archive.namelist():
+                    execution_ids.add(int(name.split("/")[0]))
+        return [str(execution_id) for execution_id in sorted(execution_ids)]
+
+    def _append(self, first: int, execution_ids: list[str]):
+        archive_file = self._segment_file(first)
+        tmp_file = f"{archive_file}.tmp"
+        if exists(archive_file):
+            shutil.copyfile(archive_file, tmp_file)
+            mode = "a"
+        else:
+            mode = "w"
+        with zipfile.ZipFile(tmp_file, mode, zipfile.ZIP_DEFLATED) as archive:
+            # Executions are archived again when a previous write was
+            # interrupted before they were removed.
+            archived = set(archive.namelist())
+            for execution_id in execution_ids:
+                job_execution_paths = JobExecutionPathsBuilder(
+                    self._job_paths, execution_id
+                )
+                for dirpath, _, filenames in walk(job_execution_paths.execution_dir):
+                    for filename in filenames:
+                        path = join(dirpath, filename)
+                        name = relpath(path, self._job_paths.executions_dir)
+                        if name not in archived:
+                            archive.write(path, name)
+        rename(tmp_file, archive_file)
+
+    def _segment(self, execution_id: str):
+        return int(execution_id) // SEGMENT_SIZE * SEGMENT_SIZE
+
+    def _segment_file(self, first: int):
+        last = first + SEGMENT_SIZE - 1
+        return join(self._job_paths.archive_dir, f"{first}-{last}.zip")
+
+    def _segment_files(self):
+        try:
+            filenames = listdir(self._job_paths.archive_dir)
+        except FileNotFoundError:
+            return []
+        return [
+            join(self._job_paths.archive_dir, filename)
+            for filename in sorted(filenames)
+            if filename.endswith(".zip")
+        ]
@@ -0,0 +1,219 @@
+import fcntl
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import close, fstat, getcwd, makedirs, rename, stat, write
+from typing import Any, Iterable
+
+from servitor.framework.logging import log
+from servitor.paths import StatePathsBuilder
+
+COMPACTION_SIZE = 1024 * 1024
+
+
+# Feed of the executions of every job, ordered by their last change of status,
+# so the latest activity across jobs is read without going through every job.
+# It's an append-only TSV file where every line is a record with the shape
+# `<job_id>\t<execution_id>\t<json data>`, where the data is the timestamp and
+# the new status of the execution, or null once it's archived. Like in
+# `ExecutionIndex`, readers keep the latest status of every execution in
+# memory and only parse the bytes appended since their last read.
+#
+# Any process can append while holding a shared `flock` on the lock file.
+# Compaction rewrites the feed with only the records of the first and the last
+# status of every execution while holding it exclusively.
+class ExecutionFeed:
+    _lock: threading.Lock
+    _lock_fd: int | None
+    _fd: int | None
+    _inode: int | None
+    _offset: int
+    _executions: OrderedDict[tuple[str, str], dict]
+    _compacted_size: int
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self._fd = None
+        self._compacted_size = 0
+        self._reset(None)
+
+    def exists(self):
+        return os.path.exists(StatePathsBuilder(getcwd()).feed_file)
+
+    # Returns the executions whose last change of status happened at or after
+    # `since`, an ISO 8601 timestamp in UTC, newest first.
+    def query(
+        self,
+        statuses: list[str] | None = None,
+        since: str | None = None,
+        limit: int | None = None,
+    ):
+        with self._lock:
+            self._refresh()
+            result = []
+            for execution in reversed(self._executions.values()):
+                if limit is not None and len(result) >= limit:
+                    break
+                if statuses is not None and execution["status"] not in statuses:
+                    continue
+                if since is not None and execution["updated_at"] < since:
+                    continue
+                result.append(dict(execution))
+            return result
+
+    def append_status(
+        self, job_id: str, execution_ids: list[str], timestamp: str, status: str
+    ):
+        self._append(
+            [
+                _record(job_id, execution_id, [timestamp, status])
+                for execution_id in execution_ids
+            ]
+        )
+
+    def append_archived(self, job_id: str, execution_ids: list[str]):
+        self._append(
+            [_record(job_id, execution_id, None) for execution_id in execution_ids]
+        )
+
+    # Replaces the feed with one holding the given executions, which must be
+    # ordered by their last change of status.
+    def write(self, executions: Iterable[dict]):
+        with self._lock:
+            with self._flock(fcntl.LOCK_EX):
+                self._write(executions)
+
+    # Rewrites the feed once it grows over COMPACTION_SIZE, and over twice its
+    # size after the previous compaction.
+    def compact_if_needed(self):
+        state_paths = StatePathsBuilder(getcwd())
+        with self._lock:
+            try:
+                size = stat(state_paths.feed_file).st_size
+            except FileNotFoundError:
+                return
+            if size < max(COMPACTION_SIZE, self._compacted_size * 2):
+                return
+            with self._flock(fcntl.LOCK_EX):
+                self._refresh()
+                self._write(list(self._executions.values()))
+            log.info("execution feed compacted")
+
+    def _append(self, records: list[str]):
+        data = "".join(records).encode()
+        with self._lock:
+            with self._flock(fcntl.LOCK_SH):
+                self._open()
+                write(self._fd, data)
+
+    # Must be called while holding the lock.
+    def _write(self, executions: Iterable[dict]):
+        state_paths = StatePathsBuilder(getcwd())
+        tmp_file = f"{state_paths.feed_file}.tmp"
+        with open(tmp_file, "w") as f:
+            for execution in executions:
+                job_id, execution_id = execution["job_id"], execution["execution_id"]
+                f.write(
+                    _record(job_id, execution_id, [execution["created_at"], "created"])
+                )
+                if execution["status"] != "created":
+                    f.write(
+                        _record(
+                            job_id,
+                            execution_id,
+                            [execution["updated_at"], execution["status"]],
+                        )
+                    )
+        rename(tmp_file, state_paths.feed_file)
+        self._compacted_size = stat(state_paths.feed_file).st_size
+
+    # Must be called while holding the lock. The feed is reopened when it was
+    # replaced by another process since it was last opened.
+    def _open(self):
+        state_paths = StatePathsBuilder(getcwd())
+        if self._fd is not None:
+            try:
+                if fstat(self._fd).st_ino == stat(state_paths.feed_file).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            close(self._fd)
+        self._fd = os.open(
+            state_paths.feed_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        )
+
+    # Must be called while holding the lock, as `flock` locks are shared by
+    # every thread using the same file descriptor.
+    @contextmanager
+    def _flock(self, operation: int):
+        if self._lock_fd is None:
+            state_paths = StatePathsBuilder(getcwd())
+            makedirs(state_paths.state_dir, exist_ok=True)
+            self._lock_fd = os.open(
+                state_paths.feed_lock_file, os.O_RDWR | os.O_CREAT
+            )
+        fcntl.flock(self._lock_fd, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _reset(self, inode: int | None):
+        self._inode = inode
+        self._offset = 0
+        self._executions = OrderedDict()
+
+    # Must be called while holding the lock.
+    def _refresh(self):
+        feed_file = StatePathsBuilder(getcwd()).feed_file
+        try:
+            feed_stat = stat(feed_file)
+        except FileNotFoundError:
+            self._reset(None)
+            return
+
+        if feed_stat.st_ino != self._inode or feed_stat.st_size < self._offset:
+            self._reset(feed_stat.st_ino)
+        if feed_stat.st_size == self._offset:
+            return
+
+        with open(feed_file, "br") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # Only complete lines are consumed. A partially written record will be
+        # picked up on the next refresh.
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode().splitlines():
+            self._apply(line)
+        self._offset += end
+
+    def _apply(self, line: str):
+        [job_id, execution_id, raw_data] = line.split("\t", 2)
+        key = (job_id, execution_id)
+        data = json.loads(raw_data)
+        if data is None:
+            self._executions.pop(key, None)
+            return
+        [timestamp, status] = data
+        execution = self._executions.pop(key, None)
+        if execution is None:
+            execution = {
+                "job_id": job_id,
+                "execution_id": execution_id,
+                "status": status,
+                "created_at": timestamp,
+                "updated_at": timestamp,
+            }
+        execution["status"] = status
+        execution["updated_at"] = timestamp
+        self._executions[key] = execution
+
+
+def _record(job_id: str, execution_id: str, data: Any):
+    return f"{job_id}\t{execution_id}\t{json.dumps(data, separators=(',', ':'))}\n"
+
+
+execution_feed = ExecutionFeed()
@@ -0,0 +1,165 @@
+import json
+import threading
+from bisect import bisect_left, bisect_right, insort
+from os import rename, stat
+from os.path import exists
+from typing import Any, Iterable
+
+from servitor.paths import JobPathsBuilder
+
+
+# The index is an append-only TSV file where every line is a record with the
+# shape `<execution_id>\t<kind>\t<json data>`. Records are applied in order,
+# so an execution summary is the result of folding all its records. Readers
+# keep the folded summaries in memory and only parse the bytes appended since
+# their last read.
+class ExecutionIndex:
+    _job_paths: JobPathsBuilder
+    _lock: threading.Lock
+    _inode: int | None
+    _offset: int
+    _executions: dict[int, dict]
+    _execution_ids: list[int]
+
+    def __init__(self, job_paths: JobPathsBuilder) -> None:
+        self._job_paths = job_paths
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def exists(self):
+        return exists(self._job_paths.execution_index_file)
+
+    def query(
+        self,
+        limit: int | None = None,
+        before: str | None = None,
+        after: str | None = None,
+        statuses: list[str] | None = None,
+    ):
+        with self._lock:
+            self._refresh()
+            start = 0
+            if after is not None:
+                start = bisect_right(self._execution_ids, int(after))
+            end = len(self._execution_ids)
+            if before is not None:
+                end = bisect_left(self._execution_ids, int(before))
+
+            # Paging forward from `after` takes the executions right after it,
+            # which are still returned newest first.
+            forward = after is not None and before is None
+            positions = range(start, end) if forward else range(end - 1, start - 1, -1)
+            result = []
+            for i in positions:
+                if limit is not None and len(result) >= limit:
+                    break
+                execution = self._executions[self._execution_ids[i]]
+                if statuses is None or execution["status"] in statuses:
+                    result.append(_copy_execution(execution))
+            if forward:
+                result.reverse()
+            return result
+
+    def append_status(self, execution_id: str, timestamp: str, status: str):
+        self._append([_record(execution_id, "status", [timestamp, status])])
+
+    def append_result(self, execution_id: str, exit_code: int, message: str | None):
+        self._append([_record(execution_id, "result", [exit_code, f"{message}"])])
+
+    def append_resources(self, execution_id: str, resources: dict):
+        self._append([_record(execution_id, "resources", resources)])
+
+    def append_executions(self, executions: Iterable[dict]):
+        records = []
+        for execution in executions:
+            records.extend(_execution_records(execution))
+        self._append(records)
+
+    def write(self, executions: Iterable[dict]):
+        tmp_file = f"{self._job_paths.execution_index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            for execution in executions:
+                f.writelines(_execution_records(execution))
+        rename(tmp_file, self._job_paths.execution_index_file)
+
+    def _append(self, records: list[str]):
+        with open(self._job_paths.execution_index_file, "a") as f:
+            f.write("".join(records))
+
+    def _reset(self, inode: int | None):
+        self._inode = inode
+        self._offset = 0
+        self._executions = {}
+        self._execution_ids = []
+
+    def _refresh(self):
+        try:
+            index_stat = stat(self._job_paths.execution_index_file)
+        except FileNotFoundError:
+            self._reset(None)
+            return
+
+        if index_stat.st_ino != self._inode or index_stat.st_size < self._offset:
+            self._reset(index_stat.st_ino)
+        if index_stat.st_size == self._offset:
+            return
+
+        with open(self._job_paths.execution_index_file, "br") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # Only complete lines are consumed. A partially written record will be
+        # picked up on the next refresh.
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode().splitlines():
+            self._apply(line)
+        self._offset += end
+
+    def _apply(self, line: str):
+        [raw_execution_id, kind, raw_data] = line.split("\t", 2)
+        execution_id = int(raw_execution_id)
+        data = json.loads(raw_data)
+        if execution_id not in self._executions:
+            self._executions[execution_id] = {
+                "execution_id": raw_execution_id,
+                "status": None,
+                "status_history": [],
+                "result": None,
+                "resources": None,
+                "input_values": {},
+            }
+            insort(self._execution_ids, execution_id)
+        execution = self._executions[execution_id]
+
+        if kind == "status":
+            [timestamp, status] = data
+            execution["status"] = status
+            execution["status_history"].append(
+                {"timestamp": timestamp, "status": status}
+            )
+        elif kind == "result":
+            [exit_code, message] = data
+            execution["result"] = {"exit_code": exit_code, "message": message.strip()}
+        elif kind == "resources":
+            execution["resources"] = data
+        elif kind == "input":
+            execution["input_values"] = data
+
+
+def _record(execution_id: str, kind: str, data: Any):
+    return f"{execution_id}\t{kind}\t{json.dumps(data, separators=(',', ':'))}\n"
+
+
+def _execution_records(execution: dict):
+    execution_id = execution["execution_id"]
+    yield _record(execution_id, "input", execution["input_values"])
+    for item in execution["status_history"]:
+        yield _record(execution_id, "status", [item["timestamp"], item["status"]])
+    if execution["result"] is not None:
+        result = execution["result"]
+        yield _record(execution_id, "result", [result["exit_code"], result["message"]])
+    if execution.get("resources") is not None:
+        yield _record(execution_id, "resources", execution["resources"])
+
+
+def _copy_execution(execution: dict):
+    return dict(execution, status_history=list(execution["status_history"]))
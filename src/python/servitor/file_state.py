@@ -0,0 +1,334 @@
+import json
+import threading
+from datetime import datetime, timezone
+from os import getcwd, listdir, makedirs, walk
+from os.path import exists, dirname, isdir, join, relpath
+from shutil import rmtree
+from typing import Any
+
+from servitor.execution_archive import ExecutionArchive
+from servitor.execution_index import ExecutionIndex
+from servitor.job_lock import job_lock
+from servitor.paths import (
+    JobExecutionPathsBuilder,
+    JobPathsBuilder,
+    StatePathsBuilder,
+)
+
+
+# Keeps every execution in a directory of its own, with a file for each part
+# of it, plus an index per job to list executions without opening them.
+class FileStateBackend:
+    _execution_indexes: dict[str, ExecutionIndex]
+    _execution_indexes_lock: threading.Lock
+
+    def __init__(self) -> None:
+        self._execution_indexes = {}
+        self._execution_indexes_lock = threading.Lock()
+
+    def get_job_executions(
+        self,
+        job_id: str,
+        limit: int | None = None,
+        before: str | None = None,
+        after: str | None = None,
+        statuses: list[str] | None = None,
+    ):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        execution_index = self._get_execution_index(job_id)
+        if not execution_index.exists() and exists(job_paths.executions_dir):
+            with job_lock(job_paths):
+                self._ensure_execution_index(job_id)
+        return execution_index.query(limit, before, after, statuses)
+
+    def rebuild_job_execution_index(self, job_id: str):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        with job_lock(job_paths):
+            if not exists(job_paths.executions_dir):
+                return
+
+            def gen():
+                execution_ids = sorted(
+                    [
+                        int(item)
+                        for item in listdir(job_paths.executions_dir)
+                        if item.isdigit()
+                        and isdir(join(job_paths.executions_dir, item))
+                    ]
+                )
+                for execution_id in execution_ids:
+                    try:
+                        yield self.get_job_execution(job_id, str(execution_id))
+                    except FileNotFoundError:
+                        pass
+
+            self._get_execution_index(job_id).write(gen())
+
+    def get_job_execution(self, job_id: str, execution_id: str):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
+        try:
+            input_values = json.loads(
+                self._read_job_execution_file(
+                    job_id, execution_id, job_execution_paths.input_values_file
+                )
+            )
+        except FileNotFoundError:
+            input_values = {}
+        return {
+            "execution_id": execution_id,
+            "status": self.get_job_execution_status(job_id, execution_id),
+            "status_history": self.get_job_execution_status_history(
+                job_id, execution_id
+            ),
+            "result": self.get_job_execution_result(job_id, execution_id),
+            "resources": self.get_job_execution_resources(job_id, execution_id),
+            "input_values": input_values,
+        }
+
+    def create_job_execution(self, job_id: str, input_values: Any):
+        execution_ids, _ = self.create_job_executions(job_id, [input_values])
+        return execution_ids[0]
+
+    # Creates many executions of the job at once. Their ids are allocated as a
+    # single range, and the index is updated with a single append. Returns the
+    # ids along with the timestamp they were created at.
+    def create_job_executions(self, job_id: str, input_values_list: list[Any]):
+        if len(input_values_list) == 0:
+            return [], None
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        with job_lock(job_paths):
+            self._ensure_execution_index(job_id)
+            first_execution = self._allocate_execution_ids(
+                job_paths, len(input_values_list)
+            )
+            timestamp = datetime.now(tz=timezone.utc).isoformat()
+            executions = []
+            for i, input_values in enumerate(input_values_list):
+                execution_id = str(first_execution + i)
+                job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
+                makedirs(job_execution_paths.execution_dir, exist_ok=True)
+                with open(job_execution_paths.status_history_file, "w") as f:
+                    f.write(f"{timestamp}\tcreated\n")
+                with open(job_execution_paths.input_values_file, "w") as f:
+                    f.write(json.dumps(input_values, indent=2) + "\n")
+                executions.append(
+                    {
+                        "execution_id": execution_id,
+                        "status": "created",
+                        "status_history": [
+                            {"timestamp": timestamp, "status": "created"}
+                        ],
+                        "result": None,
+                        "resources": None,
+                        "input_values": input_values,
+                    }
+                )
+            self._get_execution_index(job_id).append_executions(executions)
+        return [execution["execution_id"] for execution in executions], timestamp
+
+    # Returns the id of an execution of the job that's still waiting to run
+    # with the same input values, or creates a new one. The boolean tells
+    # whether the execution was created.
+    def create_job_execution_unless_pending(self, job_id: str, input_values: Any):
+        result, _ = self.create_job_executions_unless_pending(job_id, [input_values])
+        return result[0]
+
+    # Same as `create_job_execution_unless_pending` for many executions at
+    # once. Entries with the same input values share the same execution. The
+    # timestamp of the created executions is returned along with the result.
+    def create_job_executions_unless_pending(
+        self, job_id: str, input_values_list: list[Any]
+    ):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        with job_lock(job_paths):
+            pending = {}
+            for execution in self.get_job_executions(job_id, statuses=["created"]):
+                key = _input_values_key(execution["input_values"])
+                pending.setdefault(key, execution["execution_id"])
+
+            keys = [_input_values_key(values) for values in input_values_list]
+            missing = {}
+            for key, input_values in zip(keys, input_values_list):
+                if key not in pending and key not in missing:
+                    missing[key] = input_values
+            created_ids, timestamp = self.create_job_executions(
+                job_id, list(missing.values())
+            )
+            created = dict(zip(missing, created_ids))
+
+            result = []
+            for key in keys:
+                if key in pending:
+                    result.append((pending[key], False))
+                else:
+                    result.append((created[key], True))
+                    pending[key] = created[key]
+            return result, timestamp
+
+    def _allocate_execution_ids(self, job_paths: JobPathsBuilder, count: int):
+        makedirs(job_paths.executions_dir, exist_ok=True)
+        if exists(job_paths.last_execution_file):
+            with open(job_paths.last_execution_file, "r+") as f:
+                last_execution = int(f.read())
+                f.seek(0)
+                f.write(str(last_execution + count))
+            return last_execution + 1
+        with open(job_paths.last_execution_file, "w") as f:
+            f.write(str(count))
+        return 1
+
+    def get_job_execution_status_history(self, job_id: str, execution_id: str):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
+        content = self._read_job_execution_file(
+            job_id, execution_id, job_execution_paths.status_history_file
+        )
+        return [
+            {"timestamp": l[0], "status": l[1].strip()}
+            for l in [l.split("\t") for l in content.splitlines()]
+        ]
+
+    def get_job_execution_status(self, job_id: str, execution_id: str):
+        return self.get_job_execution_status_history(job_id, execution_id)[-1]["status"]
+
+    # Returns the timestamp of the change of status.
+    def set_job_execution_status(self, job_id: str, execution_id: str, status: str):
+        with job_lock(JobPathsBuilder(getcwd(), job_id)):
+            return self._write_job_execution_status(job_id, execution_id, status)
+
+    def set_job_execution_result(
+        self, job_id: str, execution_id: str, exit_code: int, message: str | None
+    ):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        with job_lock(job_paths):
+            self._ensure_execution_index(job_id)
+            job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
+            with open(job_execution_paths.result_file, "w") as f:
+                f.write(f"{exit_code}\t{message}\n")
+            self._get_execution_index(job_id).append_result(
+                execution_id, exit_code, message
+            )
+
+    def get_job_execution_result(self, job_id: str, execution_id: str):
+        job_execution_paths = JobExecutionPathsBuilder(
+            JobPathsBuilder(getcwd(), job_id), execution_id
+        )
+        try:
+            content = self._read_job_execution_file(
+                job_id, execution_id, job_execution_paths.result_file
+            )
+        except FileNotFoundError:
+            return None
+        [exit_code, message] = content.split("\t")
+        return {"exit_code": int(exit_code), "message": message.strip()}
+
+    # Resource usage of the execution, measured when its process exits.
+    def set_job_execution_resources(
+        self, job_id: str, execution_id: str, resources: dict
+    ):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        with job_lock(job_paths):
+            self._ensure_execution_index(job_id)
+            job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
+            with open(job_execution_paths.resources_file, "w") as f:
+                f.write(json.dumps(resources, indent=2) + "\n")
+            self._get_execution_index(job_id).append_resources(execution_id, resources)
+
+    def get_job_execution_resources(self, job_id: str, execution_id: str):
+        job_execution_paths = JobExecutionPathsBuilder(
+            JobPathsBuilder(getcwd(), job_id), execution_id
+        )
+        try:
+            return json.loads(
+                self._read_job_execution_file(
+                    job_id, execution_id, job_execution_paths.resources_file
+                )
+            )
+        except FileNotFoundError:
+            return None
+
+    # Returns the id of every job with executions, including archived ones.
+    def get_job_ids(self):
+        jobs_dir = StatePathsBuilder(getcwd()).jobs_dir
+        job_ids = []
+        for dirpath, dirnames, _ in walk(jobs_dir):
+            if "executions" in dirnames or "archive" in dirnames:
+                job_ids.append(relpath(dirpath, jobs_dir))
+            dirnames[:] = [d for d in dirnames if d not in ["executions", "archive"]]
+        return sorted(job_ids)
+
+    def get_archived_job_execution_ids(self, job_id: str):
+        return ExecutionArchive(JobPathsBuilder(getcwd(), job_id)).execution_ids()
+
+    # Moves finished executions into the archive of the job. They disappear
+    # from the index and the executions directory, but can still be read one
+    # by one.
+    def archive_job_executions(self, job_id: str, execution_ids: list[str]):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        ExecutionArchive(job_paths).write(execution_ids)
+        archived = set(execution_ids)
+        with job_lock(job_paths):
+            self._ensure_execution_index(job_id)
+            execution_index = self._get_execution_index(job_id)
+            execution_index.write(
+                [
+                    execution
+                    for execution in reversed(execution_index.query())
+                    if execution["execution_id"] not in archived
+                ]
+            )
+            for execution_id in execution_ids:
+                rmtree(JobExecutionPathsBuilder(job_paths, execution_id).execution_dir)
+
+    # Files of archived executions are read from the archive when they're no
+    # longer in the executions directory.
+    def _read_job_execution_file(self, job_id: str, execution_id: str, path: str):
+        try:
+            with open(path, "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            job_paths = JobPathsBuilder(getcwd(), job_id)
+            job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
+            execution_dir = job_execution_paths.execution_dir
+            if isdir(execution_dir):
+                raise
+            content = ExecutionArchive(job_paths).read(
+                execution_id, relpath(path, execution_dir)
+            )
+            if content is None:
+                raise
+            return content.decode()
+
+    def _get_execution_index(self, job_id: str):
+        with self._execution_indexes_lock:
+            if job_id not in self._execution_indexes:
+                self._execution_indexes[job_id] = ExecutionIndex(
+                    JobPathsBuilder(getcwd(), job_id)
+                )
+            return self._execution_indexes[job_id]
+
+    # Must be called while holding the job lock, before writing anything about
+    # the job, so a rebuild never sees the state that's about to be appended to
+    # the index.
+    def _ensure_execution_index(self, job_id: str):
+        if not self._get_execution_index(job_id).exists():
+            self.rebuild_job_execution_index(job_id)
+
+    # Must be called while holding the job lock.
+    def _write_job_execution_status(self, job_id: str, execution_id: str, status: str):
+        self._ensure_execution_index(job_id)
+        timestamp = datetime.now(tz=timezone.utc).isoformat()
+        job_execution_paths = JobExecutionPathsBuilder(
+            JobPathsBuilder(getcwd(), job_id), execution_id
+        )
+        makedirs(dirname(job_execution_paths.status_history_file), exist_ok=True)
+        with open(job_execution_paths.status_history_file, "a") as f:
+            f.write(f"{timestamp}\t{status}\n")
+        self._get_execution_index(job_id).append_status(execution_id, timestamp, status)
+        return timestamp
+
+
+def _input_values_key(input_values: Any):
+    return json.dumps(input_values, sort_keys=True)
+
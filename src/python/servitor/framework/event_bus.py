@@ -1,55 +1,236 @@
+import ctypes
+import pickle
+import struct
 import threading
 import multiprocessing
 import multiprocessing.connection
+import multiprocessing.sharedctypes
+from collections import OrderedDict, deque
+from time import monotonic
 from typing import Callable
 
 from servitor.framework.logging import log
 
 
+MAX_CLIENTS = 1024
+CLIENT_NAME_SIZE = 64
+QUEUE_SIZE = 10000
+SUBSCRIBE_ID = "__subscribe__"
+# Sent by the bus to a client whose queue overflowed with messages that can't
+# be dropped. Everything queued for it was discarded, so handlers listening
+# for it must resync their state.
+LAGGED_ID = "event_bus_lagged"
+
+HEADER_SIZE = struct.Struct("!I")
+HEADER_SEPARATOR = "\x1f"
+
+METRICS_FIELDS = [
+    "queue_depth",
+    "delivered",
+    "dropped",
+    "coalesced",
+    "lagged",
+    "delivery_lag_seconds_total",
+    "delivery_lag_seconds_max",
+]
+
+
+# Every message travels as a frame: a small header with the topic of the
+# message (event id, job id and coalescing key) followed by the pickled
+# message. The bus routes frames by reading only the header, so messages are
+# pickled once by the sender and unpickled once by every receiver.
+def _build_frame(id: str, job_id: str | None, coalesce_key: str | None, body: bytes):
+    header = HEADER_SEPARATOR.join([id, job_id or "", coalesce_key or ""]).encode()
+    return HEADER_SIZE.pack(len(header)) + header + body
+
+
+def _parse_frame(frame: bytes):
+    [header_size] = HEADER_SIZE.unpack_from(frame)
+    body_start = HEADER_SIZE.size + header_size
+    header = frame[HEADER_SIZE.size : body_start].decode()
+    [id, job_id, coalesce_key] = header.split(HEADER_SEPARATOR)
+    return id, job_id or None, coalesce_key or None, body_start
+
+
+LAGGED_FRAME = _build_frame(
+    LAGGED_ID, None, None, pickle.dumps({"id": LAGGED_ID, "payload": None})
+)
+
+
+def _matches(subscriptions, id: str, job_id: str | None):
+    for subscription_id, subscription_job_id in subscriptions:
+        if (subscription_id is None or subscription_id == id) and (
+            subscription_job_id is None or subscription_job_id == job_id
+        ):
+            return True
+    return False
+
+
+class EventBusMetrics:
+    _names: ctypes.Array
+    _values: ctypes.Array
+    _published: ctypes.c_double
+
+    def __init__(self, max_clients: int) -> None:
+        self._names = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_char, max_clients * CLIENT_NAME_SIZE
+        )
+        self._values = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_double, max_clients * len(METRICS_FIELDS)
+        )
+        self._published = multiprocessing.sharedctypes.RawValue(ctypes.c_double, 0)
+
+    def register(self, index: int, name: str):
+        start = index * CLIENT_NAME_SIZE
+        encoded_name = name.encode()[: CLIENT_NAME_SIZE - 1]
+        self._names[start : start + len(encoded_name)] = encoded_name
+
+    def add(self, index: int, field: str, value: float):
+        self._values[self._position(index, field)] += value
+
+    def set(self, index: int, field: str, value: float):
+        self._values[self._position(index, field)] = value
+
+    def set_max(self, index: int, field: str, value: float):
+        position = self._position(index, field)
+        self._values[position] = max(self._values[position], value)
+
+    def add_published(self):
+        self._published.value += 1
+
+    def snapshot(self):
+        clients = []
+        for index in range(len(self._names) // CLIENT_NAME_SIZE):
+            start = index * CLIENT_NAME_SIZE
+            name = self._names[start : start + CLIENT_NAME_SIZE].split(b"\0")[0]
+            if name == b"":
+                break
+            client = {"name": name.decode()}
+            for field in METRICS_FIELDS:
+                client[field] = self._values[self._position(index, field)]
+            clients.append(client)
+        return {"published": self._published.value, "clients": clients}
+
+    def _position(self, index: int, field: str):
+        return index * len(METRICS_FIELDS) + METRICS_FIELDS.index(field)
+
+
 class EventBusClient:
-    _handlers: list[Callable]
+    _handlers: list[tuple[Callable, list[str] | None, str | None]]
     _handlers_lock: threading.Lock
+    _send_lock: threading.Lock
+    _subscriptions: set[tuple[str | None, str | None]]
     _connection: multiprocessing.connection.Connection
+    _metrics: EventBusMetrics
 
     def __init__(
         self,
         connection: multiprocessing.connection.Connection,
+        metrics: EventBusMetrics,
     ) -> None:
         self._handlers = []
         self._handlers_lock = None
+        self._send_lock = None
+        self._subscriptions = set()
         self._connection = connection
+        self._metrics = metrics
 
     def start(self):
         self._handlers_lock = threading.Lock()
+        self._send_lock = threading.Lock()
         threading.Thread(target=self._repeater, daemon=True).start()
 
-    def listen(self, handler):
+    # Handlers only receive messages with any of the given ids and for the
+    # given job. The subscriptions are forwarded to the bus, so messages
+    # nobody in this process is interested in never reach it. Listening again
+    # with the same handler replaces its filters.
+    def listen(self, handler, ids: list[str] | None = None, job_id: str | None = None):
         with self._handlers_lock:
-            if handler not in self._handlers:
-                self._handlers.append(handler)
+            self._handlers = [item for item in self._handlers if item[0] != handler]
+            self._handlers.append((handler, ids, job_id))
+            self._update_subscriptions()
 
     def unlisten(self, handler):
         with self._handlers_lock:
-            if handler in self._handlers:
-                self._handlers.remove(handler)
+            self._handlers = [item for item in self._handlers if item[0] != handler]
+            self._update_subscriptions()
+
+    def get_metrics(self):
+        return self._metrics.snapshot()
+
+    def _update_subscriptions(self):
+        subscriptions = set()
+        for _, ids, job_id in self._handlers:
+            for id in ids if ids is not None else [None]:
+                subscriptions.add((id, job_id))
+        if subscriptions != self._subscriptions:
+            self._subscriptions = subscriptions
+            self._send_frame(
+                _build_frame(SUBSCRIBE_ID, None, None, pickle.dumps(subscriptions))
+            )
 
     def _repeater(self):
         try:
             while True:
-                msg = self._connection.recv()
-                self._handle(msg)
+                frame = self._connection.recv_bytes()
+                *_, body_start = _parse_frame(frame)
+                self._handle(pickle.loads(memoryview(frame)[body_start:]))
         except EOFError:
             log.info("event bus client repeater closed")
 
     def _handle(self, msg):
+        job_id = msg["payload"].get("job_id") if type(msg["payload"]) is dict else None
         with self._handlers_lock:
-            for handler in self._handlers:
-                handler(msg)
+            for handler, ids, handler_job_id in self._handlers:
+                if msg["id"] == LAGGED_ID:
+                    if ids is None or LAGGED_ID in ids:
+                        handler(msg)
+                elif (ids is None or msg["id"] in ids) and (
+                    handler_job_id is None or handler_job_id == job_id
+                ):
+                    handler(msg)
+
+    def _send_frame(self, frame: bytes):
+        with self._send_lock:
+            self._connection.send_bytes(frame)
 
-    def send(self, id, payload=None):
+    def send(self, id, payload=None, coalesce_key=None):
         msg = {"id": id, "payload": payload}
         self._handle(msg)
-        self._connection.send(msg)
+        job_id = payload.get("job_id") if type(payload) is dict else None
+        self._send_frame(_build_frame(id, job_id, coalesce_key, pickle.dumps(msg)))
+
+
+class _Subscriber:
+    index: int
+    name: str
+    connection: multiprocessing.connection.Connection
+    subscriptions: set[tuple[str | None, str | None]]
+    queue: deque
+    # Entries with a coalescing key, in the order they were queued in.
+    queued_by_key: OrderedDict[tuple[str, str | None, str], list]
+    # Entries in the queue that weren't dropped, and the ones that were, which
+    # stay until they're reached or the queue is compacted.
+    size: int
+    dropped: int
+    # Whether the queue was discarded since the last LAGGED_ID message was
+    # delivered.
+    lagged: bool
+    condition: threading.Condition
+
+    def __init__(
+        self, index: int, name: str, connection: multiprocessing.connection.Connection
+    ) -> None:
+        self.index = index
+        self.name = name
+        self.connection = connection
+        self.subscriptions = set()
+        self.queue = deque()
+        self.queued_by_key = OrderedDict()
+        self.size = 0
+        self.dropped = 0
+        self.lagged = False
+        self.condition = threading.Condition()
 
 
 class EventBus:
@@ -59,11 +240,17 @@ class EventBus:
             multiprocessing.connection.Connection,
         ]
     ]
+    _subscribers: list[_Subscriber]
+    _metrics: EventBusMetrics
+    _metrics_lock: threading.Lock
 
-    def __init__(self) -> None:
+    def __init__(self, max_clients: int = MAX_CLIENTS) -> None:
         self._connections = []
+        self._subscribers = []
+        self._metrics = EventBusMetrics(max_clients)
+        self._metrics_lock = threading.Lock()
 
-    def spawn_client(self):
+    def spawn_client(self, name: str = ""):
         client_conn, root_conn = multiprocessing.Pipe()
 
         # Storing the client connection, even though we're not going to use
@@ -74,18 +261,124 @@ class EventBus:
         # mechanism.
         self._connections.append((client_conn, root_conn))
 
-        threading.Thread(target=self._broadcast, args=(root_conn,), daemon=True).start()
-        return EventBusClient(client_conn)
+        index = len(self._subscribers)
+        subscriber = _Subscriber(index, name or f"client-{index}", root_conn)
+        self._subscribers.append(subscriber)
+        self._metrics.register(subscriber.index, subscriber.name)
 
-    def _broadcast(self, connection):
+        threading.Thread(target=self._receive, args=(subscriber,), daemon=True).start()
+        threading.Thread(target=self._deliver, args=(subscriber,), daemon=True).start()
+        return EventBusClient(client_conn, self._metrics)
+
+    def _receive(self, subscriber: _Subscriber):
         try:
             while True:
-                msg = connection.recv()
-                for _, c in self._connections:
-                    if c is not connection:
-                        c.send(msg)
+                frame = subscriber.connection.recv_bytes()
+                id, job_id, coalesce_key, body_start = _parse_frame(frame)
+                if id == SUBSCRIBE_ID:
+                    subscriber.subscriptions = pickle.loads(frame[body_start:])
+                    continue
+                with self._metrics_lock:
+                    self._metrics.add_published()
+                for other in self._subscribers:
+                    if other is not subscriber and _matches(
+                        other.subscriptions, id, job_id
+                    ):
+                        self._enqueue(other, frame, id, job_id, coalesce_key)
         except EOFError:
-            log.info("event bus broadcaster closed")
+            log.info("event bus receiver closed")
+
+    # Queues are bounded. Messages with a coalescing key replace the queued
+    # message with the same topic and key, and when the queue is full, the
+    # oldest of them is dropped, so a slow subscriber never blocks the others.
+    # Those messages only carry the latest state of something, which a newer
+    # one brings again. When there are none left to drop, the subscriber
+    # lagged too far behind: its queue is discarded and replaced by a single
+    # LAGGED_ID message, so its handlers resync.
+    def _enqueue(
+        self,
+        subscriber: _Subscriber,
+        frame: bytes,
+        id: str,
+        job_id: str | None,
+        key: str | None,
+    ):
+        topic = (id, job_id, key) if key else None
+        with subscriber.condition:
+            queued = subscriber.queued_by_key.get(topic) if topic else None
+            if queued is not None:
+                queued[0] = frame
+                self._metrics.add(subscriber.index, "coalesced", 1)
+                return
+            if subscriber.size >= QUEUE_SIZE:
+                if len(subscriber.queued_by_key) > 0:
+                    self._drop_oldest(subscriber)
+                else:
+                    self._lag(subscriber)
+            self._append(subscriber, [frame, monotonic(), topic])
+            subscriber.condition.notify()
+
+    # Must be called while holding the condition of the subscriber. Dropped
+    # entries are only marked as such, and skipped when they're reached.
+    def _drop_oldest(self, subscriber: _Subscriber):
+        _, entry = subscriber.queued_by_key.popitem(last=False)
+        entry[0] = None
+        subscriber.size -= 1
+        subscriber.dropped += 1
+        if subscriber.dropped > QUEUE_SIZE:
+            subscriber.queue = deque(e for e in subscriber.queue if e[0] is not None)
+            subscriber.dropped = 0
+        self._metrics.add(subscriber.index, "dropped", 1)
+
+    # Must be called while holding the condition of the subscriber. A stalled
+    # subscriber can lag again before it gets the previous LAGGED_ID message,
+    # which is only reported once.
+    def _lag(self, subscriber: _Subscriber):
+        if subscriber.lagged:
+            self._metrics.add(subscriber.index, "dropped", subscriber.size - 1)
+        else:
+            log.warning(f"event bus client lagged behind: {subscriber.name}")
+            self._metrics.add(subscriber.index, "dropped", subscriber.size)
+            self._metrics.add(subscriber.index, "lagged", 1)
+            subscriber.lagged = True
+        subscriber.queue.clear()
+        subscriber.queued_by_key.clear()
+        subscriber.size = 0
+        subscriber.dropped = 0
+        self._append(subscriber, [LAGGED_FRAME, monotonic(), None])
+
+    # Must be called while holding the condition of the subscriber.
+    def _append(self, subscriber: _Subscriber, entry: list):
+        subscriber.queue.append(entry)
+        subscriber.size += 1
+        if entry[2] is not None:
+            subscriber.queued_by_key[entry[2]] = entry
+        self._metrics.set(subscriber.index, "queue_depth", subscriber.size)
+
+    def _deliver(self, subscriber: _Subscriber):
+        try:
+            while True:
+                with subscriber.condition:
+                    while subscriber.size == 0:
+                        subscriber.condition.wait()
+                    entry = subscriber.queue.popleft()
+                    if entry[0] is None:
+                        subscriber.dropped -= 1
+                        continue
+                    subscriber.size -= 1
+                    if entry[2] is not None:
+                        del subscriber.queued_by_key[entry[2]]
+                    if entry[0] is LAGGED_FRAME:
+                        subscriber.lagged = False
+                    self._metrics.set(subscriber.index, "queue_depth", subscriber.size)
+                [frame, enqueued_at, _] = entry
+                subscriber.connection.send_bytes(frame)
+                lag = monotonic() - enqueued_at
+                self._metrics.add(subscriber.index, "delivered", 1)
+                self._metrics.add(subscriber.index, "delivery_lag_seconds_total", lag)
+                self._metrics.set_max(subscriber.index, "delivery_lag_seconds_max", lag)
+        except (BrokenPipeError, EOFError):
+            log.info("event bus deliverer closed")
 
 
 _event_bus_client: EventBusClient | None = None
@@ -0,0 +1,259 @@
+import ctypes
+import ctypes.util
+import struct
+import threading
+import time
+from os import close, fsdecode, read, stat
+from os.path import basename, dirname, islink, realpath
+from typing import Callable, Iterable
+
+from servitor.framework.logging import log
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+POLLING_INTERVAL_SECONDS = 1
+
+
+# Watchers expose a `generation` number that changes every time something
+# changes in the watched paths. Consumers remember the generation they built
+# their cache with and rebuild it when it doesn't match anymore.
+#
+# Changes to the target of a symlink don't reach the directory of the link,
+# so the directories of the targets of symlinked files are watched too. Only
+# changes to the targets themselves count in those directories, which may be
+# busy ones like `/etc`.
+class InotifyWatcher:
+    _fd: int
+    _libc: ctypes.CDLL
+    _lock: threading.Lock
+    _watches: dict[int, str]
+    # Names of the files that matter in every watched directory, or None when
+    # all of them do.
+    _names: dict[int, set[str] | None]
+    _generation: int
+
+    def __init__(self, libc: ctypes.CDLL, fd: int) -> None:
+        self._libc = libc
+        self._fd = fd
+        self._lock = threading.Lock()
+        self._watches = {}
+        self._names = {}
+        self._generation = 0
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def watch(self, dirs: Iterable[str], files: Iterable[str]):
+        targets = {}
+        for path in files:
+            if islink(path):
+                target = realpath(path)
+                targets.setdefault(dirname(target), set()).add(basename(target))
+        with self._lock:
+            watched = {path: self._names[wd] for wd, path in self._watches.items()}
+        for path, names in [*((path, None) for path in dirs), *targets.items()]:
+            if path in watched and (
+                watched[path] is None or (names is not None and names <= watched[path])
+            ):
+                continue
+            if not self._add_watch(path, names):
+                return False
+        return True
+
+    def _add_watch(self, path: str, names: set[str] | None):
+        wd = self._libc.inotify_add_watch(self._fd, path.encode(), WATCH_MASK)
+        if wd < 0:
+            log.warning(f"inotify watch on {path} failed (errno {ctypes.get_errno()})")
+            return False
+        with self._lock:
+            # Watching a directory again returns the same descriptor.
+            watched_names = self._names.get(wd, set())
+            self._watches[wd] = path
+            if names is None or watched_names is None:
+                self._names[wd] = None
+            else:
+                self._names[wd] = watched_names | names
+        return True
+
+    def close(self):
+        close(self._fd)
+
+    def _reader(self):
+        try:
+            while True:
+                data = read(self._fd, 64 * 1024)
+                offset = 0
+                changed = False
+                with self._lock:
+                    while offset < len(data):
+                        wd, mask, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(
+                            data, offset
+                        )
+                        offset += INOTIFY_EVENT_HEADER.size
+                        name = fsdecode(data[offset : offset + name_len].rstrip(b"\0"))
+                        offset += name_len
+                        # Events without a name are about the directory itself.
+                        names = self._names.get(wd)
+                        if names is None or name == "" or name in names:
+                            changed = True
+                        if mask & IN_IGNORED:
+                            self._watches.pop(wd, None)
+                            self._names.pop(wd, None)
+                    if changed:
+                        self._generation += 1
+        except OSError:
+            log.info("inotify watcher closed")
+
+
+class PollingWatcher:
+    _lock: threading.Lock
+    _snapshot: dict[str, int | None]
+    _last_poll: float
+    _generation: int
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._snapshot = {}
+        self._last_poll = 0
+        self._generation = 0
+
+    @property
+    def generation(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_poll >= POLLING_INTERVAL_SECONDS:
+                self._last_poll = now
+                if any(_mtime(p) != m for p, m in self._snapshot.items()):
+                    self._generation += 1
+            return self._generation
+
+    def watch(self, dirs: Iterable[str], files: Iterable[str]):
+        with self._lock:
+            self._snapshot = {path: _mtime(path) for path in [*dirs, *files]}
+            self._last_poll = time.monotonic()
+        return True
+
+    def close(self):
+        pass
+
+
+# Calls the subscribed callbacks whenever a specific file is modified. The
+# inotify instance is created on first use, so importing this in processes
+# that never subscribe costs nothing.
+class FileNotifier:
+    _lock: threading.Lock
+    _libc: ctypes.CDLL | None
+    _fd: int | None
+    _subscriptions: dict[int, list[Callable]]
+    _watches: dict[str, int]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._libc = None
+        self._fd = None
+        self._subscriptions = {}
+        self._watches = {}
+
+    def subscribe(self, path: str, callback: Callable):
+        with self._lock:
+            if self._fd is None:
+                self._start()
+            if self._fd < 0:
+                return False
+            if path not in self._watches:
+                wd = self._libc.inotify_add_watch(
+                    self._fd, path.encode(), IN_MODIFY | IN_CLOSE_WRITE
+                )
+                if wd < 0:
+                    return False
+                self._watches[path] = wd
+                self._subscriptions.setdefault(wd, [])
+            self._subscriptions[self._watches[path]].append(callback)
+            return True
+
+    def unsubscribe(self, path: str, callback: Callable):
+        with self._lock:
+            if path not in self._watches:
+                return
+            wd = self._watches[path]
+            if callback in self._subscriptions[wd]:
+                self._subscriptions[wd].remove(callback)
+            if len(self._subscriptions[wd]) == 0:
+                del self._watches[path]
+                del self._subscriptions[wd]
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _start(self):
+        self._libc, self._fd = _inotify_init()
+        if self._fd >= 0:
+            threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self):
+        try:
+            while True:
+                data = read(self._fd, 64 * 1024)
+                offset = 0
+                with self._lock:
+                    while offset < len(data):
+                        wd, _, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(
+                            data, offset
+                        )
+                        offset += INOTIFY_EVENT_HEADER.size + name_len
+                        for callback in self._subscriptions.get(wd, []):
+                            callback()
+        except OSError:
+            log.info("file notifier closed")
+
+
+def build_watcher(polling: bool = False):
+    if polling:
+        return PollingWatcher()
+    libc, fd = _inotify_init()
+    if fd < 0:
+        log.info("inotify not available, falling back to polling")
+        return PollingWatcher()
+    return InotifyWatcher(libc, fd)
+
+
+def _inotify_init():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return libc, libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None, -1
+
+
+def _mtime(path: str):
+    try:
+        return stat(path).st_mtime_ns
+    except OSError:
+        return None
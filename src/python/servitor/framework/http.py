@@ -1,16 +1,37 @@
+import asyncio
+import gzip
+import http.client
 import http.server
+import inspect
+import io
 import json
 import re
 import socket
 import socketserver
-import shutil
-from os.path import getsize
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from email.utils import formatdate, parsedate_to_datetime
+from os import fstat
 from mimetypes import guess_type
-from urllib.parse import urlparse
+from time import perf_counter
+from urllib.parse import parse_qs, urlsplit
 from typing import Callable
 
 from servitor.framework.logging import log
 
+GZIP_MIN_SIZE = 1024
+# Bounds of the cache of static files, in entries and in bytes of gzipped
+# content. The least recently used files are evicted first.
+STATIC_CACHE_ENTRIES = 1024
+STATIC_CACHE_SIZE = 32 * 1024 * 1024
+KEEP_ALIVE_TIMEOUT = 60
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+# Patterns matching a single path, which are looked up in a dict instead. An
+# unescaped `.` matches any character, so only escaped dots are literal.
+LITERAL_ROUTE = re.compile(r"\^((?:[\w/-]|\\\.)*)\$")
+TEXT_TYPES = ("application/javascript", "application/json", "image/svg+xml")
 
 # Ugly? yes
 # Works? yes
@@ -24,25 +45,206 @@ class UnixHTTPServer(http.server.ThreadingHTTPServer):
         self.server_port = 0
 
 
+class AsyncUnixHTTPServer:
+    _sock_path: str
+    _handle_connection: Callable
+    _loop: asyncio.AbstractEventLoop | None
+    _started: threading.Event
+    _stopped: asyncio.Event | None
+
+    def __init__(self, sock_path: str, handle_connection: Callable) -> None:
+        self._sock_path = sock_path
+        self._handle_connection = handle_connection
+        self._loop = None
+        self._started = threading.Event()
+        self._stopped = None
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        self._started.wait()
+        self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_unix_server(
+            self._handle_connection, path=self._sock_path
+        )
+        self._started.set()
+        await self._stopped.wait()
+        server.close()
+
+
+# The parts of a request route handlers need, parsed once before routing.
+# Route handlers find it in `ctx.request` with both servers.
+@dataclass
+class Request:
+    method: str
+    path: str
+    query: dict[str, list[str]]
+    body: bytes
+
+
+def parse_request(method: str, target: str, body: bytes):
+    url = urlsplit(target)
+    return Request(method=method, path=url.path, query=parse_qs(url.query), body=body)
+
+
+# `buckets` counts the requests that took up to each of LATENCY_BUCKETS, and
+# the ones that took longer last.
+@dataclass
+class RequestStats:
+    requests: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+    buckets: list[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+
+# Mimics the parts of http.server.BaseHTTPRequestHandler used by the route
+# handlers, so the same handlers work with both servers.
+class AsyncRequestContext:
+    command: str
+    path: str
+    request_version: str
+    headers: http.client.HTTPMessage
+    request: Request
+    status: int | None
+    rfile: io.BytesIO
+    wfile: io.BufferedIOBase
+    close_connection: bool
+    headers_sent: bool
+    _writer: asyncio.StreamWriter
+    _headers_buffer: list[str]
+
+    def __init__(
+        self,
+        writer: asyncio.StreamWriter,
+        command: str,
+        path: str,
+        request_version: str,
+        headers: http.client.HTTPMessage,
+        body: bytes,
+    ) -> None:
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.headers = headers
+        self.request = parse_request(command, path, body)
+        self.status = None
+        self.rfile = io.BytesIO(body)
+        self.wfile = io.BytesIO()
+        self.close_connection = (
+            request_version != "HTTP/1.1"
+            or headers.get("Connection", "").lower() == "close"
+        )
+        self.headers_sent = False
+        self._writer = writer
+        self._headers_buffer = []
+
+    def send_response(self, code: int, message: str | None = None):
+        if message is None:
+            message = http.HTTPStatus(code).phrase
+        self.status = code
+        self._headers_buffer.append(f"HTTP/1.1 {code} {message}\r\n")
+        self.send_header("Server", "Servitor")
+        self.send_header("Date", formatdate(usegmt=True))
+
+    def send_header(self, keyword: str, value: str):
+        self._headers_buffer.append(f"{keyword}: {value}\r\n")
+        if keyword.lower() == "connection" and value.lower() == "close":
+            self.close_connection = True
+
+    def end_headers(self):
+        self._headers_buffer.append("\r\n")
+        self.wfile.write("".join(self._headers_buffer).encode("latin-1"))
+        self._headers_buffer = []
+        self.headers_sent = True
+
+    def stream(self):
+        self.flush()
+        self.wfile = _StreamWriterFile(self._writer)
+
+    def flush(self):
+        if isinstance(self.wfile, io.BytesIO):
+            self._writer.write(self.wfile.getvalue())
+            self.wfile = io.BytesIO()
+
+    async def drain(self):
+        if self._writer.is_closing():
+            raise ConnectionResetError()
+        await self._writer.drain()
+
+    # Sends part of a file with `sendfile`, so it's never copied through the
+    # process.
+    async def sendfile(self, file: io.BufferedIOBase, offset: int, count: int):
+        self.flush()
+        await self.drain()
+        await asyncio.get_running_loop().sendfile(
+            self._writer.transport, file, offset, count
+        )
+
+
+class _StreamWriterFile(io.RawIOBase):
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self._writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._writer.write(b)
+        return len(b)
+
+
+# Routes whose pattern is a literal path are looked up in a dict, and only the
+# rest are matched one by one. Both servers keep connections open between
+# requests, and close them whenever a failed request may have left them in an
+# unknown state. The time spent on every route is kept in `RequestStats`.
 class HTTPApp:
+    _exact_routes: dict[str, dict[str, tuple[str, Callable]]]
     _routes: dict[str, list[tuple[re.Pattern, Callable]]]
+    _stats_lock: threading.Lock
+    _stats: dict[tuple[str, str], RequestStats]
 
     def __init__(self) -> None:
+        self._exact_routes = {}
         self._routes = {}
+        self._stats_lock = threading.Lock()
+        self._stats = {}
 
-    def route(self, method: str, pattern: re.Pattern):
+    def route(self, method: str, pattern: str):
         def decorator(func):
-            if method not in self._routes:
-                self._routes[method] = []
-            self._routes[method].append((re.compile(pattern), func))
+            literal = LITERAL_ROUTE.fullmatch(pattern)
+            if literal:
+                path = literal[1].replace("\\.", ".")
+                self._exact_routes.setdefault(method, {})[path] = (
+                    pattern,
+                    func,
+                )
+            else:
+                self._routes.setdefault(method, []).append((re.compile(pattern), func))
             return func
 
         return decorator
 
+    # Returns the stats of every route that got a request, by method and
+    # route pattern.
+    def get_request_stats(self):
+        with self._stats_lock:
+            return {
+                key: RequestStats(
+                    stats.requests, stats.errors, stats.seconds, list(stats.buckets)
+                )
+                for key, stats in self._stats.items()
+            }
+
     def build_server(self, sock_path: str):
         class HTTPAppRequestHandler(http.server.BaseHTTPRequestHandler):
             server_version = "Servitor"
             protocol_version = "HTTP/1.1"
+            timeout = KEEP_ALIVE_TIMEOUT
 
             def do_GET(handler):
                 self._handle_request(handler, "GET")
@@ -50,26 +252,204 @@ class HTTPApp:
             def do_POST(handler):
                 self._handle_request(handler, "POST")
 
+            def send_response(handler, code: int, message: str | None = None):
+                handler.status = code
+                super().send_response(code, message)
+
+            def end_headers(handler):
+                handler.headers_sent = True
+                super().end_headers()
+
+            def log_request(handler, code="-", size="-"):
+                pass
+
             def log_message(handler, format, *args):
                 log.debug(f"request {format % args}")
 
             def version_string(handler):
                 return handler.server_version
 
+            async def drain(handler):
+                pass
+
+            async def sendfile(handler, file, offset: int, count: int):
+                handler.wfile.flush()
+                handler.connection.sendfile(file, offset, count)
+
         return UnixHTTPServer(sock_path, HTTPAppRequestHandler)
 
+    # Route handlers can be plain functions or coroutines. In the asyncio
+    # server, coroutines run in the event loop and plain functions run in a
+    # thread pool. In the threaded server, coroutines get their own event loop
+    # in the request thread.
+    def build_async_server(self, sock_path: str):
+        return AsyncUnixHTTPServer(sock_path, self._handle_connection)
+
     def _handle_request(self, ctx: http.server.BaseHTTPRequestHandler, method: str):
-        routing_path = urlparse(ctx.path).path
+        started = perf_counter()
+        ctx.status = None
+        ctx.headers_sent = False
+        # The body is always read, even by routes that ignore it, so the next
+        # request on the connection starts where it should.
+        if "Transfer-Encoding" in ctx.headers:
+            ctx.close_connection = True
+            ctx.send_error(400)
+            return
+        body = ctx.rfile.read(int(ctx.headers.get("Content-Length", "0")))
+        ctx.request = parse_request(method, ctx.path, body)
+        pattern, func, params = self._find_route(method, ctx.request.path)
+        failed = False
         try:
-            for pattern, func in self._routes[method]:
-                match = pattern.match(routing_path)
-                if match:
-                    func(ctx, **match.groupdict())
-                    return
-            reply_not_found(ctx)
+            result = func(ctx, **params)
+            if inspect.iscoroutine(result):
+                asyncio.run(result)
         except Exception:
+            failed = True
             log.exception("error during request processing")
-            reply_error(ctx)
+            if ctx.headers_sent:
+                ctx.close_connection = True
+            else:
+                reply_error(ctx)
+        self._record_request(ctx, pattern, failed, started)
+
+    def _find_route(self, method: str, routing_path: str):
+        exact_route = self._exact_routes.get(method, {}).get(routing_path)
+        if exact_route is not None:
+            [pattern, func] = exact_route
+            return pattern, func, {}
+        for pattern, func in self._routes.get(method, []):
+            match = pattern.match(routing_path)
+            if match:
+                return pattern.pattern, func, match.groupdict()
+        return None, reply_not_found, {}
+
+    def _record_request(
+        self,
+        ctx: http.server.BaseHTTPRequestHandler,
+        pattern: str | None,
+        failed: bool,
+        started: float,
+    ):
+        elapsed = perf_counter() - started
+        log.debug(
+            f'request "{ctx.command} {ctx.path}" {ctx.status} {elapsed * 1000:.1f}ms'
+        )
+        if pattern is None:
+            return
+        with self._stats_lock:
+            stats = self._stats.setdefault((ctx.command, pattern), RequestStats())
+            stats.requests += 1
+            stats.seconds += elapsed
+            stats.buckets[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            if failed or (ctx.status is not None and ctx.status >= 500):
+                stats.errors += 1
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while ctx := await self._read_request(reader, writer):
+                await self._handle_async_request(ctx)
+                ctx.flush()
+                await ctx.drain()
+                if ctx.close_connection:
+                    break
+        # Cancellation only happens when the server shuts down, and letting it
+        # propagate makes asyncio log it as an error.
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        except (ValueError, asyncio.LimitOverrunError):
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+        finally:
+            writer.close()
+
+    # Returns None when the client closes the connection, or leaves it idle
+    # for longer than KEEP_ALIVE_TIMEOUT.
+    async def _read_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_TIMEOUT
+            )
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        [request_line, raw_headers] = head.split(b"\r\n", 1)
+        [command, path, request_version] = request_line.decode("latin-1").split()
+        headers = http.client.parse_headers(io.BytesIO(raw_headers))
+        if "Transfer-Encoding" in headers:
+            raise ValueError("unsupported request body encoding")
+        body = await reader.readexactly(int(headers.get("Content-Length", "0")))
+        return AsyncRequestContext(
+            writer, command, path, request_version, headers, body
+        )
+
+    async def _handle_async_request(self, ctx: AsyncRequestContext):
+        started = perf_counter()
+        pattern, func, params = self._find_route(ctx.command, ctx.request.path)
+        failed = False
+        try:
+            if inspect.iscoroutinefunction(func):
+                ctx.stream()
+                await func(ctx, **params)
+            else:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: func(ctx, **params)
+                )
+        except (ConnectionError, asyncio.CancelledError):
+            ctx.close_connection = True
+            raise
+        except Exception:
+            failed = True
+            log.exception("error during request processing")
+            # Buffered responses haven't reached the client yet, so they can
+            # be replaced, as can streamed ones that didn't send any headers.
+            if isinstance(ctx.wfile, io.BytesIO) or not ctx.headers_sent:
+                if isinstance(ctx.wfile, io.BytesIO):
+                    ctx.wfile = io.BytesIO()
+                ctx._headers_buffer = []
+                reply_error(ctx)
+            else:
+                ctx.close_connection = True
+        finally:
+            self._record_request(ctx, pattern, failed, started)
+
+
+def query_list(query: dict[str, list[str]], key: str):
+    if key not in query:
+        return None
+    return [item for value in query[key] for item in value.split(",") if item != ""]
+
+
+# Parses a query parameter holding a count or an id. Raises ValueError when
+# it's not a non-negative integer.
+def query_int(query: dict[str, list[str]], key: str):
+    if key not in query:
+        return None
+    value = query[key][0]
+    if not value.isdecimal():
+        raise ValueError(f"expected a non-negative integer in {key}: {value}")
+    return int(value)
+
+
+# Parses a `Range` header with a single byte range into the start and end
+# offsets, end excluded. Returns None when the range can't be satisfied, and
+# raises ValueError for anything else, which should be ignored.
+def parse_byte_range(header: str, size: int):
+    [unit, _, spec] = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise ValueError(f"unsupported range: {header}")
+    [first, _, last] = spec.strip().partition("-")
+    if first == "":
+        length = int(last)
+        if length == 0 or size == 0:
+            return None
+        return max(size - length, 0), size
+    start = int(first)
+    end = min(int(last) + 1, size) if last != "" else size
+    if start >= size or end <= start:
+        return None
+    return start, end
 
 
 def reply(ctx: http.server.BaseHTTPRequestHandler, code: int, type: str, body: bytes):
@@ -80,19 +460,175 @@ def reply(ctx: http.server.BaseHTTPRequestHandler, code: int, type: str, body: b
     ctx.wfile.write(body)
 
 
-def reply_file(ctx: http.server.BaseHTTPRequestHandler, code: int, path: str):
-    with open(path, "br") as f:
-        ctx.send_response(code)
-        ctx.send_header("Content-Type", f"{guess_type(path)[0]}; charset=utf-8")
-        ctx.send_header("Content-Length", str(getsize(path)))
-        ctx.end_headers()
-        shutil.copyfileobj(f, ctx.wfile)
+# Replies with the content of a file, or with 304 when the client already has
+# it. Clients are told to revalidate files every time, as their names don't
+# change with their content. The file is opened and looked up in the default
+# executor, as a cache miss reads and compresses it.
+async def reply_file(
+    ctx: http.server.BaseHTTPRequestHandler,
+    code: int,
+    path: str,
+    cache_control: str = "no-cache",
+):
+    f, static_file = await asyncio.get_running_loop().run_in_executor(
+        None, _open_static_file, path
+    )
+    with f:
+        gzipped = static_file.gzipped is not None and accepts_gzip(ctx)
+        etag = static_file.gzipped_etag if gzipped else static_file.etag
+        not_modified = _is_not_modified(ctx, static_file)
+        ctx.send_response(304 if not_modified else code)
+        ctx.send_header("Content-Type", static_file.content_type)
+        ctx.send_header("ETag", etag)
+        ctx.send_header("Last-Modified", static_file.last_modified)
+        ctx.send_header("Cache-Control", cache_control)
+        if static_file.gzipped is not None:
+            ctx.send_header("Vary", "Accept-Encoding")
+        if not_modified:
+            ctx.end_headers()
+            return
+        if gzipped:
+            ctx.send_header("Content-Encoding", "gzip")
+            ctx.send_header("Content-Length", str(len(static_file.gzipped)))
+            ctx.end_headers()
+            ctx.wfile.write(static_file.gzipped)
+        else:
+            ctx.send_header("Content-Length", str(static_file.size))
+            ctx.end_headers()
+            if static_file.size > 0:
+                await ctx.sendfile(f, 0, static_file.size)
+
+
+def _open_static_file(path: str):
+    f = open(path, "br")
+    try:
+        return f, static_files.get(path, f)
+    except BaseException:
+        f.close()
+        raise
+
+
+@dataclass
+class StaticFile:
+    content_type: str
+    size: int
+    mtime_ns: int
+    etag: str
+    gzipped_etag: str
+    last_modified: str
+    gzipped: bytes | None
+
+
+# Keeps the headers and the gzipped content of the files served with
+# `reply_file`, until their size or modification time changes. The content
+# itself is sent straight from the file, so only compressible files are read.
+class StaticFiles:
+    _lock: threading.Lock
+    _files: OrderedDict[str, StaticFile]
+    _gzipped_size: int
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._gzipped_size = 0
+
+    def get(self, path: str, f: io.BufferedIOBase):
+        file_stat = fstat(f.fileno())
+        with self._lock:
+            static_file = self._files.get(path)
+            if (
+                static_file is not None
+                and static_file.size == file_stat.st_size
+                and static_file.mtime_ns == file_stat.st_mtime_ns
+            ):
+                self._files.move_to_end(path)
+                return static_file
+
+        [content_type, _] = guess_type(path)
+        if content_type is None:
+            content_type = "application/octet-stream"
+        gzipped = None
+        if content_type.startswith("text/") or content_type in TEXT_TYPES:
+            if file_stat.st_size >= GZIP_MIN_SIZE:
+                gzipped = gzip.compress(f.read(), mtime=0)
+            content_type = f"{content_type}; charset=utf-8"
+        etag = f"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"
+        static_file = StaticFile(
+            content_type=content_type,
+            size=file_stat.st_size,
+            mtime_ns=file_stat.st_mtime_ns,
+            etag=f'"{etag}"',
+            gzipped_etag=f'"{etag}-gzip"',
+            last_modified=formatdate(file_stat.st_mtime, usegmt=True),
+            gzipped=gzipped,
+        )
+        with self._lock:
+            self._remove(path)
+            self._files[path] = static_file
+            self._gzipped_size += _gzipped_size(static_file)
+            while len(self._files) > STATIC_CACHE_ENTRIES or (
+                self._gzipped_size > STATIC_CACHE_SIZE and len(self._files) > 1
+            ):
+                self._remove(next(iter(self._files)))
+        return static_file
+
+    # Must be called while holding the lock.
+    def _remove(self, path: str):
+        static_file = self._files.pop(path, None)
+        if static_file is not None:
+            self._gzipped_size -= _gzipped_size(static_file)
+
+
+def _gzipped_size(static_file: StaticFile):
+    return len(static_file.gzipped) if static_file.gzipped is not None else 0
+
+
+static_files = StaticFiles()
+
+
+def accepts_gzip(ctx: http.server.BaseHTTPRequestHandler):
+    return "gzip" in [
+        encoding.split(";")[0].strip()
+        for encoding in ctx.headers.get("Accept-Encoding", "").split(",")
+    ]
+
+
+def _is_not_modified(ctx: http.server.BaseHTTPRequestHandler, static_file: StaticFile):
+    if "If-None-Match" in ctx.headers:
+        etags = [
+            etag.strip().removeprefix("W/")
+            for etag in ctx.headers["If-None-Match"].split(",")
+        ]
+        return (
+            "*" in etags
+            or static_file.etag in etags
+            or static_file.gzipped_etag in etags
+        )
+    if "If-Modified-Since" in ctx.headers:
+        try:
+            since = parsedate_to_datetime(ctx.headers["If-Modified-Since"])
+        except (TypeError, ValueError):
+            return False
+        return int(static_file.mtime_ns // 1_000_000_000) <= since.timestamp()
+    return False
+
+
+def encode_chunk(chunk: bytes):
+    return f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n"
+
+
+def write_chunk(ctx: http.server.BaseHTTPRequestHandler, chunk: bytes):
+    ctx.wfile.write(encode_chunk(chunk))
 
 
 def reply_json(ctx: http.server.BaseHTTPRequestHandler, code: int, body: object):
     reply(ctx, code, "application/json", json.dumps(body).encode())
 
 
+def reply_bad_request(ctx: http.server.BaseHTTPRequestHandler, message: str):
+    reply_json(ctx, 400, {"message": message})
+
+
 def reply_not_found(ctx: http.server.BaseHTTPRequestHandler):
     reply_json(ctx, 404, {"message": "Unknown path"})
 
@@ -1,54 +1,226 @@
+import asyncio
 import http.server
-import threading
 import json
-import time
+import re
+import threading
+from datetime import datetime, timezone
+from itertools import islice
 from os import getcwd, sep, getenv, name as os_name
 from os.path import join, normpath
-from urllib.parse import urlparse, parse_qs
+from typing import Any, Callable
 
-from servitor.framework.event_bus import get_event_bus_client
+from servitor.framework.event_bus import LAGGED_ID, get_event_bus_client
+from servitor.framework.logging import log
 from servitor.framework.http import (
     HTTPApp,
+    accepts_gzip,
+    encode_chunk,
+    parse_byte_range,
+    query_int,
+    query_list,
+    reply,
+    reply_bad_request,
     reply_file,
     reply_json,
     reply_not_found,
+    write_chunk,
 )
+from servitor.framework.fs_watch import FileNotifier
 from servitor.config import config
+from servitor.dispatcher import PRIORITIES
+from servitor.line_index import read_line_index
+from servitor.log_compression import (
+    CompressedLogFile,
+    read_compressed_log,
+    read_decompressed_log,
+)
+from servitor.log_files import (
+    LogFile,
+    PlainLogFile,
+    find_line_offset,
+    find_tail_offset,
+    open_log_file,
+)
+from servitor.log_search import log_indexes, read_execution_log, search_log
+from servitor.metrics import render_metrics
 from servitor.paths import JobExecutionPathsBuilder, JobPathsBuilder
-from servitor.shared_memory import JobQueueItem, get_shared_memory
+from servitor.shared_memory import get_shared_memory
 from servitor.state import state
+from servitor.triggers import (
+    build_job_queue_item,
+    create_job_executions,
+    filter_input_values,
+    queue_job_executions,
+)
 
 # Copied from shutil.
 # https://github.com/python/cpython/blob/v3.12.2/Lib/shutil.py#L48
 COPY_BUFSIZE = 1024 * 1024 if (os_name == "nt") else 64 * 1024
 
+# Log changes are notified through inotify when available. Polling is kept as a
+# safety net for filesystems that don't report every change (like NFS).
+LOG_POLLING_INTERVAL = 0.1
+LOG_NOTIFIED_POLLING_INTERVAL = 1
+
+EVENTS_QUEUE_SIZE = 1000
+
+LOG_SEARCH_LIMIT = 100
+
 
 app = HTTPApp()
+log_notifier = FileNotifier()
+
+
+class EventSubscriber:
+    loop: asyncio.AbstractEventLoop
+    ids: list[str] | None
+    job_id_prefix: str | None
+    queue: asyncio.Queue
+    evicted: bool
+
+    def __init__(self, ids: list[str] | None, job_id_prefix: str | None) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.ids = ids
+        self.job_id_prefix = job_id_prefix
+        self.queue = asyncio.Queue(EVENTS_QUEUE_SIZE)
+        self.evicted = False
+
+    def matches(self, msg):
+        if self.ids is not None and msg["id"] not in self.ids:
+            return False
+        if self.job_id_prefix is None:
+            return True
+        payload = msg["payload"]
+        job_id = payload.get("job_id") if type(payload) is dict else None
+        return job_id is not None and job_id.startswith(self.job_id_prefix)
+
+    # Runs in the subscriber's event loop. Clients that can't keep up are
+    # evicted instead of buffering events for them forever.
+    def offer(self, chunk: bytes):
+        if self.queue.full():
+            self.evicted = True
+        else:
+            self.queue.put_nowait(chunk)
+
+    # Runs in the subscriber's event loop. The empty chunk wakes it up.
+    def evict(self):
+        self.evicted = True
+        if not self.queue.full():
+            self.queue.put_nowait(b"")
+
+
+# Single event bus listener shared by every /api/events connection. Events are
+# encoded once, and handed to the event loop of every interested connection.
+class EventStream:
+    _lock: threading.Lock
+    _listener_lock: threading.Lock
+    _subscribers: list[EventSubscriber]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._listener_lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, subscriber: EventSubscriber):
+        with self._lock:
+            self._subscribers.append(subscriber)
+        self._update_listener()
+
+    def unsubscribe(self, subscriber: EventSubscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+        self._update_listener()
+
+    # The event bus client holds its handlers lock while calling
+    # `_on_message`, so `_lock` can't be held while updating the listener.
+    def _update_listener(self):
+        event_bus_client = get_event_bus_client()
+        with self._listener_lock:
+            with self._lock:
+                subscribers = list(self._subscribers)
+            if len(subscribers) == 0:
+                event_bus_client.unlisten(self._on_message)
+                return
+            ids = None
+            if all(s.ids is not None for s in subscribers):
+                ids = sorted({LAGGED_ID, *(id for s in subscribers for id in s.ids)})
+            event_bus_client.listen(self._on_message, ids=ids)
+
+    # When this process lagged behind on the event bus, events were lost, so
+    # every client is evicted to make them resync.
+    def _on_message(self, msg):
+        if msg["id"] == LAGGED_ID:
+            with self._lock:
+                subscribers = list(self._subscribers)
+            _call_in_loops(subscribers, EventSubscriber.evict)
+            return
+        with self._lock:
+            subscribers = [s for s in self._subscribers if s.matches(msg)]
+        if len(subscribers) == 0:
+            return
+        chunk = encode_chunk(f"{json.dumps(msg, separators=(',', ':'))}\n".encode())
+        _call_in_loops(subscribers, EventSubscriber.offer, chunk)
 
 
-@app.route("GET", r"^/api/events$")
-def _(ctx: http.server.BaseHTTPRequestHandler):
-    event_bus_client = get_event_bus_client()
-    done = threading.Event()
+def _call_in_loops(subscribers: list[EventSubscriber], method: Callable, *args):
+    by_loop: dict[asyncio.AbstractEventLoop, list[EventSubscriber]] = {}
+    for subscriber in subscribers:
+        by_loop.setdefault(subscriber.loop, []).append(subscriber)
+    for loop, loop_subscribers in by_loop.items():
+        loop.call_soon_threadsafe(_call_all, loop_subscribers, method, args)
 
-    def on_message(msg):
-        try:
-            chunk = f"{json.dumps(msg, separators=(',', ':'))}\n".encode()
-            ctx.wfile.write(f"{len(chunk):x}\r\n".encode())
-            ctx.wfile.write(chunk)
-            ctx.wfile.write("\r\n".encode())
-        except Exception:
-            done.set()
+
+def _call_all(subscribers: list[EventSubscriber], method: Callable, args: tuple):
+    for subscriber in subscribers:
+        method(subscriber, *args)
+
+
+event_stream = EventStream()
+
+
+@app.route("GET", r"^/api/events$")
+async def _(ctx: http.server.BaseHTTPRequestHandler):
+    query = ctx.request.query
+    subscriber = EventSubscriber(
+        ids=query_list(query, "id"),
+        job_id_prefix=query["job_id_prefix"][0] if "job_id_prefix" in query else None,
+    )
 
     try:
         ctx.send_response(200)
         ctx.send_header("Content-Type", f"text/plain; charset=utf-8")
         ctx.send_header("Transfer-Encoding", "chunked")
         ctx.end_headers()
-        event_bus_client.listen(on_message)
-        done.wait()
+        await ctx.drain()
+        event_stream.subscribe(subscriber)
+        while not subscriber.evicted:
+            chunks = [await subscriber.queue.get()]
+            while not subscriber.queue.empty():
+                chunks.append(subscriber.queue.get_nowait())
+            ctx.wfile.write(b"".join(chunks))
+            await ctx.drain()
+        log.info("evicted slow /api/events client")
+        ctx.close_connection = True
+    except Exception:
+        pass
     finally:
-        event_bus_client.unlisten(on_message)
+        event_stream.unsubscribe(subscriber)
+
+
+@app.route("GET", r"^/api/events/metrics$")
+def _(ctx: http.server.BaseHTTPRequestHandler):
+    reply_json(ctx, 200, get_event_bus_client().get_metrics())
+
+
+@app.route("GET", r"^/api/metrics$")
+def _(ctx: http.server.BaseHTTPRequestHandler):
+    metrics = render_metrics(
+        get_shared_memory().metrics.snapshot(),
+        get_event_bus_client().get_metrics(),
+        app.get_request_stats(),
+    )
+    reply(ctx, 200, "text/plain; version=0.0.4", metrics.encode())
 
 
 @app.route("GET", r"^/api/jobs/get_list$")
@@ -58,37 +230,98 @@ def _(ctx: http.server.BaseHTTPRequestHandler):
 
 @app.route("GET", r"^/api/jobs/get$")
 def _(ctx: http.server.BaseHTTPRequestHandler):
-    query = parse_qs(urlparse(ctx.path).query)
+    query = ctx.request.query
     job_id = query["job_id"][0]
     reply_json(ctx, 200, config.get_job(job_id))
 
 
 @app.route("POST", r"^/api/jobs/run$")
 def _(ctx: http.server.BaseHTTPRequestHandler):
-    query = parse_qs(urlparse(ctx.path).query)
+    query = ctx.request.query
     job_id = query["job_id"][0]
-    job_paths = JobPathsBuilder(getcwd(), job_id)
-
-    try:
-        with open(job_paths.input_spec_file, "r") as f:
-            input_spec = json.load(f)
-    except FileNotFoundError:
-        input_spec = {}
+    priority = query["priority"][0] if "priority" in query else None
     input_values = {}
     for key in query:
         if key.startswith("input_value_"):
-            input_key = key.removeprefix("input_value_")
-            if input_key in input_spec:
-                input_values[input_key] = query[key][0]
+            input_values[key.removeprefix("input_value_")] = query[key][0]
+    error = _check_trigger(job_id, input_values, priority)
+    if error is not None:
+        reply_json(ctx, error[0], {"message": error[1]})
+        return
+
+    job = config.get_job(job_id)
+    [(execution_id, created)] = create_job_executions(
+        job, [filter_input_values(job, input_values)]
+    )
+    if created:
+        item = build_job_queue_item(job, execution_id, priority)
+        queue_job_executions([item])
+    reply_json(ctx, 200, {"status": "success", "execution_id": execution_id})
+
+
+# Expects a body like `{"executions": [{"job_id": "...", "input_values": {}}]}`
+# where every entry can also have a `priority`. Every entry is checked before
+# anything is created, so a batch is either accepted or rejected as a whole.
+# Executions of the same job are created together, and everything is queued
+# at once.
+@app.route("POST", r"^/api/jobs/run_batch$")
+def _(ctx: http.server.BaseHTTPRequestHandler):
+    try:
+        body = json.loads(ctx.request.body)
+    except ValueError:
+        reply_bad_request(ctx, "invalid JSON body")
+        return
+    entries = body.get("executions") if isinstance(body, dict) else None
+    if not isinstance(entries, list) or not all(
+        isinstance(entry, dict) for entry in entries
+    ):
+        reply_bad_request(ctx, "expected a list of executions")
+        return
+    for entry in entries:
+        error = _check_trigger(
+            entry.get("job_id"), entry.get("input_values", {}), entry.get("priority")
+        )
+        if error is not None:
+            reply_json(ctx, error[0], {"message": error[1]})
+            return
 
-    execution_id = state.create_job_execution(job_id, input_values)
-    get_shared_memory().job_queue.put(JobQueueItem(job_id, execution_id))
-    reply_json(ctx, 200, {"status": "success"})
+    entries_by_job: dict[str, list[int]] = {}
+    for i, entry in enumerate(entries):
+        entries_by_job.setdefault(entry["job_id"], []).append(i)
+
+    execution_ids = [None] * len(entries)
+    items = []
+    for job_id, indexes in entries_by_job.items():
+        job = config.get_job(job_id)
+        input_values_list = [
+            filter_input_values(job, entries[i].get("input_values", {}))
+            for i in indexes
+        ]
+        results = create_job_executions(job, input_values_list)
+        for i, (execution_id, created) in zip(indexes, results):
+            execution_ids[i] = execution_id
+            if created:
+                items.append(
+                    build_job_queue_item(job, execution_id, entries[i].get("priority"))
+                )
+
+    queue_job_executions(items)
+    reply_json(
+        ctx,
+        200,
+        {
+            "status": "success",
+            "executions": [
+                {"job_id": entry["job_id"], "execution_id": execution_id}
+                for entry, execution_id in zip(entries, execution_ids)
+            ],
+        },
+    )
 
 
 @app.route("POST", r"^/api/jobs/executions/cancel$")
 def _(ctx: http.server.BaseHTTPRequestHandler):
-    query = parse_qs(urlparse(ctx.path).query)
+    query = ctx.request.query
     job_id = query["job_id"][0]
     execution_id = query["execution_id"][0]
     get_event_bus_client().send(
@@ -98,15 +331,47 @@ def _(ctx: http.server.BaseHTTPRequestHandler):
     reply_json(ctx, 200, {"status": "success"})
 
 
+# Returns the status code and message to reply with when a trigger can't be
+# accepted, or None when it can.
+def _check_trigger(job_id: Any, input_values: Any, priority: Any):
+    if not isinstance(job_id, str) or not config.has_job(job_id):
+        return 404, f"unknown job: {job_id}"
+    if not isinstance(input_values, dict):
+        return 400, f"expected an object of input values for job: {job_id}"
+    if priority is not None and priority not in PRIORITIES:
+        return 400, f"unknown priority: {priority}"
+    return None
+
+
 @app.route("GET", r"^/api/jobs/executions/get_list$")
 def _(ctx: http.server.BaseHTTPRequestHandler):
-    query = parse_qs(urlparse(ctx.path).query)
-    reply_json(ctx, 200, state.get_job_executions(query["job_id"][0]))
+    query = ctx.request.query
+    try:
+        limit = query_int(query, "limit")
+        before = query_int(query, "before")
+        after = query_int(query, "after")
+    except ValueError as ex:
+        reply_bad_request(ctx, str(ex))
+        return
+    job_executions = state.get_job_executions(
+        query["job_id"][0],
+        limit=limit,
+        before=str(before) if before is not None else None,
+        after=str(after) if after is not None else None,
+        statuses=query_list(query, "status"),
+    )
+    fields = query_list(query, "fields")
+    if fields is not None:
+        job_executions = [
+            {key: value for key, value in job_execution.items() if key in fields}
+            for job_execution in job_executions
+        ]
+    reply_json(ctx, 200, job_executions)
 
 
 @app.route("GET", r"^/api/jobs/executions/get$")
 def _(ctx: http.server.BaseHTTPRequestHandler):
-    query = parse_qs(urlparse(ctx.path).query)
+    query = ctx.request.query
     reply_json(
         ctx,
         200,
@@ -114,65 +379,343 @@ def _(ctx: http.server.BaseHTTPRequestHandler):
     )
 
 
-@app.route("GET", r"^/api/jobs/executions/logs/get$")
+# Executions of every job, newest first by their last change of status, from
+# the execution feed. `since` is an ISO 8601 timestamp, and leaves out the
+# executions that didn't change since then.
+@app.route("GET", r"^/api/executions$")
 def _(ctx: http.server.BaseHTTPRequestHandler):
-    query = parse_qs(urlparse(ctx.path).query)
+    query = ctx.request.query
+    try:
+        since = _parse_timestamp(query["since"][0]) if "since" in query else None
+        limit = query_int(query, "limit")
+    except ValueError as ex:
+        reply_bad_request(ctx, str(ex))
+        return
+    reply_json(
+        ctx,
+        200,
+        state.get_executions(
+            statuses=query_list(query, "status"), since=since, limit=limit
+        ),
+    )
+
+
+# Timestamps in the feed are in UTC, as written by `datetime.isoformat`, so
+# they're compared as strings once the given one is written the same way.
+# Timestamps without a timezone are taken as UTC.
+def _parse_timestamp(value: str):
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc).isoformat()
+
+
+# Besides streaming the whole log, it can start from a byte offset
+# (`since_offset`) or from the last lines (`tail`). Single byte ranges through
+# the `Range` header and line ranges (`from_line`, `to_line`, counting from 1)
+# are replied without following the log.
+@app.route("GET", r"^/api/jobs/executions/logs/get$")
+async def _(ctx: http.server.BaseHTTPRequestHandler):
+    query = ctx.request.query
     job_id = query["job_id"][0]
     execution_id = query["execution_id"][0]
+    since_offset = int(query["since_offset"][0]) if "since_offset" in query else 0
+    loop = asyncio.get_running_loop()
+
+    try:
+        log_file = await loop.run_in_executor(
+            None, open_log_file, job_id, execution_id
+        )
+    except FileNotFoundError:
+        reply_not_found(ctx)
+        return
+
+    try:
+        byte_range = None
+        if "Range" in ctx.headers:
+            try:
+                byte_range = parse_byte_range(ctx.headers["Range"], log_file.size())
+            except ValueError:
+                pass
+            else:
+                if byte_range is None:
+                    ctx.send_response(416)
+                    ctx.send_header("Content-Range", f"bytes */{log_file.size()}")
+                    ctx.send_header("Content-Length", "0")
+                    ctx.end_headers()
+                    return
+
+        if byte_range is not None:
+            [start, end] = byte_range
+            content_range = f"bytes {start}-{end - 1}/{log_file.size()}"
+            await _reply_log_part(
+                ctx, log_file, 206, start, end, {"Content-Range": content_range}
+            )
+        elif "from_line" in query or "to_line" in query:
+            job_execution_paths = JobExecutionPathsBuilder(
+                JobPathsBuilder(getcwd(), job_id), execution_id
+            )
+            line_index = read_line_index(job_execution_paths.line_index_file)
+            from_line = int(query["from_line"][0]) if "from_line" in query else 1
+            start = await loop.run_in_executor(
+                None, find_line_offset, log_file, max(from_line - 1, 0), line_index
+            )
+            if "to_line" in query:
+                to_line = int(query["to_line"][0])
+                end = await loop.run_in_executor(
+                    None, find_line_offset, log_file, to_line, line_index
+                )
+            else:
+                end = log_file.size()
+            await _reply_log_part(ctx, log_file, 200, start, max(start, end), {})
+        else:
+            if "tail" in query:
+                since_offset = await loop.run_in_executor(
+                    None, find_tail_offset, log_file, int(query["tail"][0])
+                )
+            if isinstance(log_file, PlainLogFile):
+                await _follow_log(ctx, job_id, execution_id, log_file, since_offset)
+            elif isinstance(log_file, CompressedLogFile):
+                await _reply_compressed_log(ctx, log_file, since_offset)
+            else:
+                await _reply_log_part(
+                    ctx, log_file, 200, since_offset, log_file.size(), {}
+                )
+    finally:
+        log_file.close()
+
+
+async def _follow_log(
+    ctx: http.server.BaseHTTPRequestHandler,
+    job_id: str,
+    execution_id: str,
+    log_file: PlainLogFile,
+    since_offset: int,
+):
     job_paths = JobPathsBuilder(getcwd(), job_id)
     job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
 
+    loop = asyncio.get_running_loop()
     event_bus_client = get_event_bus_client()
-    done = threading.Event()
+    log_buffers = get_shared_memory().log_buffers
+    done = asyncio.Event()
+    wake_up = asyncio.Event()
+    lagged = asyncio.Event()
+
+    def on_log_modified():
+        loop.call_soon_threadsafe(wake_up.set)
 
     def on_message(msg):
-        if (
-            msg["id"] == "job_execution_status_changed"
+        if msg["id"] == LAGGED_ID:
+            loop.call_soon_threadsafe(lagged.set)
+            loop.call_soon_threadsafe(wake_up.set)
+        elif (
+            msg["id"] in ["job_execution_status_changed", "job_execution_log_appended"]
             and msg["payload"]["job_id"] == job_id
             and msg["payload"]["execution_id"] == execution_id
         ):
-            done.set()
+            if msg["id"] == "job_execution_status_changed":
+                loop.call_soon_threadsafe(done.set)
+            loop.call_soon_threadsafe(wake_up.set)
 
     try:
-        event_bus_client.listen(on_message)
-        if state.get_job_execution_status(job_id, execution_id) != "running":
+        event_bus_client.listen(
+            on_message,
+            ids=[
+                "job_execution_status_changed",
+                "job_execution_log_appended",
+                LAGGED_ID,
+            ],
+            job_id=job_id,
+        )
+        status = await loop.run_in_executor(
+            None, state.get_job_execution_status, job_id, execution_id
+        )
+        if status != "running":
             done.set()
-        with open(job_execution_paths.main_log_file, "br") as f:
-            ctx.send_response(200)
-            ctx.send_header("Content-Type", f"text/plain; charset=utf-8")
-            ctx.send_header("Transfer-Encoding", "chunked")
-            ctx.end_headers()
-
-            while True:
+        notified = log_notifier.subscribe(
+            job_execution_paths.main_log_file, on_log_modified
+        )
+        offset = since_offset
+        ctx.send_response(200)
+        ctx.send_header("Content-Type", f"text/plain; charset=utf-8")
+        ctx.send_header("Accept-Ranges", "bytes")
+        ctx.send_header("Transfer-Encoding", "chunked")
+        ctx.end_headers()
 
+        while True:
+            # A change of status may have been lost to the event bus lagging
+            # behind, so it's read again.
+            if lagged.is_set():
+                lagged.clear()
+                status = await loop.run_in_executor(
+                    None, state.get_job_execution_status, job_id, execution_id
+                )
+                if status != "running":
+                    done.set()
+            # Whatever is written before the execution finishes must be
+            # sent, so the last read happens after `done` is observed.
+            finished = done.is_set()
+            wake_up.clear()
+
+            try:
+                # Output of executions captured through a pipe reaches the
+                # disk in batches, and the rest lives in a shared buffer.
+                size = log_file.size()
+                if size > offset:
+                    ctx.wfile.write(f"{size - offset:x}\r\n".encode())
+                    await ctx.sendfile(log_file.file, offset, size - offset)
+                    ctx.wfile.write(b"\r\n")
+                    offset = size
+                    await ctx.drain()
+                chunk = log_buffers.read(job_id, execution_id, offset)
+                if chunk:
+                    write_chunk(ctx, chunk)
+                    offset += len(chunk)
+                    await ctx.drain()
+            except Exception:
+                break
+
+            if finished:
                 try:
-                    while chunk := f.read(COPY_BUFSIZE):
-                        ctx.wfile.write(f"{len(chunk):x}\r\n".encode())
-                        ctx.wfile.write(chunk)
-                        ctx.wfile.write(f"\r\n".encode())
+                    ctx.wfile.write(f"{0:x}\r\n\r\n".encode())
                 except Exception:
-                    break
-
-                if done.is_set():
-                    try:
-                        ctx.wfile.write(f"{0:x}\r\n\r\n".encode())
-                    except Exception:
-                        pass
-                    break
-
-                time.sleep(0.1)
-
-    except FileNotFoundError:
-        reply_not_found(ctx)
+                    pass
+                break
+
+            try:
+                await asyncio.wait_for(
+                    wake_up.wait(),
+                    LOG_NOTIFIED_POLLING_INTERVAL if notified else LOG_POLLING_INTERVAL,
+                )
+            except asyncio.TimeoutError:
+                pass
     finally:
         event_bus_client.unlisten(on_message)
+        log_notifier.unsubscribe(job_execution_paths.main_log_file, on_log_modified)
+
+
+async def _reply_log_part(
+    ctx: http.server.BaseHTTPRequestHandler,
+    log_file: LogFile,
+    code: int,
+    start: int,
+    end: int,
+    headers: dict[str, str],
+):
+    ctx.send_response(code)
+    ctx.send_header("Content-Type", f"text/plain; charset=utf-8")
+    ctx.send_header("Accept-Ranges", "bytes")
+    ctx.send_header("Content-Length", str(end - start))
+    for keyword, value in headers.items():
+        ctx.send_header(keyword, value)
+    ctx.end_headers()
+    if isinstance(log_file, PlainLogFile):
+        if end > start:
+            await ctx.sendfile(log_file.file, start, end - start)
+        return
+    offset = start
+    while offset < end:
+        chunk = log_file.read(offset, min(COPY_BUFSIZE, end - offset))
+        if not chunk:
+            break
+        ctx.wfile.write(chunk)
+        offset += len(chunk)
+        await ctx.drain()
+
+
+# Logs of finished executions are compressed, and sent as they are to clients
+# that accept gzip. Otherwise they're decompressed on the fly.
+async def _reply_compressed_log(
+    ctx: http.server.BaseHTTPRequestHandler,
+    log_file: CompressedLogFile,
+    since_offset: int,
+):
+    gzip_accepted = accepts_gzip(ctx)
+    ctx.send_response(200)
+    ctx.send_header("Content-Type", f"text/plain; charset=utf-8")
+    ctx.send_header("Accept-Ranges", "bytes")
+    ctx.send_header("Vary", "Accept-Encoding")
+    if gzip_accepted:
+        ctx.send_header("Content-Encoding", "gzip")
+    ctx.send_header("Transfer-Encoding", "chunked")
+    ctx.end_headers()
+    if gzip_accepted:
+        chunks = read_compressed_log(log_file.file, since_offset)
+    else:
+        chunks = read_decompressed_log(log_file.file, since_offset)
+    for chunk in chunks:
+        if chunk:
+            write_chunk(ctx, chunk)
+            await ctx.drain()
+    ctx.wfile.write(f"{0:x}\r\n\r\n".encode())
+
+
+# Streams the matches as JSON lines, newest executions first. Executions whose
+# log index rules out the text aren't scanned at all.
+@app.route("GET", r"^/api/jobs/executions/logs/search$")
+async def _(ctx: http.server.BaseHTTPRequestHandler):
+    query = ctx.request.query
+    job_id = query["job_id"][0]
+    text = query["q"][0]
+    context = int(query["context"][0]) if "context" in query else 0
+    limit = int(query["limit"][0]) if "limit" in query else LOG_SEARCH_LIMIT
+    ignore_case = query.get("ignore_case", ["false"])[0] == "true"
+    pattern = re.compile(re.escape(text.encode()), re.IGNORECASE if ignore_case else 0)
+    loop = asyncio.get_running_loop()
+
+    indexed, candidates = await loop.run_in_executor(
+        None, log_indexes.get(job_id).candidates, text
+    )
+    listed = await loop.run_in_executor(None, state.get_job_executions, job_id)
+    execution_ids = sorted(
+        indexed | {execution["execution_id"] for execution in listed},
+        key=int,
+        reverse=True,
+    )
+
+    ctx.send_response(200)
+    ctx.send_header("Content-Type", f"text/plain; charset=utf-8")
+    ctx.send_header("Transfer-Encoding", "chunked")
+    ctx.end_headers()
+    found = 0
+    for execution_id in execution_ids:
+        if found >= limit:
+            break
+        if execution_id in indexed and execution_id not in candidates:
+            continue
+        matches = await loop.run_in_executor(
+            None,
+            _search_execution_log,
+            job_id,
+            execution_id,
+            pattern,
+            context,
+            limit - found,
+        )
+        for match in matches:
+            line = json.dumps(dict(match, execution_id=execution_id))
+            write_chunk(ctx, f"{line}\n".encode())
+        found += len(matches)
+        await ctx.drain()
+    ctx.wfile.write(f"{0:x}\r\n\r\n".encode())
+
+
+def _search_execution_log(
+    job_id: str, execution_id: str, pattern: re.Pattern, context: int, limit: int
+):
+    try:
+        chunks = read_execution_log(job_id, execution_id)
+        return list(islice(search_log(chunks, pattern, context), limit))
+    except FileNotFoundError:
+        return []
 
 
 ui_root = getenv("SERVITOR_UI_ROOT")
 if ui_root is not None:
 
     @app.route("GET", r"^/(?P<rest>.*)")
-    def _(ctx: http.server.BaseHTTPRequestHandler, rest: str):
+    async def _(ctx: http.server.BaseHTTPRequestHandler, rest: str):
         if rest == "" or rest is None:
             rest = "index.html"
         base_path = normpath(ui_root)
@@ -183,6 +726,6 @@ if ui_root is not None:
             return
 
         try:
-            reply_file(ctx, 200, ui_file_path)
+            await reply_file(ctx, 200, ui_file_path)
         except FileNotFoundError:
             reply_not_found(ctx)
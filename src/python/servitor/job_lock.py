@@ -0,0 +1,37 @@
+import fcntl
+import threading
+from contextlib import contextmanager
+from os import makedirs
+from os.path import dirname
+
+from servitor.paths import JobPathsBuilder
+
+
+_held = threading.local()
+
+
+# Exclusive lock over the state of a single job, backed by `flock` on a file
+# in the job's state directory, so it works across processes and jobs never
+# contend with each other. It's reentrant within the same thread, as `flock`
+# locks held through different file descriptors exclude each other even inside
+# the same process.
+@contextmanager
+def job_lock(job_paths: JobPathsBuilder):
+    if not hasattr(_held, "locks"):
+        _held.locks = {}
+    lock_file = job_paths.lock_file
+    if lock_file in _held.locks:
+        _held.locks[lock_file][1] += 1
+    else:
+        makedirs(dirname(lock_file), exist_ok=True)
+        f = open(lock_file, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        _held.locks[lock_file] = [f, 1]
+    try:
+        yield
+    finally:
+        _held.locks[lock_file][1] -= 1
+        if _held.locks[lock_file][1] == 0:
+            f = _held.locks.pop(lock_file)[0]
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
@@ -0,0 +1,204 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict
+from os import close, fstat, fsync, getcwd, makedirs, rename, stat, write
+from os.path import exists
+from time import sleep
+from typing import Any
+
+from servitor.framework.logging import log
+from servitor.paths import QueuePathsBuilder
+from servitor.shared_memory import JobQueueItem
+
+SYNC_INTERVAL = 0.01
+COMPACTION_SIZE = 1024 * 1024
+
+
+# Journal of the job queue, so executions waiting to run survive restarts.
+# It's an append-only TSV file where every line is a record with the shape
+# `<kind>\t<json data>`: `queued` when an execution is triggered, `dispatched`
+# when it's handed to a job worker, and `finished` when the worker is done
+# with it. Records are written right away, but flushed to disk in batches by a
+# background thread, so triggering an execution never waits for `fsync`.
+#
+# Any process can append while holding a shared `flock` on the lock file.
+# Compaction rewrites the journal with only the live records while holding it
+# exclusively, and appenders reopen the journal when they notice it changed.
+class JobQueueJournal:
+    _lock: threading.Lock
+    _lock_fd: int | None
+    _fd: int | None
+    _unsynced: threading.Condition
+    _has_unsynced: bool
+    _flusher_started: bool
+    _compacted_size: int
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self._fd = None
+        self._unsynced = threading.Condition()
+        self._has_unsynced = False
+        self._flusher_started = False
+        self._compacted_size = 0
+
+    def append_queued(self, items: list[JobQueueItem]):
+        self._append([_record("queued", asdict(item)) for item in items])
+
+    def append_dispatched(self, item: JobQueueItem):
+        self._append([_record("dispatched", [item.job_id, item.execution_id])])
+
+    def append_finished(self, job_id: str, execution_id: str):
+        self._append([_record("finished", [job_id, execution_id])])
+
+    # Returns every execution that's in the queue or was dispatched and hasn't
+    # finished, in the order they were queued, along with whether it was
+    # dispatched.
+    def read(self):
+        queue_paths = QueuePathsBuilder(getcwd())
+        with self._lock:
+            with self._flock(fcntl.LOCK_SH):
+                return list(_replay(queue_paths.journal_file).values())
+
+    # Replaces the journal with one holding only the given items.
+    def write(self, items: list[tuple[JobQueueItem, bool]]):
+        with self._lock:
+            with self._flock(fcntl.LOCK_EX):
+                self._write(items)
+
+    # Rewrites the journal without the records of finished executions once it
+    # grows over COMPACTION_SIZE, and over twice its size after the previous
+    # compaction, so a long queue doesn't trigger a compaction on every append.
+    def compact_if_needed(self):
+        queue_paths = QueuePathsBuilder(getcwd())
+        with self._lock:
+            try:
+                size = stat(queue_paths.journal_file).st_size
+            except FileNotFoundError:
+                return
+            if size < max(COMPACTION_SIZE, self._compacted_size * 2):
+                return
+            with self._flock(fcntl.LOCK_EX):
+                self._write(_replay(queue_paths.journal_file).values())
+            log.info("job queue journal compacted")
+
+    def _append(self, records: list[str]):
+        data = "".join(records).encode()
+        with self._lock:
+            with self._flock(fcntl.LOCK_SH):
+                self._open()
+                write(self._fd, data)
+        self._mark_unsynced()
+
+    # Must be called while holding the lock.
+    def _write(self, items):
+        queue_paths = QueuePathsBuilder(getcwd())
+        tmp_file = f"{queue_paths.journal_file}.tmp"
+        with open(tmp_file, "w") as f:
+            for item, dispatched in items:
+                f.write(_record("queued", asdict(item)))
+                if dispatched:
+                    f.write(_record("dispatched", [item.job_id, item.execution_id]))
+            f.flush()
+            fsync(f.fileno())
+        rename(tmp_file, queue_paths.journal_file)
+        _fsync_dir(queue_paths.queue_dir)
+        self._compacted_size = stat(queue_paths.journal_file).st_size
+
+    # Must be called while holding the lock. The journal is reopened when
+    # it was replaced by another process since it was last opened.
+    def _open(self):
+        queue_paths = QueuePathsBuilder(getcwd())
+        if self._fd is not None:
+            try:
+                if fstat(self._fd).st_ino == stat(queue_paths.journal_file).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            close(self._fd)
+        self._fd = os.open(
+            queue_paths.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        )
+
+    # Must be called while holding the lock, as `flock` locks are shared by
+    # every thread using the same file descriptor.
+    @contextmanager
+    def _flock(self, operation: int):
+        if self._lock_fd is None:
+            queue_paths = QueuePathsBuilder(getcwd())
+            makedirs(queue_paths.queue_dir, exist_ok=True)
+            self._lock_fd = os.open(queue_paths.lock_file, os.O_RDWR | os.O_CREAT)
+        fcntl.flock(self._lock_fd, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _mark_unsynced(self):
+        with self._unsynced:
+            if not self._flusher_started:
+                self._flusher_started = True
+                threading.Thread(target=self._flusher, daemon=True).start()
+            self._has_unsynced = True
+            self._unsynced.notify()
+
+    # Appends that happen while waiting for SYNC_INTERVAL are flushed
+    # together with a single `fsync`.
+    def _flusher(self):
+        while True:
+            with self._unsynced:
+                while not self._has_unsynced:
+                    self._unsynced.wait()
+            sleep(SYNC_INTERVAL)
+            with self._unsynced:
+                self._has_unsynced = False
+            with self._lock:
+                fd = self._fd
+            try:
+                fsync(fd)
+            except OSError:
+                # The journal was replaced, and its replacement was already
+                # synced while compacting.
+                pass
+
+
+def _record(kind: str, data: Any):
+    return f"{kind}\t{json.dumps(data, separators=(',', ':'))}\n"
+
+
+def _replay(journal_file: str):
+    live: dict[tuple[str, str], tuple[JobQueueItem, bool]] = {}
+    if not exists(journal_file):
+        return live
+    with open(journal_file, "br") as f:
+        content = f.read()
+    # A partially written record at the end is the result of a crash in the
+    # middle of an append, and is ignored.
+    end = content.rfind(b"\n") + 1
+    for line in content[:end].decode().splitlines():
+        [kind, raw_data] = line.split("\t", 1)
+        data = json.loads(raw_data)
+        if kind == "queued":
+            item = JobQueueItem(**data)
+            live[(item.job_id, item.execution_id)] = (item, False)
+        elif kind == "dispatched":
+            key = tuple(data)
+            if key in live:
+                live[key] = (live[key][0], True)
+        elif kind == "finished":
+            live.pop(tuple(data), None)
+    return live
+
+
+def _fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
+
+job_queue_journal = JobQueueJournal()
@@ -1,19 +1,56 @@
-import json
-from signal import SIGINT
-from subprocess import Popen, DEVNULL
-from os import getcwd, makedirs, killpg, environ
+import asyncio
+import os
+import threading
+from datetime import datetime, timezone
+from select import select
+from signal import SIGINT, SIGKILL
+from subprocess import Popen, DEVNULL, PIPE, STDOUT
+from os import close, getcwd, getenv, makedirs, killpg, environ, read
+from time import monotonic
+from typing import BinaryIO
 
+from servitor.config import config
 from servitor.framework.event_bus import get_event_bus_client
+from servitor.line_index import LineIndexWriter
 from servitor.paths import JobExecutionPathsBuilder, JobPathsBuilder
+from servitor.resources import (
+    build_preexec,
+    build_resource_usage,
+    create_execution_cgroup,
+    warn_unenforced_limits,
+)
+from servitor.shared_memory import get_shared_memory
 from servitor.state import state
 
+LOG_CAPTURE = getenv("SERVITOR_LOG_CAPTURE", "file")
+LOG_TIMESTAMPS = getenv("SERVITOR_LOG_TIMESTAMPS", "false") == "true"
+LOG_BUFFER_SIZE = int(getenv("SERVITOR_LOG_BUFFER_SIZE", str(1024 * 1024)))
+LOG_READ_SIZE = 64 * 1024
+LOG_FLUSH_INTERVAL = 1
+LOG_NOTIFICATION_INTERVAL = 0.05
+LOG_DRAIN_TIMEOUT = 1
+TIMEOUT_KILL_DELAY = 10
 
-def run_job(job_id: str, execution_id: str):
+
+# Runs the job without blocking the event loop, so a single process can
+# supervise many executions at the same time. Executions that run for longer
+# than the `timeout` in the spec of the job are interrupted like cancelled
+# ones, and killed if they're still running TIMEOUT_KILL_DELAY seconds later.
+# Config and state are read and written in the default executor, as they wait
+# on locks and disks, which would hold up every other execution.
+async def run_job(job_id: str, execution_id: str):
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(None, config.get_job, job_id)
+    spec = job["spec"]
     job_paths = JobPathsBuilder(getcwd(), job_id)
     job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
-    with open(job_execution_paths.input_values_file, "r") as f:
-        input_values = json.load(f)
+    execution = await loop.run_in_executor(
+        None, state.get_job_execution, job_id, execution_id
+    )
+    input_values = execution["input_values"]
     event_bus_client = get_event_bus_client()
+    metrics = get_shared_memory().metrics
+    created_at = datetime.fromisoformat(execution["status_history"][0]["timestamp"])
 
     job_env = dict(
         environ,
@@ -24,11 +61,22 @@ def run_job(job_id: str, execution_id: str):
     )
 
     process: Popen = None
+    started_at: float | None = None
+    resource_usage: dict | None = None
     cancelled: bool = False
+    timed_out: bool = False
+    timers: list[asyncio.TimerHandle] = []
     status: str = None
     result_exit_code: int = None
     result_message: str = None
 
+    def interrupt(signal: int = SIGINT):
+        if process is not None and process.returncode is None:
+            try:
+                killpg(process.pid, signal)
+            except ProcessLookupError:
+                pass
+
     def listen_for_cancellation(msg):
         if (
             msg["id"] == "job_execution_cancellation_requested"
@@ -37,31 +85,79 @@ def run_job(job_id: str, execution_id: str):
         ):
             nonlocal cancelled
             cancelled = True
-            killpg(process.pid, SIGINT)
+            interrupt()
+
+    def time_out():
+        nonlocal timed_out
+        timed_out = True
+        interrupt()
+        timers.append(loop.call_later(TIMEOUT_KILL_DELAY, interrupt, SIGKILL))
 
-    event_bus_client.listen(listen_for_cancellation)
+    event_bus_client.listen(
+        listen_for_cancellation,
+        ids=["job_execution_cancellation_requested"],
+        job_id=job_id,
+    )
+    cgroup = None
     try:
+        cgroup = create_execution_cgroup(job_id, execution_id)
+        applied_limits = cgroup.set_limits(spec) if cgroup is not None else []
+        warn_unenforced_limits(job_id, spec, applied_limits)
         makedirs(job_execution_paths.logs_dir, exist_ok=True)
-        with open(job_execution_paths.main_log_file, "w") as job_log:
+        with open(job_execution_paths.main_log_file, "bw") as job_log:
+            capture = LOG_CAPTURE == "pipe"
             process = Popen(
                 [job_paths.run_file],
                 cwd=job_paths.home,
-                stdout=job_log,
-                stderr=job_log,
+                stdout=PIPE if capture else job_log,
+                stderr=STDOUT if capture else job_log,
                 stdin=DEVNULL,
                 start_new_session=True,
                 env=job_env,
+                preexec_fn=build_preexec(spec, cgroup),
+            )
+            started_at = monotonic()
+            if spec.get("timeout") is not None:
+                timers.append(loop.call_later(spec["timeout"], time_out))
+            await loop.run_in_executor(
+                None, state.set_job_execution_status, job_id, execution_id, "running"
+            )
+            metrics.observe_queue_time(
+                job_id, (datetime.now(tz=timezone.utc) - created_at).total_seconds()
+            )
+            # Descendants of the job can keep the pipe open after it exits, so
+            # capture doesn't wait for the end of the output to reap it.
+            if capture:
+                exited = threading.Event()
+                captured = loop.run_in_executor(
+                    None,
+                    capture_log,
+                    job_id,
+                    execution_id,
+                    process.stdout,
+                    job_log,
+                    exited,
+                )
+            exit_code, rusage = await wait_process(process)
+            if capture:
+                exited.set()
+                await captured
+                process.stdout.close()
+            resource_usage = build_resource_usage(
+                rusage,
+                monotonic() - started_at,
+                cgroup.read_usage() if cgroup is not None else None,
             )
-            state.set_job_execution_status(job_id, execution_id, "running")
-            exit_code = process.wait()
     except Exception as ex:
         status = "failure"
         result_exit_code = -1
         result_message = str(ex)
     else:
-        if cancelled:
+        if timed_out:
+            status = "timed_out"
+        elif cancelled:
             status = "cancelled"
-        elif exit_code > 0:
+        elif exit_code != 0:
             status = "failure"
         else:
             status = "success"
@@ -69,7 +165,159 @@ def run_job(job_id: str, execution_id: str):
         result_message = ""
     finally:
         event_bus_client.unlisten(listen_for_cancellation)
-        state.set_job_execution_status(job_id, execution_id, status)
-        state.set_job_execution_result(
-            job_id, execution_id, result_exit_code, result_message
+        for timer in timers:
+            timer.cancel()
+        if cgroup is not None:
+            cgroup.remove()
+        if started_at is not None:
+            metrics.observe_duration(job_id, monotonic() - started_at)
+        if resource_usage is not None:
+            metrics.add_resource_usage(job_id, resource_usage)
+        await loop.run_in_executor(
+            None,
+            _write_outcome,
+            job_id,
+            execution_id,
+            status,
+            result_exit_code,
+            result_message,
+            resource_usage,
         )
+
+
+def _write_outcome(
+    job_id: str,
+    execution_id: str,
+    status: str,
+    exit_code: int,
+    message: str,
+    resource_usage: dict | None,
+):
+    if resource_usage is not None:
+        state.set_job_execution_resources(job_id, execution_id, resource_usage)
+    state.set_job_execution_status(job_id, execution_id, status)
+    state.set_job_execution_result(job_id, execution_id, exit_code, message)
+
+
+# Waits for the process to exit through a pidfd, which becomes readable when
+# the process exits. Falls back to waiting in a thread where pidfds aren't
+# supported. Returns the exit code along with the resource usage of the
+# process.
+async def wait_process(process: Popen):
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        return await loop.run_in_executor(None, _wait4, process)
+
+    exited = asyncio.Event()
+    loop.add_reader(pidfd, exited.set)
+    try:
+        await exited.wait()
+    finally:
+        loop.remove_reader(pidfd)
+        close(pidfd)
+    return _wait4(process)
+
+
+def _wait4(process: Popen):
+    [_, wait_status, rusage] = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    return process.returncode, rusage
+
+
+# Reads the output of the job through a pipe, writing it to disk in batches
+# while keeping the most recent part in a shared ring buffer, so live viewers
+# can be served from memory. Everything not yet written to disk is always
+# present in the ring buffer. Once the job exits, the output still in the pipe
+# is read for up to LOG_DRAIN_TIMEOUT seconds, and whatever descendants of the
+# job write after that is lost.
+def capture_log(
+    job_id: str,
+    execution_id: str,
+    pipe: BinaryIO,
+    job_log: BinaryIO,
+    exited: threading.Event,
+):
+    log_buffers = get_shared_memory().log_buffers
+    log_buffer = log_buffers.acquire(job_id, execution_id)
+    line_index_writer = LineIndexWriter(
+        JobExecutionPathsBuilder(
+            JobPathsBuilder(getcwd(), job_id), execution_id
+        ).line_index_file
+    )
+    event_bus_client = get_event_bus_client()
+    batch_size = 0
+    if log_buffer is not None:
+        batch_size = max((log_buffers.size - LOG_READ_SIZE) // 2, 0)
+
+    pending = bytearray()
+    written = 0
+    notified = 0
+    at_line_start = True
+    last_flush = last_notification = monotonic()
+    drain_deadline = None
+    try:
+        while True:
+            idle = len(pending) == 0 and notified == written
+            timeout = LOG_FLUSH_INTERVAL if idle else LOG_NOTIFICATION_INTERVAL
+            if exited.is_set():
+                if drain_deadline is None:
+                    drain_deadline = monotonic() + LOG_DRAIN_TIMEOUT
+                timeout = min(timeout, max(drain_deadline - monotonic(), 0))
+            readable, _, _ = select([pipe], [], [], timeout)
+            if drain_deadline is not None and (
+                not readable or monotonic() >= drain_deadline
+            ):
+                break
+            if readable:
+                chunk = read(pipe.fileno(), LOG_READ_SIZE)
+                if not chunk:
+                    break
+                if LOG_TIMESTAMPS:
+                    chunk, at_line_start = _add_timestamps(chunk, at_line_start)
+                pending += chunk
+                written += len(chunk)
+                line_index_writer.write(chunk)
+                if log_buffer is not None:
+                    log_buffer.write(chunk)
+
+            now = monotonic()
+            if len(pending) >= batch_size or now - last_flush >= LOG_FLUSH_INTERVAL:
+                job_log.write(pending)
+                job_log.flush()
+                pending.clear()
+                last_flush = now
+            if (
+                log_buffer is not None
+                and notified != written
+                and now - last_notification >= LOG_NOTIFICATION_INTERVAL
+            ):
+                event_bus_client.send(
+                    "job_execution_log_appended",
+                    {"job_id": job_id, "execution_id": execution_id, "offset": written},
+                    coalesce_key=execution_id,
+                )
+                notified = written
+                last_notification = now
+    finally:
+        job_log.write(pending)
+        job_log.flush()
+        line_index_writer.close()
+        if log_buffer is not None:
+            log_buffers.release(log_buffer)
+
+
+def _add_timestamps(chunk: bytes, at_line_start: bool):
+    timestamp = f"{datetime.now(tz=timezone.utc).isoformat()} ".encode()
+    result = bytearray()
+    for i, line in enumerate(chunk.split(b"\n")):
+        if i > 0:
+            result += b"\n"
+            at_line_start = True
+        if line:
+            if at_line_start:
+                result += timestamp
+                at_line_start = False
+            result += line
+    return bytes(result), at_line_start
@@ -0,0 +1,56 @@
+from typing import TextIO
+
+LINE_INDEX_INTERVAL = 1000
+SCAN_BLOCK_SIZE = 64 * 1024
+
+
+# The line index of a log is a TSV file with the offset where every
+# LINE_INDEX_INTERVAL-th line starts, with the shape `<line>\t<offset>`, where
+# lines are counted from 0. Finding a line means jumping to the closest
+# previous entry and scanning from there.
+class LineIndexWriter:
+    _file: TextIO
+    _lines: int
+    _offset: int
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "w")
+        self._lines = 0
+        self._offset = 0
+
+    def write(self, chunk: bytes):
+        newlines = chunk.count(b"\n")
+        next_entry = (self._lines // LINE_INDEX_INTERVAL + 1) * LINE_INDEX_INTERVAL
+        if self._lines + newlines >= next_entry:
+            position = -1
+            for line in range(self._lines + 1, self._lines + newlines + 1):
+                position = chunk.index(b"\n", position + 1)
+                if line % LINE_INDEX_INTERVAL == 0:
+                    self._file.write(f"{line}\t{self._offset + position + 1}\n")
+            self._file.flush()
+        self._lines += newlines
+        self._offset += len(chunk)
+
+    def close(self):
+        self._file.close()
+
+
+def build_line_index(log_file: str, line_index_file: str):
+    line_index_writer = LineIndexWriter(line_index_file)
+    try:
+        with open(log_file, "br") as f:
+            while chunk := f.read(SCAN_BLOCK_SIZE):
+                line_index_writer.write(chunk)
+    finally:
+        line_index_writer.close()
+
+
+def read_line_index(line_index_file: str):
+    try:
+        with open(line_index_file, "r") as f:
+            return [
+                (int(line), int(offset))
+                for [line, offset] in [l.split("\t") for l in f.read().splitlines()]
+            ]
+    except FileNotFoundError:
+        return []
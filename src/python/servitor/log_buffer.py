@@ -0,0 +1,85 @@
+import ctypes
+import multiprocessing
+import multiprocessing.sharedctypes
+
+KEY_SIZE = 512
+
+
+# Ring buffer living in shared memory that holds the most recent output of a
+# live execution. `written` counts every byte ever written, so it's also the
+# offset in the log file right after the last byte in the buffer.
+class LogBuffer:
+    lock: multiprocessing.Lock
+    key: ctypes.Array
+    written: ctypes.c_uint64
+    data: ctypes.Array
+
+    def __init__(self, size: int) -> None:
+        self.lock = multiprocessing.Lock()
+        self.key = multiprocessing.sharedctypes.RawArray(ctypes.c_char, KEY_SIZE)
+        self.written = multiprocessing.sharedctypes.RawValue(ctypes.c_uint64, 0)
+        self.data = multiprocessing.sharedctypes.RawArray(ctypes.c_char, size)
+
+    def write(self, chunk: bytes):
+        size = len(self.data)
+        with self.lock:
+            if len(chunk) > size:
+                self.written.value += len(chunk) - size
+                chunk = chunk[-size:]
+            start = self.written.value % size
+            first = min(len(chunk), size - start)
+            self.data[start : start + first] = chunk[:first]
+            self.data[0 : len(chunk) - first] = chunk[first:]
+            self.written.value += len(chunk)
+
+    def read(self, key: bytes, since: int):
+        size = len(self.data)
+        with self.lock:
+            written = self.written.value
+            if self.key.value != key or since >= written or written - since > size:
+                return None
+            start = since % size
+            end = written % size
+            if start < end:
+                return self.data[start:end]
+            return self.data[start:size] + self.data[0:end]
+
+
+class LogBuffers:
+    _lock: multiprocessing.Lock
+    _buffers: list[LogBuffer]
+
+    def __init__(self, count: int, size: int) -> None:
+        self._lock = multiprocessing.Lock()
+        self._buffers = [LogBuffer(size) for _ in range(count)]
+
+    @property
+    def size(self):
+        return len(self._buffers[0].data) if len(self._buffers) > 0 else 0
+
+    def acquire(self, job_id: str, execution_id: str):
+        key = _key(job_id, execution_id)
+        with self._lock:
+            for buffer in self._buffers:
+                if buffer.key.value == b"":
+                    with buffer.lock:
+                        buffer.key.value = key
+                        buffer.written.value = 0
+                    return buffer
+        return None
+
+    def release(self, buffer: LogBuffer):
+        with self._lock:
+            with buffer.lock:
+                buffer.key.value = b""
+
+    def read(self, job_id: str, execution_id: str, since: int):
+        key = _key(job_id, execution_id)
+        for buffer in self._buffers:
+            if buffer.key.value == key:
+                return buffer.read(key, since)
+        return None
+
+
+def _key(job_id: str, execution_id: str):
+    return f"{job_id}\t{execution_id}".encode()[: KEY_SIZE - 1]
@@ -0,0 +1,211 @@
+import gzip
+import queue
+import struct
+import threading
+import zlib
+from bisect import bisect_right
+from os import getcwd, getenv, remove, rename
+from os.path import exists
+from typing import BinaryIO
+
+from servitor.config import config
+from servitor.framework.event_bus import LAGGED_ID, get_event_bus_client
+from servitor.framework.logging import log
+from servitor.line_index import build_line_index
+from servitor.paths import JobExecutionPathsBuilder, JobPathsBuilder
+from servitor.retention import FINISHED_STATUSES
+from servitor.state import state
+
+LOG_COMPRESSION = getenv("SERVITOR_LOG_COMPRESSION", "gzip")
+BLOCK_SIZE = 1024 * 1024
+
+# Compressed logs are a sequence of gzip members of up to BLOCK_SIZE bytes of
+# uncompressed data each, which together are a valid gzip file. Like in BGZF,
+# every member stores its own size in an extra field of its header, so a
+# reader can jump from member to member without decompressing them, and
+# start reading from any offset by decompressing a single block.
+MEMBER_HEADER = struct.Struct("<2sBBIBBH2sHI")
+MEMBER_TRAILER = struct.Struct("<II")
+GZIP_MAGIC = b"\x1f\x8b"
+GZIP_DEFLATE = 8
+GZIP_FEXTRA = 4
+GZIP_OS_UNKNOWN = 255
+SUBFIELD_ID = b"SV"
+
+
+# Runs in the main process, and builds the line index of the log of every
+# execution as soon as it finishes, unless it was built during capture. Then
+# compresses the log. When the event bus lagged behind, the logs of every
+# finished execution that weren't processed yet are.
+class LogCompressor:
+    _queue: queue.Queue
+
+    def __init__(self) -> None:
+        self._queue = queue.Queue()
+
+    def start(self):
+        get_event_bus_client().listen(
+            self._on_message, ids=["job_execution_status_changed", LAGGED_ID]
+        )
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _on_message(self, msg):
+        if msg["id"] == LAGGED_ID:
+            self._queue.put(None)
+        elif msg["payload"]["status"] in FINISHED_STATUSES:
+            self._queue.put((msg["payload"]["job_id"], msg["payload"]["execution_id"]))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._catch_up()
+            else:
+                self._process(*item)
+
+    def _catch_up(self):
+        for job in config.get_jobs():
+            executions = state.get_job_executions(
+                job["job_id"], statuses=FINISHED_STATUSES
+            )
+            for execution in reversed(executions):
+                self._process(job["job_id"], execution["execution_id"])
+
+    def _process(self, job_id: str, execution_id: str):
+        job_execution_paths = JobExecutionPathsBuilder(
+            JobPathsBuilder(getcwd(), job_id), execution_id
+        )
+        try:
+            if not exists(job_execution_paths.line_index_file):
+                build_line_index(
+                    job_execution_paths.main_log_file,
+                    job_execution_paths.line_index_file,
+                )
+            if LOG_COMPRESSION != "none":
+                compress_log(
+                    job_execution_paths.main_log_file,
+                    job_execution_paths.compressed_main_log_file,
+                )
+        except FileNotFoundError:
+            pass
+        except Exception:
+            log.exception(f"error processing log of job: {job_id}")
+
+
+# Replaces the log file with its compressed version. Readers that already
+# opened the log file can keep reading it.
+def compress_log(log_file: str, compressed_log_file: str):
+    tmp_file = f"{compressed_log_file}.tmp"
+    with open(log_file, "br") as src, open(tmp_file, "bw") as dst:
+        while block := src.read(BLOCK_SIZE):
+            dst.write(_build_member(block))
+        # An empty log still needs a member to be a valid gzip file.
+        if dst.tell() == 0:
+            dst.write(_build_member(b""))
+    rename(tmp_file, compressed_log_file)
+    remove(log_file)
+
+
+# Yields gzip members holding the log from the given offset on.
+def read_compressed_log(f: BinaryIO, since: int):
+    sent = False
+    for start, position, size, block_size in _read_members(f):
+        if start + block_size <= since:
+            continue
+        f.seek(position)
+        member = f.read(size)
+        if since > start:
+            member = _build_member(gzip.decompress(member)[since - start :])
+        sent = True
+        yield member
+    if not sent:
+        yield _build_member(b"")
+
+
+# Gives random access to a compressed log. The last decompressed block is
+# kept, as reads tend to hit the same block many times in a row.
+class CompressedLogFile:
+    file: BinaryIO
+    _members: list[tuple[int, int, int, int]]
+    _starts: list[int]
+    _block: tuple[int | None, bytes]
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.file = f
+        self._members = list(_read_members(f))
+        self._starts = [member[0] for member in self._members]
+        self._block = (None, b"")
+
+    def size(self):
+        if len(self._members) == 0:
+            return 0
+        [start, _, _, block_size] = self._members[-1]
+        return start + block_size
+
+    def read(self, offset: int, count: int):
+        result = bytearray()
+        i = max(bisect_right(self._starts, offset) - 1, 0)
+        while len(result) < count and i < len(self._members):
+            start = self._members[i][0]
+            block = self._read_block(i)
+            result += block[max(offset + len(result) - start, 0) :]
+            i += 1
+        return bytes(result[:count])
+
+    def close(self):
+        self.file.close()
+
+    def _read_block(self, i: int):
+        if self._block[0] != i:
+            [_, position, size, _] = self._members[i]
+            self.file.seek(position)
+            self._block = (i, gzip.decompress(self.file.read(size)))
+        return self._block[1]
+
+
+# Yields the decompressed log from the given offset on.
+def read_decompressed_log(f: BinaryIO, since: int):
+    for start, position, size, block_size in _read_members(f):
+        if start + block_size <= since:
+            continue
+        f.seek(position)
+        yield gzip.decompress(f.read(size))[max(since - start, 0) :]
+
+
+def _build_member(block: bytes):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(block) + compressor.flush()
+    size = MEMBER_HEADER.size + len(body) + MEMBER_TRAILER.size
+    header = MEMBER_HEADER.pack(
+        GZIP_MAGIC,
+        GZIP_DEFLATE,
+        GZIP_FEXTRA,
+        0,
+        0,
+        GZIP_OS_UNKNOWN,
+        8,
+        SUBFIELD_ID,
+        4,
+        size,
+    )
+    return header + body + MEMBER_TRAILER.pack(zlib.crc32(block), len(block))
+
+
+# Yields the uncompressed offset, position, size and uncompressed size of
+# every member, reading only their headers and trailers.
+def _read_members(f: BinaryIO):
+    start = 0
+    position = 0
+    while True:
+        f.seek(position)
+        header = f.read(MEMBER_HEADER.size)
+        if len(header) < MEMBER_HEADER.size:
+            return
+        [magic, _, _, _, _, _, _, subfield_id, _, size] = MEMBER_HEADER.unpack(header)
+        if magic != GZIP_MAGIC or subfield_id != SUBFIELD_ID:
+            raise ValueError("unexpected compressed log format")
+        f.seek(position + size - MEMBER_TRAILER.size)
+        [_, block_size] = MEMBER_TRAILER.unpack(f.read(MEMBER_TRAILER.size))
+        yield start, position, size, block_size
+        start += block_size
+        position += size
@@ -0,0 +1,116 @@
+from os import fstat, getcwd
+from typing import BinaryIO
+
+from servitor.line_index import SCAN_BLOCK_SIZE
+from servitor.log_compression import CompressedLogFile
+from servitor.paths import JobExecutionPathsBuilder, JobPathsBuilder
+from servitor.state import state
+
+
+class PlainLogFile:
+    file: BinaryIO
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.file = f
+
+    def size(self):
+        return fstat(self.file.fileno()).st_size
+
+    def read(self, offset: int, count: int):
+        self.file.seek(offset)
+        return self.file.read(count)
+
+    def close(self):
+        self.file.close()
+
+
+class ArchivedLogFile:
+    _content: bytes
+
+    def __init__(self, content: bytes) -> None:
+        self._content = content
+
+    def size(self):
+        return len(self._content)
+
+    def read(self, offset: int, count: int):
+        return self._content[offset : offset + count]
+
+    def close(self):
+        pass
+
+
+LogFile = PlainLogFile | CompressedLogFile | ArchivedLogFile
+
+
+# Opens the log of an execution wherever it's stored. Logs are compressed
+# after the execution finishes, so the plain log is tried first.
+def open_log_file(job_id: str, execution_id: str) -> LogFile:
+    job_execution_paths = JobExecutionPathsBuilder(
+        JobPathsBuilder(getcwd(), job_id), execution_id
+    )
+    try:
+        return PlainLogFile(open(job_execution_paths.main_log_file, "br"))
+    except FileNotFoundError:
+        pass
+    try:
+        f = open(job_execution_paths.compressed_main_log_file, "br")
+    except FileNotFoundError:
+        pass
+    else:
+        try:
+            return CompressedLogFile(f)
+        except Exception:
+            f.close()
+            raise
+    archived_log = state.get_archived_job_execution_log(job_id, execution_id)
+    if archived_log is None:
+        raise FileNotFoundError(job_execution_paths.main_log_file)
+    return ArchivedLogFile(archived_log)
+
+
+# Returns the offset where the line starts, counting lines from 0, or the
+# size of the log if it has less lines.
+def find_line_offset(
+    log_file: LogFile, line: int, line_index: list[tuple[int, int]]
+):
+    lines, offset = 0, 0
+    for entry_line, entry_offset in line_index:
+        if entry_line > line:
+            break
+        lines, offset = entry_line, entry_offset
+    while lines < line:
+        block = log_file.read(offset, SCAN_BLOCK_SIZE)
+        if not block:
+            return offset
+        newlines = block.count(b"\n")
+        if lines + newlines < line:
+            lines += newlines
+            offset += len(block)
+            continue
+        position = -1
+        for _ in range(line - lines):
+            position = block.index(b"\n", position + 1)
+        return offset + position + 1
+    return offset
+
+
+# Returns the offset where the last `count` lines of the log start, scanning
+# blocks backwards from the end. A trailing newline doesn't start a new line.
+def find_tail_offset(log_file: LogFile, count: int):
+    end = log_file.size()
+    if count <= 0:
+        return end
+    if end > 0 and log_file.read(end - 1, 1) == b"\n":
+        end -= 1
+    newlines = 0
+    while end > 0:
+        start = max(end - SCAN_BLOCK_SIZE, 0)
+        block = log_file.read(start, end - start)
+        position = len(block)
+        while (position := block.rfind(b"\n", 0, position)) != -1:
+            newlines += 1
+            if newlines == count:
+                return start + position + 1
+        end = start
+    return 0
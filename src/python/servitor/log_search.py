@@ -0,0 +1,249 @@
+import base64
+import queue
+import re
+import threading
+import zlib
+from collections import deque
+from os import getcwd, stat
+from typing import Iterable
+
+from servitor.config import config
+from servitor.framework.event_bus import LAGGED_ID, get_event_bus_client
+from servitor.framework.logging import log
+from servitor.log_compression import BLOCK_SIZE
+from servitor.log_files import open_log_file
+from servitor.paths import JobPathsBuilder
+from servitor.retention import FINISHED_STATUSES
+from servitor.state import state
+
+TOKEN = re.compile(rb"\w+")
+MIN_BLOOM_BITS = 1024
+MAX_BLOOM_BITS = 1024 * 256
+BLOOM_BITS_PER_TRIGRAM = 16
+
+
+# Every finished execution gets a line in the log index of its job, with the
+# shape `<execution_id>\t<bits>\t<base64 bloom filter>`. The bloom filter holds
+# the trigrams of every distinct word in the log, lowercased. Any line
+# containing a text also contains the trigrams of the words in the text, so
+# only the executions whose filter has all of them need to be scanned.
+class LogIndex:
+    _job_paths: JobPathsBuilder
+    _lock: threading.Lock
+    _inode: int | None
+    _offset: int
+    _blooms: dict[str, tuple[int, int]]
+
+    def __init__(self, job_paths: JobPathsBuilder) -> None:
+        self._job_paths = job_paths
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def indexed(self):
+        with self._lock:
+            self._refresh()
+            return set(self._blooms.keys())
+
+    # Returns the ids of every indexed execution, and the ids of the ones that
+    # may contain the text.
+    def candidates(self, text: str):
+        trigrams = _trigrams(TOKEN.findall(text.lower().encode()))
+        with self._lock:
+            self._refresh()
+            masks = {}
+            result = set()
+            for execution_id, (bits, bloom) in self._blooms.items():
+                if bits not in masks:
+                    masks[bits] = _bloom(trigrams, bits)
+                if bloom & masks[bits] == masks[bits]:
+                    result.add(execution_id)
+            return set(self._blooms.keys()), result
+
+    def append(self, execution_id: str, chunks: Iterable[bytes]):
+        words = set()
+        rest = b""
+        for chunk in chunks:
+            data = rest + chunk.lower()
+            end = data.rfind(b"\n") + 1
+            words.update(TOKEN.findall(data, 0, end))
+            rest = data[end:]
+        words.update(TOKEN.findall(rest))
+        trigrams = _trigrams(words)
+        bits = MIN_BLOOM_BITS
+        while bits < len(trigrams) * BLOOM_BITS_PER_TRIGRAM and bits < MAX_BLOOM_BITS:
+            bits *= 2
+        bloom = _bloom(trigrams, bits).to_bytes(bits // 8, "little")
+        with open(self._job_paths.log_index_file, "a") as f:
+            f.write(f"{execution_id}\t{bits}\t{base64.b64encode(bloom).decode()}\n")
+
+    def _reset(self, inode: int | None):
+        self._inode = inode
+        self._offset = 0
+        self._blooms = {}
+
+    def _refresh(self):
+        try:
+            index_stat = stat(self._job_paths.log_index_file)
+        except FileNotFoundError:
+            self._reset(None)
+            return
+
+        if index_stat.st_ino != self._inode or index_stat.st_size < self._offset:
+            self._reset(index_stat.st_ino)
+        if index_stat.st_size == self._offset:
+            return
+
+        with open(self._job_paths.log_index_file, "br") as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode().splitlines():
+            [execution_id, bits, bloom] = line.split("\t")
+            self._blooms[execution_id] = (
+                int(bits),
+                int.from_bytes(base64.b64decode(bloom), "little"),
+            )
+        self._offset += end
+
+
+class LogIndexes:
+    _lock: threading.Lock
+    _indexes: dict[str, LogIndex]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def get(self, job_id: str):
+        with self._lock:
+            if job_id not in self._indexes:
+                self._indexes[job_id] = LogIndex(JobPathsBuilder(getcwd(), job_id))
+            return self._indexes[job_id]
+
+
+log_indexes = LogIndexes()
+
+
+# Runs in the main process. Indexes the log of every execution when it
+# finishes, and catches up with the executions that finished while it wasn't
+# running, or while the event bus lagged behind.
+class LogIndexer:
+    _queue: queue.Queue
+
+    def __init__(self) -> None:
+        self._queue = queue.Queue()
+
+    def start(self):
+        get_event_bus_client().listen(
+            self._on_message, ids=["job_execution_status_changed", LAGGED_ID]
+        )
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _on_message(self, msg):
+        if msg["id"] == LAGGED_ID:
+            self._queue.put(None)
+        elif msg["payload"]["status"] in FINISHED_STATUSES:
+            self._queue.put((msg["payload"]["job_id"], msg["payload"]["execution_id"]))
+
+    def _run(self):
+        self._catch_up()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._catch_up()
+            else:
+                self._index(*item)
+
+    def _catch_up(self):
+        for job in config.get_jobs():
+            indexed = log_indexes.get(job["job_id"]).indexed()
+            executions = state.get_job_executions(
+                job["job_id"], statuses=FINISHED_STATUSES
+            )
+            for execution in reversed(executions):
+                if execution["execution_id"] not in indexed:
+                    self._index(job["job_id"], execution["execution_id"])
+
+    def _index(self, job_id: str, execution_id: str):
+        try:
+            log_indexes.get(job_id).append(
+                execution_id, read_execution_log(job_id, execution_id)
+            )
+        except FileNotFoundError:
+            pass
+        except Exception:
+            log.exception(f"error indexing log of job: {job_id}")
+
+
+# Yields the log of an execution in blocks, wherever it is stored.
+def read_execution_log(job_id: str, execution_id: str):
+    log_file = open_log_file(job_id, execution_id)
+    try:
+        offset = 0
+        while chunk := log_file.read(offset, BLOCK_SIZE):
+            yield chunk
+            offset += len(chunk)
+    finally:
+        log_file.close()
+
+
+# Yields the lines matching the pattern, with their line number and up to
+# `context` lines before and after them. Blocks without matches are skipped
+# without splitting them in lines.
+def search_log(chunks: Iterable[bytes], pattern: re.Pattern, context: int):
+    line_number = 0
+    before = deque(maxlen=context)
+    pending = []
+    rest = b""
+
+    def scan(data: bytes):
+        nonlocal line_number
+        if len(pending) == 0 and pattern.search(data) is None:
+            line_number += data.count(b"\n") + 1
+            if context > 0:
+                tail = data.rsplit(b"\n", context)[-context:]
+                before.extend(line.decode(errors="replace") for line in tail)
+            return
+        for line in data.split(b"\n"):
+            line_number += 1
+            text = line.decode(errors="replace")
+            for match in pending:
+                match["after"].append(text)
+            while len(pending) > 0 and len(pending[0]["after"]) >= context:
+                yield pending.pop(0)
+            if pattern.search(line):
+                match = {
+                    "line_number": line_number,
+                    "line": text,
+                    "before": list(before),
+                    "after": [],
+                }
+                if context == 0:
+                    yield match
+                else:
+                    pending.append(match)
+            before.append(text)
+
+    for chunk in chunks:
+        data = rest + chunk
+        end = data.rfind(b"\n")
+        if end == -1:
+            rest = data
+            continue
+        rest = data[end + 1 :]
+        yield from scan(data[:end])
+    if rest:
+        yield from scan(rest)
+    yield from pending
+
+
+def _trigrams(words: Iterable[bytes]):
+    return {word[i : i + 3] for word in words for i in range(len(word) - 2)}
+
+
+def _bloom(trigrams: Iterable[bytes], bits: int):
+    bloom = bytearray(bits // 8)
+    for trigram in trigrams:
+        position = zlib.crc32(trigram) % bits
+        bloom[position // 8] |= 1 << (position % 8)
+    return int.from_bytes(bloom, "little")
@@ -0,0 +1,336 @@
+import ctypes
+import multiprocessing
+import multiprocessing.sharedctypes
+from bisect import bisect_left
+
+from servitor.framework.http import LATENCY_BUCKETS, RequestStats
+
+MAX_JOBS = 1024
+JOB_ID_SIZE = 256
+STATUSES = ["created", "running", "success", "failure", "cancelled", "timed_out"]
+GAUGES = ["queue_pending", "slots_busy", "slots_total"]
+RESOURCE_FIELDS = [
+    "user_cpu_seconds",
+    "system_cpu_seconds",
+    "read_bytes",
+    "write_bytes",
+    "max_rss_bytes",
+]
+DURATION_BUCKETS = [1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 24 * 3600]
+QUEUE_TIME_BUCKETS = [0.01, 0.1, 1, 5, 15, 60, 300, 900, 3600]
+
+
+# Metrics of the job queue and the executions of every job, living in shared
+# memory so every process updates the same counters. Jobs get a slot the first
+# time they're seen, and jobs that don't fit in MAX_JOBS slots aren't counted.
+# Histograms are stored as the count of every bucket, with the overflow bucket
+# last, followed by the sum of the observed values.
+class Metrics:
+    _lock: multiprocessing.Lock
+    _job_ids: ctypes.Array
+    _gauges: ctypes.Array
+    _statuses: ctypes.Array
+    _durations: ctypes.Array
+    _queue_times: ctypes.Array
+    _resources: ctypes.Array
+    _job_indexes: dict[str, int]
+
+    def __init__(self) -> None:
+        self._lock = multiprocessing.Lock()
+        self._job_ids = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_char, MAX_JOBS * JOB_ID_SIZE
+        )
+        self._gauges = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_double, len(GAUGES)
+        )
+        self._statuses = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_double, MAX_JOBS * len(STATUSES)
+        )
+        self._durations = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_double, MAX_JOBS * (len(DURATION_BUCKETS) + 2)
+        )
+        self._queue_times = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_double, MAX_JOBS * (len(QUEUE_TIME_BUCKETS) + 2)
+        )
+        self._resources = multiprocessing.sharedctypes.RawArray(
+            ctypes.c_double, MAX_JOBS * len(RESOURCE_FIELDS)
+        )
+        self._job_indexes = {}
+
+    def set_gauge(self, gauge: str, value: float):
+        self._gauges[GAUGES.index(gauge)] = value
+
+    def add_status(self, job_id: str, status: str):
+        if status not in STATUSES:
+            return
+        with self._lock:
+            index = self._job_index(job_id)
+            if index is not None:
+                self._statuses[index * len(STATUSES) + STATUSES.index(status)] += 1
+
+    def observe_duration(self, job_id: str, seconds: float):
+        self._observe(self._durations, DURATION_BUCKETS, job_id, seconds)
+
+    def observe_queue_time(self, job_id: str, seconds: float):
+        self._observe(self._queue_times, QUEUE_TIME_BUCKETS, job_id, seconds)
+
+    # Adds up the usage of every execution of the job, except for the peak
+    # memory, which keeps the highest one.
+    def add_resource_usage(self, job_id: str, usage: dict):
+        with self._lock:
+            index = self._job_index(job_id)
+            if index is None:
+                return
+            start = index * len(RESOURCE_FIELDS)
+            for i, field in enumerate(RESOURCE_FIELDS):
+                if field == "max_rss_bytes":
+                    self._resources[start + i] = max(
+                        self._resources[start + i], usage.get(field, 0)
+                    )
+                else:
+                    self._resources[start + i] += usage.get(field, 0)
+
+    def snapshot(self):
+        with self._lock:
+            jobs = []
+            for index in range(MAX_JOBS):
+                job_id = self._read_job_id(index)
+                if job_id == "":
+                    break
+                jobs.append(
+                    {
+                        "job_id": job_id,
+                        "statuses": {
+                            status: self._statuses[index * len(STATUSES) + i]
+                            for i, status in enumerate(STATUSES)
+                        },
+                        "duration": _read_histogram(
+                            self._durations, DURATION_BUCKETS, index
+                        ),
+                        "queue_time": _read_histogram(
+                            self._queue_times, QUEUE_TIME_BUCKETS, index
+                        ),
+                        "resources": {
+                            field: self._resources[index * len(RESOURCE_FIELDS) + i]
+                            for i, field in enumerate(RESOURCE_FIELDS)
+                        },
+                    }
+                )
+            gauges = {gauge: self._gauges[i] for i, gauge in enumerate(GAUGES)}
+            return {"gauges": gauges, "jobs": jobs}
+
+    def _observe(
+        self, values: ctypes.Array, buckets: list[float], job_id: str, value: float
+    ):
+        with self._lock:
+            index = self._job_index(job_id)
+            if index is None:
+                return
+            start = index * (len(buckets) + 2)
+            values[start + bisect_left(buckets, value)] += 1
+            values[start + len(buckets) + 1] += value
+
+    # Must be called while holding the lock. Slots are assigned in order and
+    # never released, so the ones already known by this process stay valid.
+    def _job_index(self, job_id: str):
+        if job_id in self._job_indexes:
+            return self._job_indexes[job_id]
+        for index in range(MAX_JOBS):
+            known_job_id = self._read_job_id(index)
+            if known_job_id == "":
+                encoded_job_id = job_id.encode()[: JOB_ID_SIZE - 1]
+                start = index * JOB_ID_SIZE
+                self._job_ids[start : start + len(encoded_job_id)] = encoded_job_id
+            elif known_job_id != job_id:
+                continue
+            self._job_indexes[job_id] = index
+            return index
+        return None
+
+    def _read_job_id(self, index: int):
+        start = index * JOB_ID_SIZE
+        return self._job_ids[start : start + JOB_ID_SIZE].split(b"\0")[0].decode()
+
+
+# Renders the metrics in the Prometheus text format.
+def render_metrics(
+    metrics: dict,
+    event_bus_metrics: dict,
+    request_stats: dict[tuple[str, str], RequestStats],
+):
+    lines = []
+
+    def metric(name: str, type: str, help: str, samples):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{_labels(labels)} {_value(value)}")
+
+    gauges = metrics["gauges"]
+    metric(
+        "servitor_job_queue_pending",
+        "gauge",
+        "Executions waiting to be dispatched to a job worker.",
+        [("", {}, gauges["queue_pending"])],
+    )
+    metric(
+        "servitor_job_slots",
+        "gauge",
+        "Execution slots of the job workers, by whether they're running one.",
+        [
+            ("", {"state": "busy"}, gauges["slots_busy"]),
+            ("", {"state": "idle"}, gauges["slots_total"] - gauges["slots_busy"]),
+        ],
+    )
+    metric(
+        "servitor_job_executions_total",
+        "counter",
+        "Executions that reached each status since Servitor started.",
+        [
+            ("", {"job_id": job["job_id"], "status": status}, count)
+            for job in metrics["jobs"]
+            for status, count in job["statuses"].items()
+        ],
+    )
+    metric(
+        "servitor_job_duration_seconds",
+        "histogram",
+        "Time from the start of an execution to its end.",
+        _histogram_samples(metrics["jobs"], "duration"),
+    )
+    metric(
+        "servitor_job_queue_time_seconds",
+        "histogram",
+        "Time from the creation of an execution to its start.",
+        _histogram_samples(metrics["jobs"], "queue_time"),
+    )
+    metric(
+        "servitor_job_cpu_seconds_total",
+        "counter",
+        "CPU time used by executions that finished since Servitor started.",
+        [
+            ("", {"job_id": job["job_id"], "mode": mode}, job["resources"][field])
+            for job in metrics["jobs"]
+            for mode, field in [
+                ("user", "user_cpu_seconds"),
+                ("system", "system_cpu_seconds"),
+            ]
+        ],
+    )
+    metric(
+        "servitor_job_io_bytes_total",
+        "counter",
+        "Bytes read and written by executions that finished since Servitor started.",
+        [
+            ("", {"job_id": job["job_id"], "direction": name}, job["resources"][field])
+            for job in metrics["jobs"]
+            for name, field in [("read", "read_bytes"), ("write", "write_bytes")]
+        ],
+    )
+    metric(
+        "servitor_job_max_rss_bytes",
+        "gauge",
+        "Highest peak memory of an execution that finished since Servitor started.",
+        [
+            ("", {"job_id": job["job_id"]}, job["resources"]["max_rss_bytes"])
+            for job in metrics["jobs"]
+        ],
+    )
+
+    clients = event_bus_metrics["clients"]
+    metric(
+        "servitor_event_bus_published_total",
+        "counter",
+        "Messages published to the event bus.",
+        [("", {}, event_bus_metrics["published"])],
+    )
+    for field, name, type, help in [
+        ("delivered", "delivered_total", "counter", "Messages delivered."),
+        ("dropped", "dropped_total", "counter", "Messages dropped for being slow."),
+        ("coalesced", "coalesced_total", "counter", "Messages replaced by newer ones."),
+        ("lagged", "lagged_total", "counter", "Times the whole queue was discarded."),
+        ("queue_depth", "queue_depth", "gauge", "Messages waiting to be delivered."),
+        (
+            "delivery_lag_seconds_total",
+            "delivery_lag_seconds_total",
+            "counter",
+            "Time messages waited to be delivered.",
+        ),
+    ]:
+        metric(
+            f"servitor_event_bus_{name}",
+            type,
+            help,
+            [("", {"client": client["name"]}, client[field]) for client in clients],
+        )
+
+    samples = []
+    for (method, route), stats in sorted(request_stats.items()):
+        labels = {"method": method, "route": _route_label(route)}
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + [float("inf")], stats.buckets):
+            cumulative += count
+            samples.append(("_bucket", {**labels, "le": bound}, cumulative))
+        samples.append(("_sum", labels, stats.seconds))
+        samples.append(("_count", labels, stats.requests))
+    metric(
+        "servitor_http_request_duration_seconds",
+        "histogram",
+        "Time spent handling requests, by route.",
+        samples,
+    )
+    metric(
+        "servitor_http_request_errors_total",
+        "counter",
+        "Requests that failed, by route.",
+        [
+            ("", {"method": method, "route": _route_label(route)}, stats.errors)
+            for (method, route), stats in sorted(request_stats.items())
+        ],
+    )
+    return "".join(f"{line}\n" for line in lines)
+
+
+def _read_histogram(values: ctypes.Array, buckets: list[float], index: int):
+    start = index * (len(buckets) + 2)
+    counts = values[start : start + len(buckets) + 1]
+    return {
+        "buckets": list(zip(buckets + [float("inf")], counts)),
+        "sum": values[start + len(buckets) + 1],
+    }
+
+
+def _histogram_samples(jobs: list[dict], key: str):
+    samples = []
+    for job in jobs:
+        labels = {"job_id": job["job_id"]}
+        cumulative = 0
+        for bound, count in job[key]["buckets"]:
+            cumulative += count
+            samples.append(("_bucket", {**labels, "le": bound}, cumulative))
+        samples.append(("_sum", labels, job[key]["sum"]))
+        samples.append(("_count", labels, cumulative))
+    return samples
+
+
+def _route_label(route: str):
+    return route.removeprefix("^").removesuffix("$")
+
+
+def _labels(labels: dict):
+    if len(labels) == 0:
+        return ""
+    pairs = [f'{key}="{_escape(_value(value))}"' for key, value in labels.items()]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
@@ -14,18 +14,42 @@ class JobPathsBuilder:
     def input_spec_file(self):
         return f"{self.run_file}.input.json"
 
+    @property
+    def spec_file(self):
+        return f"{self.run_file}.spec.json"
+
     @property
     def home(self):
         return dirname(self.run_file)
 
+    @property
+    def state_dir(self):
+        return join(self._root, "state", "jobs", self._job_id)
+
+    @property
+    def lock_file(self):
+        return join(self.state_dir, "lock")
+
     @property
     def executions_dir(self):
-        return join(self._root, "state", "jobs", self._job_id, "executions")
+        return join(self.state_dir, "executions")
 
     @property
     def last_execution_file(self):
         return join(self.executions_dir, "last_execution.txt")
 
+    @property
+    def execution_index_file(self):
+        return join(self.executions_dir, "index.tsv")
+
+    @property
+    def log_index_file(self):
+        return join(self.executions_dir, "log_index.tsv")
+
+    @property
+    def archive_dir(self):
+        return join(self.state_dir, "archive")
+
 
 class JobExecutionPathsBuilder:
     def __init__(self, job_paths: JobPathsBuilder, execution_id: str) -> None:
@@ -48,6 +72,10 @@ class JobExecutionPathsBuilder:
     def result_file(self):
         return join(self.execution_dir, "result.tsv")
 
+    @property
+    def resources_file(self):
+        return join(self.execution_dir, "resources.json")
+
     @property
     def logs_dir(self):
         return join(self.execution_dir, "logs")
@@ -55,3 +83,57 @@ class JobExecutionPathsBuilder:
     @property
     def main_log_file(self):
         return join(self.logs_dir, "main.txt")
+
+    @property
+    def compressed_main_log_file(self):
+        return f"{self.main_log_file}.gz"
+
+    @property
+    def line_index_file(self):
+        return join(self.logs_dir, "main.lines.tsv")
+
+
+class StatePathsBuilder:
+    def __init__(self, root: str) -> None:
+        self._root = root
+
+    @property
+    def state_dir(self):
+        return join(self._root, "state")
+
+    @property
+    def jobs_dir(self):
+        return join(self.state_dir, "jobs")
+
+    @property
+    def database_file(self):
+        return join(self.state_dir, "state.db")
+
+    @property
+    def feed_file(self):
+        return join(self.state_dir, "executions.tsv")
+
+    @property
+    def feed_lock_file(self):
+        return join(self.state_dir, "executions.lock")
+
+    @property
+    def schedules_file(self):
+        return join(self.state_dir, "schedules.json")
+
+
+class QueuePathsBuilder:
+    def __init__(self, root: str) -> None:
+        self._root = root
+
+    @property
+    def queue_dir(self):
+        return join(self._root, "state", "queue")
+
+    @property
+    def lock_file(self):
+        return join(self.queue_dir, "lock")
+
+    @property
+    def journal_file(self):
+        return join(self.queue_dir, "journal.tsv")
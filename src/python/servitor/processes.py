@@ -1,15 +1,26 @@
+import asyncio
 import queue
+from concurrent.futures import ThreadPoolExecutor
 import signal
 import threading
 from time import sleep
-from os import getcwd, makedirs, remove, chmod
+from os import getcwd, getenv, makedirs, remove, chmod
 from os.path import join, exists
 
 from servitor.framework.logging import log
 from servitor.framework.event_bus import EventBusClient, set_event_bus_client
 from servitor.job_runner import run_job
 from servitor.http import app
-from servitor.shared_memory import JobQueueItem, SharedMemory, set_shared_memory
+from servitor.scheduler import Scheduler
+from servitor.shared_memory import (
+    JobFinished,
+    JobQueueItem,
+    SharedMemory,
+    set_shared_memory,
+)
+
+HTTP_SERVER = getenv("SERVITOR_HTTP_SERVER", "asyncio")
+JOBS_PER_WORKER = int(getenv("SERVITOR_JOBS_PER_WORKER", "1"))
 
 
 def handle_shutdown(handler):
@@ -31,7 +42,10 @@ def start_http_server(shared_memory: SharedMemory, event_bus_client: EventBusCli
     sock_path = join(sockets_dir, "servitor.sock")
     if exists(sock_path):
         remove(sock_path)
-    http_server = app.build_server(sock_path)
+    if HTTP_SERVER == "threading":
+        http_server = app.build_server(sock_path)
+    else:
+        http_server = app.build_async_server(sock_path)
     thread = threading.Thread(target=http_server.serve_forever, args=(1,), daemon=True)
     thread.start()
 
@@ -47,7 +61,8 @@ def start_http_server(shared_memory: SharedMemory, event_bus_client: EventBusCli
 
     handle_shutdown(shutdown_handler)
     thread.join()
-    remove(sock_path)
+    if exists(sock_path):
+        remove(sock_path)
     log.info("http server shutted down")
 
 
@@ -63,12 +78,59 @@ def start_job_worker(shared_memory: SharedMemory, event_bus_client: EventBusClie
         keep_alive = False
 
     handle_shutdown(shutdown_handler)
-    while keep_alive:
-        try:
-            item: JobQueueItem = shared_memory.job_queue.get(timeout=1)
-            log.info("running job: " + item.job_id)
-            run_job(item.job_id, item.execution_id)
-        except queue.Empty:
-            pass
 
+    # Every worker supervises up to JOBS_PER_WORKER executions at the same
+    # time from a single event loop, and only takes new executions from the
+    # queue while it has free slots. Every execution can hold up to three
+    # threads of the default executor: one capturing its log, one waiting for
+    # its process where pidfds aren't supported, and one reading or writing
+    # its state. It's sized for all of them, so state writes never wait behind
+    # the others, and waiting on the queue gets a thread of its own.
+    async def supervise():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(JOBS_PER_WORKER * 3))
+        dispatch_executor = ThreadPoolExecutor(1)
+        running: set[asyncio.Task] = set()
+
+        async def run(item: JobQueueItem):
+            try:
+                log.info("running job: " + item.job_id)
+                await run_job(item.job_id, item.execution_id)
+            except Exception:
+                log.exception("error running job")
+            finally:
+                shared_memory.job_queue.put(
+                    JobFinished(item.job_id, item.execution_id)
+                )
+
+        while keep_alive:
+            if len(running) >= JOBS_PER_WORKER:
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                item: JobQueueItem = await loop.run_in_executor(
+                    dispatch_executor,
+                    lambda: shared_memory.dispatch_queue.get(timeout=1),
+                )
+            except queue.Empty:
+                continue
+            task = asyncio.create_task(run(item))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        if len(running) > 0:
+            await asyncio.wait(running)
+
+    asyncio.run(supervise())
     log.info("job worker shutted down")
+
+
+def start_scheduler(shared_memory: SharedMemory, event_bus_client: EventBusClient):
+    set_shared_memory(shared_memory)
+    set_event_bus_client(event_bus_client)
+    event_bus_client.start()
+    log.info("starting scheduler")
+    scheduler = Scheduler()
+    handle_shutdown(scheduler.stop)
+    scheduler.run()
+    log.info("scheduler shutted down")
@@ -0,0 +1,222 @@
+import ctypes
+import os
+import platform
+import re
+from os import getenv, rmdir
+from os.path import exists, isdir, join
+
+from servitor.framework.logging import log
+
+# A cgroup v2 directory delegated to Servitor, for example through `Delegate=`
+# in its systemd unit. When set, every execution runs in a cgroup of its own
+# under it, so the usage of all its processes is accounted for.
+CGROUP_ROOT = getenv("SERVITOR_CGROUP_ROOT")
+CGROUP_NAME = re.compile(r"[^\w.-]")
+CGROUP_CONTROLLERS = ["cpu", "memory", "pids"]
+# Keys of the limits in job specs that only cgroups can enforce.
+CGROUP_LIMITS = ["cpu_quota", "cpu_weight", "memory_max", "max_pids"]
+CPU_PERIOD = 100000
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30}
+
+
+# The cgroup of an execution. Processes join it from the child side of the
+# fork, before running the job, so none of them escapes it.
+class ExecutionCgroup:
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def join(self):
+        fd = os.open(join(self.path, "cgroup.procs"), os.O_WRONLY)
+        try:
+            os.write(fd, b"0")
+        finally:
+            os.close(fd)
+
+    # Applies the limits in the spec of the job that cgroups can enforce, and
+    # returns the keys of the ones that were applied.
+    def set_limits(self, spec: dict):
+        limits = []
+        if spec.get("cpu_quota") is not None:
+            quota = int(spec["cpu_quota"] * CPU_PERIOD)
+            limits.append(("cpu_quota", "cpu.max", f"{quota} {CPU_PERIOD}"))
+        if spec.get("cpu_weight") is not None:
+            limits.append(("cpu_weight", "cpu.weight", str(spec["cpu_weight"])))
+        if spec.get("memory_max") is not None:
+            limits.append(("memory_max", "memory.max", str(spec["memory_max"])))
+        if spec.get("max_pids") is not None:
+            limits.append(("max_pids", "pids.max", str(spec["max_pids"])))
+
+        applied = []
+        for key, file, value in limits:
+            try:
+                with open(join(self.path, file), "w") as f:
+                    f.write(value)
+            except OSError:
+                log.warning(f"can't set {file} of cgroup: {self.path}")
+                continue
+            applied.append(key)
+        return applied
+
+    def read_usage(self):
+        cpu = _read_flat_keyed(join(self.path, "cpu.stat"))
+        usage = {
+            "user_cpu_seconds": cpu.get("user_usec", 0) / 1_000_000,
+            "system_cpu_seconds": cpu.get("system_usec", 0) / 1_000_000,
+        }
+        try:
+            with open(join(self.path, "memory.peak")) as f:
+                usage["max_rss_bytes"] = int(f.read())
+        except FileNotFoundError:
+            # Kernels before 5.19 don't track the peak.
+            pass
+        read_bytes, write_bytes = 0, 0
+        try:
+            with open(join(self.path, "io.stat")) as f:
+                for line in f:
+                    for field in line.split()[1:]:
+                        [key, _, value] = field.partition("=")
+                        if key == "rbytes":
+                            read_bytes += int(value)
+                        elif key == "wbytes":
+                            write_bytes += int(value)
+        except FileNotFoundError:
+            pass
+        usage["read_bytes"] = read_bytes
+        usage["write_bytes"] = write_bytes
+        return usage
+
+    def remove(self):
+        try:
+            rmdir(self.path)
+        except OSError:
+            log.warning(f"can't remove cgroup, it still has processes: {self.path}")
+
+
+# Returns the cgroup for the execution, or None when there's no usable
+# delegated cgroup, in which case usage comes from `wait4` alone. Controllers
+# can only be enabled for the children of a cgroup without processes, so the
+# delegated cgroup must not hold any for limits to work.
+def create_execution_cgroup(job_id: str, execution_id: str):
+    if CGROUP_ROOT is None or not isdir(CGROUP_ROOT):
+        return None
+    _enable_controllers()
+    path = join(CGROUP_ROOT, CGROUP_NAME.sub("_", f"{job_id}-{execution_id}"))
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+    except OSError:
+        log.exception(f"can't create cgroup: {path}")
+        return None
+    if not exists(join(path, "cgroup.procs")):
+        log.warning(f"not a cgroup v2 directory: {CGROUP_ROOT}")
+        rmdir(path)
+        return None
+    return ExecutionCgroup(path)
+
+
+# Builds the resource usage of an execution from the `rusage` of its process,
+# which covers the process and every descendant it waited for. Usage read from
+# the cgroup of the execution takes precedence, as it also covers descendants
+# that were never waited for.
+def build_resource_usage(
+    rusage, wall_seconds: float, cgroup_usage: dict | None = None
+):
+    usage = {
+        "source": "rusage",
+        "wall_seconds": wall_seconds,
+        "user_cpu_seconds": rusage.ru_utime,
+        "system_cpu_seconds": rusage.ru_stime,
+        # Linux reports it in kilobytes.
+        "max_rss_bytes": rusage.ru_maxrss * 1024,
+        # Block operations are counted in 512 byte units.
+        "read_bytes": rusage.ru_inblock * 512,
+        "write_bytes": rusage.ru_oublock * 512,
+    }
+    if cgroup_usage is not None:
+        usage.update(cgroup_usage, source="cgroup")
+    return usage
+
+
+# Logs the limits in the spec of the job that couldn't be applied through the
+# cgroup of the execution, or at all when it has none. There's no fallback for
+# them: `RLIMIT_AS` limits address space rather than memory use, and breaks
+# runtimes that reserve a lot of it up front.
+def warn_unenforced_limits(job_id: str, spec: dict, applied: list[str]):
+    for key in CGROUP_LIMITS:
+        if spec.get(key) is not None and key not in applied:
+            log.warning(f"{key} of job isn't enforced without a cgroup: {job_id}")
+
+
+# Builds the function that runs in the child process right before the job
+# starts, which joins the cgroup of the execution and sets its priorities.
+# Returns None when there's nothing to do, as running Python code between fork
+# and exec isn't safe in a threaded process, and rules out the faster ways of
+# spawning processes.
+def build_preexec(spec: dict, cgroup: ExecutionCgroup | None):
+    nice = spec.get("nice")
+    ioprio = None
+    if spec.get("ionice_class") is not None:
+        ioprio_class = IOPRIO_CLASSES[spec["ionice_class"]]
+        ioprio = (ioprio_class << IOPRIO_CLASS_SHIFT) | spec.get("ionice_level", 4)
+    ioprio_set = _ioprio_set() if ioprio is not None else None
+    if cgroup is None and nice is None and ioprio_set is None:
+        return None
+
+    def preexec():
+        if cgroup is not None:
+            cgroup.join()
+        if nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+        if ioprio_set is not None:
+            ioprio_set(ioprio)
+
+    return preexec
+
+
+_controllers_enabled = False
+
+
+def _enable_controllers():
+    global _controllers_enabled
+    if _controllers_enabled:
+        return
+    _controllers_enabled = True
+    try:
+        with open(join(CGROUP_ROOT, "cgroup.controllers")) as f:
+            available = f.read().split()
+        controllers = [c for c in CGROUP_CONTROLLERS if c in available]
+        with open(join(CGROUP_ROOT, "cgroup.subtree_control"), "w") as f:
+            f.write(" ".join(f"+{controller}" for controller in controllers))
+    except OSError:
+        log.warning(f"can't enable cgroup controllers in: {CGROUP_ROOT}")
+
+
+# There's no wrapper for `ioprio_set` in Python nor in most libcs, so it's
+# called through `syscall`, on the architectures its number is known for.
+def _ioprio_set():
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None:
+        log.warning(f"ionice isn't supported on {platform.machine()}")
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    def ioprio_set(ioprio: int):
+        if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+            raise OSError(ctypes.get_errno(), "ioprio_set failed")
+
+    return ioprio_set
+
+
+def _read_flat_keyed(path: str):
+    values = {}
+    with open(path) as f:
+        for line in f:
+            [key, value] = line.split()
+            values[key] = int(value)
+    return values
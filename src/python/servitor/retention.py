@@ -0,0 +1,70 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from os import getenv
+from time import sleep
+
+from servitor.config import config
+from servitor.framework.logging import log
+from servitor.state import state
+
+RETENTION_INTERVAL = int(getenv("SERVITOR_RETENTION_INTERVAL", "3600"))
+ARCHIVE_BATCH_SIZE = 1000
+FINISHED_STATUSES = ["success", "failure", "cancelled", "timed_out"]
+# Statuses covered by `keep_failures_days`.
+FAILED_STATUSES = ["failure", "timed_out"]
+
+
+# Runs in the main process, and periodically archives the finished executions
+# of every job that are no longer covered by the retention policy in its spec.
+class RetentionCompactor:
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            for job in config.get_jobs():
+                try:
+                    self.compact(job)
+                except Exception:
+                    log.exception(f"error compacting job: {job['job_id']}")
+            sleep(RETENTION_INTERVAL)
+
+    def compact(self, job: dict):
+        spec = job["spec"]
+        keep_executions = spec.get("keep_executions")
+        keep_days = spec.get("keep_days")
+        keep_failures_days = spec.get("keep_failures_days")
+        if keep_executions is None and keep_days is None and keep_failures_days is None:
+            return
+
+        now = datetime.now(tz=timezone.utc)
+        expired = []
+        executions = state.get_job_executions(job["job_id"])
+        for position, execution in enumerate(executions):
+            if execution["status"] not in FINISHED_STATUSES:
+                continue
+            age = now - datetime.fromisoformat(
+                execution["status_history"][-1]["timestamp"]
+            )
+            if (
+                execution["status"] in FAILED_STATUSES
+                and keep_failures_days is not None
+            ):
+                expired_by_count = False
+                expired_by_age = age > timedelta(days=keep_failures_days)
+            else:
+                expired_by_count = (
+                    keep_executions is not None and position >= keep_executions
+                )
+                expired_by_age = keep_days is not None and age > timedelta(
+                    days=keep_days
+                )
+            if expired_by_count or expired_by_age:
+                expired.append(execution["execution_id"])
+
+        for i in range(0, len(expired), ARCHIVE_BATCH_SIZE):
+            state.archive_job_executions(
+                job["job_id"], expired[i : i + ARCHIVE_BATCH_SIZE]
+            )
+        if len(expired) > 0:
+            log.info(f"archived {len(expired)} executions of job: {job['job_id']}")
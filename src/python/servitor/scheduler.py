@@ -0,0 +1,217 @@
+import json
+import random
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from heapq import heappop, heappush
+from os import getcwd, makedirs, rename
+from os.path import dirname
+
+from servitor.config import config
+from servitor.cron import CronSchedule
+from servitor.framework.logging import log
+from servitor.paths import StatePathsBuilder
+from servitor.triggers import (
+    build_job_queue_item,
+    create_job_executions,
+    filter_input_values,
+    queue_job_executions,
+)
+
+MISFIRE_POLICIES = ["skip", "run_once", "run_all"]
+# Executions that start later than this after their time are misfires.
+MISFIRE_GRACE = 60
+# Upper bound of executions a single misfire can catch up on with `run_all`.
+MAX_CATCH_UP = 100
+# Seconds between checks for changes in the schedules of jobs. It also bounds
+# how long a jump of the system clock goes unnoticed.
+RELOAD_INTERVAL = 10
+
+
+@dataclass
+class ScheduledJob:
+    job_id: str
+    spec: dict
+    schedule: CronSchedule
+    # Time the job is scheduled for, and the time it's due to run, which is
+    # later when it has jitter.
+    fire_time: datetime
+    due_time: datetime
+    sequence: int
+
+
+# Runs in a process of its own, and triggers jobs that have a `schedule` in
+# their spec, as cron would. Scheduled jobs wait in a heap ordered by when
+# they're due, so waking up for the next one and rescheduling it are
+# logarithmic in the number of schedules. Entries of jobs whose schedule
+# changed stay in the heap, and are skipped when their sequence number no
+# longer matches the one of the job.
+#
+# The last time every job was scheduled for is kept in a file, so executions
+# missed while Servitor wasn't running, or the system was suspended, are
+# handled by the misfire policy of the job when it starts again.
+class Scheduler:
+    _heap: list[tuple[datetime, int, str]]
+    _jobs: dict[str, ScheduledJob]
+    _sequence: int
+    _last_fire_times: dict[str, str]
+    _rejected: dict[str, str]
+    _stopped: threading.Event
+
+    def __init__(self) -> None:
+        self._heap = []
+        self._jobs = {}
+        self._sequence = 0
+        self._last_fire_times = {}
+        self._rejected = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        self._last_fire_times = _read_last_fire_times()
+        self._reload(initial=True)
+        reloaded_at = datetime.now(tz=timezone.utc)
+        while not self._stopped.is_set():
+            now = datetime.now(tz=timezone.utc)
+            if now - reloaded_at >= timedelta(seconds=RELOAD_INTERVAL):
+                self._reload()
+                reloaded_at = now
+            self._fire_due(now)
+            timeout = RELOAD_INTERVAL
+            if len(self._heap) > 0:
+                timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+            self._stopped.wait(max(timeout, 0))
+
+    def stop(self):
+        self._stopped.set()
+
+    # Schedules new jobs and jobs whose schedule changed, and drops the ones
+    # that no longer have one. The first time, jobs are scheduled from the
+    # last time they were scheduled for, so missed executions are noticed.
+    def _reload(self, initial: bool = False):
+        now = datetime.now(tz=timezone.utc)
+        jobs = {job["job_id"]: job for job in config.get_jobs()}
+        for job_id in list(self._jobs):
+            job = jobs.get(job_id)
+            if job is None or _schedule_changed(self._jobs[job_id], job):
+                del self._jobs[job_id]
+        for job_id, job in jobs.items():
+            spec = job["spec"]
+            if spec.get("schedule") is None:
+                continue
+            if job_id in self._jobs:
+                self._jobs[job_id].spec = spec
+                continue
+            # Schedules that can't be used are only reported once.
+            if self._rejected.get(job_id) == spec["schedule"]:
+                continue
+            try:
+                schedule = CronSchedule(spec["schedule"])
+            except ValueError as ex:
+                log.error(f"invalid schedule of job: {job_id}: {ex}")
+                self._rejected[job_id] = spec["schedule"]
+                continue
+            since = now
+            if initial and job_id in self._last_fire_times:
+                since = datetime.fromisoformat(self._last_fire_times[job_id])
+            self._schedule(job_id, spec, schedule, since)
+
+    def _schedule(
+        self, job_id: str, spec: dict, schedule: CronSchedule, since: datetime
+    ):
+        fire_time = schedule.next_after(since)
+        if fire_time is None:
+            log.error(f"schedule of job never matches: {job_id}")
+            self._rejected[job_id] = spec["schedule"]
+            return
+        due_time = fire_time + timedelta(
+            seconds=random.uniform(0, spec.get("schedule_jitter", 0))
+        )
+        self._sequence += 1
+        self._jobs[job_id] = ScheduledJob(
+            job_id, spec, schedule, fire_time, due_time, self._sequence
+        )
+        heappush(self._heap, (due_time, self._sequence, job_id))
+
+    # Triggers every job that's due, queueing all their executions at once.
+    def _fire_due(self, now: datetime):
+        items = []
+        fired = False
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            [_, sequence, job_id] = heappop(self._heap)
+            scheduled_job = self._jobs.get(job_id)
+            if scheduled_job is None or scheduled_job.sequence != sequence:
+                continue
+            fired = True
+            try:
+                items.extend(self._fire(scheduled_job, now))
+            except Exception:
+                log.exception(f"error triggering scheduled job: {job_id}")
+        queue_job_executions(items)
+        if fired:
+            _write_last_fire_times(self._last_fire_times)
+
+    # Returns the queue items of the executions of the job, which are more or
+    # less than one when it misfired, depending on its misfire policy, and
+    # schedules its next execution.
+    def _fire(self, scheduled_job: ScheduledJob, now: datetime):
+        job_id, spec = scheduled_job.job_id, scheduled_job.spec
+        fire_times = [scheduled_job.fire_time]
+        while len(fire_times) < MAX_CATCH_UP:
+            fire_time = scheduled_job.schedule.next_after(fire_times[-1])
+            if fire_time is None or fire_time > now:
+                break
+            fire_times.append(fire_time)
+        self._last_fire_times[job_id] = fire_times[-1].isoformat()
+        self._schedule(job_id, spec, scheduled_job.schedule, max(fire_times[-1], now))
+
+        count = 1
+        late = now - scheduled_job.due_time > timedelta(seconds=MISFIRE_GRACE)
+        if late or len(fire_times) > 1:
+            policy = spec.get("schedule_misfire", "run_once")
+            if policy not in MISFIRE_POLICIES:
+                log.warning(f"unknown misfire policy of job: {job_id}: {policy}")
+                policy = "run_once"
+            count = {"skip": 0, "run_once": 1, "run_all": len(fire_times)}[policy]
+            log.info(
+                f"scheduled job misfired: {job_id}"
+                f" (due {len(fire_times)} times, running {count})"
+            )
+        if count == 0:
+            return []
+
+        job = config.get_job(job_id)
+        input_values = filter_input_values(
+            job, job["spec"].get("schedule_input_values", {})
+        )
+        log.info(f"triggering scheduled job: {job_id}")
+        results = create_job_executions(job, [input_values] * count)
+        return [
+            build_job_queue_item(job, execution_id, None)
+            for execution_id, created in results
+            if created
+        ]
+
+
+def _schedule_changed(scheduled_job: ScheduledJob, job: dict):
+    spec = job["spec"]
+    return (
+        spec.get("schedule") != scheduled_job.spec.get("schedule")
+        or spec.get("schedule_jitter") != scheduled_job.spec.get("schedule_jitter")
+    )
+
+
+def _read_last_fire_times():
+    try:
+        with open(StatePathsBuilder(getcwd()).schedules_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_last_fire_times(last_fire_times: dict[str, str]):
+    schedules_file = StatePathsBuilder(getcwd()).schedules_file
+    makedirs(dirname(schedules_file), exist_ok=True)
+    tmp_file = f"{schedules_file}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(json.dumps(last_fire_times, indent=2, sort_keys=True) + "\n")
+    rename(tmp_file, schedules_file)
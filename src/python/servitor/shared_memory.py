@@ -1,20 +1,35 @@
 from dataclasses import dataclass
 import multiprocessing
 
+from servitor.log_buffer import LogBuffers
+from servitor.metrics import Metrics
+
 
 @dataclass
 class JobQueueItem:
     job_id: str
     execution_id: str
+    priority: str = "normal"
+    max_concurrency: int | None = None
+
+
+@dataclass
+class JobFinished:
+    job_id: str
+    execution_id: str
 
 
 class SharedMemory:
-    state_lock: multiprocessing.RLock
     job_queue: multiprocessing.Queue
+    dispatch_queue: multiprocessing.Queue
+    log_buffers: LogBuffers
+    metrics: Metrics
 
-    def __init__(self) -> None:
-        self.state_lock = multiprocessing.RLock()
+    def __init__(self, log_buffer_count: int = 0, log_buffer_size: int = 0) -> None:
         self.job_queue = multiprocessing.Queue()
+        self.dispatch_queue = multiprocessing.Queue()
+        self.log_buffers = LogBuffers(log_buffer_count, log_buffer_size)
+        self.metrics = Metrics()
 
 
 _shared_memory: SharedMemory | None = None
@@ -0,0 +1,513 @@
+import json
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from os import getcwd, makedirs, remove, rename
+from os.path import dirname, exists
+from shutil import rmtree
+from typing import Any, Callable
+
+from servitor.execution_archive import ExecutionArchive
+from servitor.framework.logging import log
+from servitor.paths import JobExecutionPathsBuilder, JobPathsBuilder
+
+WRITE_BATCH_SIZE = 256
+# Status histories are read for this many executions per query at most, well
+# below the limit of variables in a statement of older versions of SQLite.
+READ_BATCH_SIZE = 500
+BUSY_TIMEOUT = 30
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    last_execution INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS executions (
+    job_id TEXT NOT NULL,
+    execution_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    input_values TEXT NOT NULL,
+    exit_code INTEGER,
+    message TEXT,
+    resources TEXT,
+    archived INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, execution_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS executions_status
+    ON executions (status, job_id, execution_id);
+
+CREATE TABLE IF NOT EXISTS status_history (
+    job_id TEXT NOT NULL,
+    execution_id INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS status_history_execution
+    ON status_history (job_id, execution_id);
+"""
+EXECUTION_COLUMNS = "execution_id, status, input_values, exit_code, message, resources"
+
+
+# Keeps the state of every execution in a single SQLite database in WAL mode,
+# so readers never wait for writers and every process sees the same state
+# without going through the file system for each part of an execution. Logs
+# stay in the executions directory.
+#
+# Every process writes through a thread of its own, which commits all the
+# writes queued while the previous transaction was running in a single one, so
+# bursts of status changes cost one fsync. Writes are only acknowledged once
+# committed. Readers get a connection per thread, and read in a transaction so
+# they never see half of a write.
+class SQLiteStateBackend:
+    _database_file: str
+    _local: threading.local
+    _writes: queue.Queue
+    _writer: threading.Thread | None
+    _writer_lock: threading.Lock
+
+    def __init__(self, database_file: str) -> None:
+        self._database_file = database_file
+        self._local = threading.local()
+        self._writes = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def get_job_executions(
+        self,
+        job_id: str,
+        limit: int | None = None,
+        before: str | None = None,
+        after: str | None = None,
+        statuses: list[str] | None = None,
+    ):
+        conditions = ["job_id = ?", "archived = 0"]
+        params: list[Any] = [job_id]
+        if before is not None:
+            conditions.append("execution_id < ?")
+            params.append(int(before))
+        if after is not None:
+            conditions.append("execution_id > ?")
+            params.append(int(after))
+        if statuses is not None:
+            conditions.append(f"status IN ({', '.join('?' for _ in statuses)})")
+            params.extend(statuses)
+        # Paging forward from `after` takes the executions right after it,
+        # which are still returned newest first.
+        forward = after is not None and before is None
+        sql = (
+            f"SELECT {EXECUTION_COLUMNS} FROM executions"
+            f" WHERE {' AND '.join(conditions)}"
+            f" ORDER BY execution_id {'ASC' if forward else 'DESC'}"
+        )
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self._read() as db:
+            rows = db.execute(sql, params).fetchall()
+            if len(rows) == 0:
+                return []
+            if forward:
+                rows.reverse()
+            status_histories = self._read_status_histories(
+                db, job_id, [row[0] for row in rows]
+            )
+        return [_build_execution(row, status_histories[row[0]]) for row in rows]
+
+    def get_job_execution(self, job_id: str, execution_id: str):
+        with self._read() as db:
+            row = db.execute(
+                f"SELECT {EXECUTION_COLUMNS} FROM executions"
+                " WHERE job_id = ? AND execution_id = ?",
+                (job_id, int(execution_id)),
+            ).fetchone()
+            if row is None:
+                raise _execution_not_found(job_id, execution_id)
+            status_histories = self._read_status_histories(db, job_id, [row[0]])
+        return _build_execution(row, status_histories[row[0]])
+
+    def create_job_execution(self, job_id: str, input_values: Any):
+        execution_ids, _ = self.create_job_executions(job_id, [input_values])
+        return execution_ids[0]
+
+    # Creates many executions of the job at once, in a single transaction.
+    # Returns their ids along with the timestamp they were created at.
+    def create_job_executions(self, job_id: str, input_values_list: list[Any]):
+        if len(input_values_list) == 0:
+            return [], None
+        return self._write(
+            lambda db: _insert_executions(db, job_id, input_values_list)
+        )
+
+    # Returns the id of an execution of the job that's still waiting to run
+    # with the same input values, or creates a new one. The boolean tells
+    # whether the execution was created.
+    def create_job_execution_unless_pending(self, job_id: str, input_values: Any):
+        result, _ = self.create_job_executions_unless_pending(job_id, [input_values])
+        return result[0]
+
+    # Same as `create_job_execution_unless_pending` for many executions at
+    # once. Entries with the same input values share the same execution. Input
+    # values are stored with their keys sorted, so they're compared as stored.
+    # The timestamp of the created executions is returned along with the result.
+    def create_job_executions_unless_pending(
+        self, job_id: str, input_values_list: list[Any]
+    ):
+        def write(db: sqlite3.Connection):
+            pending = {}
+            for execution_id, key in db.execute(
+                "SELECT execution_id, input_values FROM executions"
+                " WHERE status = 'created' AND job_id = ? AND archived = 0"
+                " ORDER BY execution_id DESC",
+                (job_id,),
+            ):
+                pending.setdefault(key, str(execution_id))
+
+            keys = [_input_values_key(values) for values in input_values_list]
+            missing = {}
+            for key, input_values in zip(keys, input_values_list):
+                if key not in pending and key not in missing:
+                    missing[key] = input_values
+            created_ids, timestamp = _insert_executions(
+                db, job_id, list(missing.values())
+            )
+            created = dict(zip(missing, created_ids))
+
+            result = []
+            for key in keys:
+                if key in pending:
+                    result.append((pending[key], False))
+                else:
+                    result.append((created[key], True))
+                    pending[key] = created[key]
+            return result, timestamp
+
+        return self._write(write)
+
+    def get_job_execution_status_history(self, job_id: str, execution_id: str):
+        with self._read() as db:
+            status_history = self._read_status_histories(
+                db, job_id, [int(execution_id)]
+            )[int(execution_id)]
+        if len(status_history) == 0:
+            raise _execution_not_found(job_id, execution_id)
+        return status_history
+
+    def get_job_execution_status(self, job_id: str, execution_id: str):
+        with self._read() as db:
+            row = db.execute(
+                "SELECT status FROM executions WHERE job_id = ? AND execution_id = ?",
+                (job_id, int(execution_id)),
+            ).fetchone()
+        if row is None:
+            raise _execution_not_found(job_id, execution_id)
+        return row[0]
+
+    # Returns the timestamp of the change of status.
+    def set_job_execution_status(self, job_id: str, execution_id: str, status: str):
+        timestamp = datetime.now(tz=timezone.utc).isoformat()
+
+        def write(db: sqlite3.Connection):
+            db.execute(
+                "UPDATE executions SET status = ?"
+                " WHERE job_id = ? AND execution_id = ?",
+                (status, job_id, int(execution_id)),
+            )
+            db.execute(
+                "INSERT INTO status_history VALUES (?, ?, ?, ?)",
+                (job_id, int(execution_id), timestamp, status),
+            )
+
+        self._write(write)
+        return timestamp
+
+    def set_job_execution_result(
+        self, job_id: str, execution_id: str, exit_code: int, message: str | None
+    ):
+        self._update_execution(
+            job_id, execution_id, exit_code=exit_code, message=f"{message}"
+        )
+
+    def get_job_execution_result(self, job_id: str, execution_id: str):
+        return self.get_job_execution(job_id, execution_id)["result"]
+
+    # Resource usage of the execution, measured when its process exits.
+    def set_job_execution_resources(
+        self, job_id: str, execution_id: str, resources: dict
+    ):
+        self._update_execution(
+            job_id, execution_id, resources=json.dumps(resources)
+        )
+
+    def get_job_execution_resources(self, job_id: str, execution_id: str):
+        return self.get_job_execution(job_id, execution_id)["resources"]
+
+    def get_job_ids(self):
+        with self._read() as db:
+            return [row[0] for row in db.execute("SELECT job_id FROM jobs")]
+
+    # Moves the logs of finished executions into the archive of the job. The
+    # executions disappear from the listings, but can still be read one by one.
+    def archive_job_executions(self, job_id: str, execution_ids: list[str]):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        ExecutionArchive(job_paths).write(execution_ids)
+
+        def write(db: sqlite3.Connection):
+            db.executemany(
+                "UPDATE executions SET archived = 1"
+                " WHERE job_id = ? AND execution_id = ?",
+                [(job_id, int(execution_id)) for execution_id in execution_ids],
+            )
+
+        self._write(write)
+        for execution_id in execution_ids:
+            rmtree(
+                JobExecutionPathsBuilder(job_paths, execution_id).execution_dir,
+                ignore_errors=True,
+            )
+
+    # Imports every execution kept by the given backend, archived ones
+    # included, unless the database already exists. The database is built
+    # under a temporary name and renamed when complete, so an interrupted
+    # import starts over on the next run.
+    def import_executions(self, file_state):
+        if exists(self._database_file):
+            return
+        tmp_file = f"{self._database_file}.tmp"
+        if exists(tmp_file):
+            remove(tmp_file)
+        makedirs(dirname(self._database_file), exist_ok=True)
+        db = sqlite3.connect(tmp_file, isolation_level=None)
+        try:
+            db.executescript(SCHEMA)
+            db.execute("BEGIN")
+            count = 0
+            for job_id in file_state.get_job_ids():
+                count += _import_job(db, file_state, job_id)
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        rename(tmp_file, self._database_file)
+        log.info(f"imported {count} executions into: {self._database_file}")
+
+    def _update_execution(self, job_id: str, execution_id: str, **values):
+        assignments = ", ".join(f"{column} = ?" for column in values)
+
+        def write(db: sqlite3.Connection):
+            db.execute(
+                f"UPDATE executions SET {assignments}"
+                " WHERE job_id = ? AND execution_id = ?",
+                (*values.values(), job_id, int(execution_id)),
+            )
+
+        self._write(write)
+
+    # Reads the status histories of only the given executions, as the ones in
+    # between may be many when the executions were filtered by status.
+    def _read_status_histories(
+        self, db: sqlite3.Connection, job_id: str, execution_ids: list[int]
+    ):
+        status_histories = {}
+        for start in range(0, len(execution_ids), READ_BATCH_SIZE):
+            batch = execution_ids[start : start + READ_BATCH_SIZE]
+            placeholders = ", ".join("?" for _ in batch)
+            for execution_id, timestamp, status in db.execute(
+                "SELECT execution_id, timestamp, status FROM status_history"
+                f" WHERE job_id = ? AND execution_id IN ({placeholders})"
+                " ORDER BY execution_id, rowid",
+                [job_id, *batch],
+            ):
+                status_histories.setdefault(execution_id, []).append(
+                    {"timestamp": timestamp, "status": status}
+                )
+        return _StatusHistories(status_histories)
+
+    def _connect(self):
+        db = sqlite3.connect(
+            self._database_file,
+            timeout=BUSY_TIMEOUT,
+            isolation_level=None,
+        )
+        db.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode, a crash can only lose the last transactions, and never
+        # corrupts the database.
+        db.execute("PRAGMA synchronous = NORMAL")
+        return db
+
+    def _read(self):
+        if not hasattr(self._local, "db"):
+            self._local.db = self._connect()
+            self._local.db.executescript(SCHEMA)
+        return _ReadTransaction(self._local.db)
+
+    # Queues the function for the writer thread, and waits for the transaction
+    # it ran in to be committed.
+    def _write(self, write: Callable[[sqlite3.Connection], Any]):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer, daemon=True)
+                self._writer.start()
+        future = Future()
+        self._writes.put((write, future))
+        return future.result()
+
+    def _run_writer(self):
+        db = self._connect()
+        db.executescript(SCHEMA)
+        while True:
+            writes = [self._writes.get()]
+            while len(writes) < WRITE_BATCH_SIZE:
+                try:
+                    writes.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            results = []
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                for write, _ in writes:
+                    # Every write gets a savepoint, so a failing one doesn't
+                    # undo the rest of the batch.
+                    db.execute("SAVEPOINT write")
+                    try:
+                        results.append((write(db), None))
+                    except Exception as ex:
+                        db.execute("ROLLBACK TO write")
+                        results.append((None, ex))
+                    db.execute("RELEASE write")
+                db.execute("COMMIT")
+            except Exception as ex:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                results = [(None, ex)] * len(writes)
+
+            for (_, future), (result, ex) in zip(writes, results):
+                if ex is not None:
+                    future.set_exception(ex)
+                else:
+                    future.set_result(result)
+
+
+class _ReadTransaction:
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self._db = db
+
+    def __enter__(self):
+        self._db.execute("BEGIN")
+        return self._db
+
+    def __exit__(self, *_):
+        self._db.execute("COMMIT")
+
+
+# Status histories by execution id, which are empty for unknown executions.
+class _StatusHistories(dict):
+    def __missing__(self, execution_id: int):
+        return []
+
+
+# Must be called in a write transaction.
+def _insert_executions(
+    db: sqlite3.Connection, job_id: str, input_values_list: list[Any]
+):
+    if len(input_values_list) == 0:
+        return [], None
+    row = db.execute(
+        "SELECT last_execution FROM jobs WHERE job_id = ?", (job_id,)
+    ).fetchone()
+    first_execution = (row[0] if row is not None else 0) + 1
+    last_execution = first_execution + len(input_values_list) - 1
+    db.execute(
+        "INSERT INTO jobs VALUES (?, ?)"
+        " ON CONFLICT (job_id) DO UPDATE SET last_execution = excluded.last_execution",
+        (job_id, last_execution),
+    )
+    timestamp = datetime.now(tz=timezone.utc).isoformat()
+    execution_ids = range(first_execution, last_execution + 1)
+    db.executemany(
+        "INSERT INTO executions (job_id, execution_id, status, input_values)"
+        " VALUES (?, ?, 'created', ?)",
+        [
+            (job_id, execution_id, _input_values_key(input_values))
+            for execution_id, input_values in zip(execution_ids, input_values_list)
+        ],
+    )
+    db.executemany(
+        "INSERT INTO status_history VALUES (?, ?, ?, 'created')",
+        [(job_id, execution_id, timestamp) for execution_id in execution_ids],
+    )
+    return [str(execution_id) for execution_id in execution_ids], timestamp
+
+
+def _import_job(db: sqlite3.Connection, file_state, job_id: str):
+    executions = list(reversed(file_state.get_job_executions(job_id)))
+    archived = []
+    for execution_id in file_state.get_archived_job_execution_ids(job_id):
+        try:
+            archived.append(file_state.get_job_execution(job_id, execution_id))
+        except FileNotFoundError:
+            pass
+
+    last_execution = 0
+    for archived_flag, execution_list in [(1, archived), (0, executions)]:
+        for execution in execution_list:
+            execution_id = int(execution["execution_id"])
+            last_execution = max(last_execution, execution_id)
+            result = execution["result"] or {"exit_code": None, "message": None}
+            resources = execution["resources"]
+            db.execute(
+                "INSERT OR REPLACE INTO executions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    execution_id,
+                    execution["status"],
+                    _input_values_key(execution["input_values"]),
+                    result["exit_code"],
+                    result["message"],
+                    json.dumps(resources) if resources is not None else None,
+                    archived_flag,
+                ),
+            )
+            db.executemany(
+                "INSERT INTO status_history VALUES (?, ?, ?, ?)",
+                [
+                    (job_id, execution_id, entry["timestamp"], entry["status"])
+                    for entry in execution["status_history"]
+                ],
+            )
+
+    last_execution_file = JobPathsBuilder(getcwd(), job_id).last_execution_file
+    if exists(last_execution_file):
+        with open(last_execution_file) as f:
+            last_execution = max(last_execution, int(f.read()))
+    if last_execution > 0:
+        db.execute("INSERT INTO jobs VALUES (?, ?)", (job_id, last_execution))
+    return len(executions) + len(archived)
+
+
+def _build_execution(row: tuple, status_history: list[dict]):
+    [execution_id, status, input_values, exit_code, message, resources] = row
+    return {
+        "execution_id": str(execution_id),
+        "status": status,
+        "status_history": status_history,
+        "result": (
+            {"exit_code": exit_code, "message": message}
+            if exit_code is not None
+            else None
+        ),
+        "resources": json.loads(resources) if resources is not None else None,
+        "input_values": json.loads(input_values),
+    }
+
+
+def _execution_not_found(job_id: str, execution_id: str):
+    return FileNotFoundError(f"unknown execution {execution_id} of job: {job_id}")
+
+
+def _input_values_key(input_values: Any):
+    return json.dumps(input_values, sort_keys=True)
@@ -1,121 +1,206 @@
-import json
-from datetime import datetime, timezone
-from os import getcwd, listdir, makedirs
-from os.path import exists, dirname, isdir, join
+import gzip
+import threading
+from os import getcwd, getenv
+from os.path import relpath
 from typing import Any
 
+from servitor.execution_archive import ExecutionArchive
+from servitor.execution_feed import execution_feed
+from servitor.file_state import FileStateBackend
 from servitor.framework.event_bus import get_event_bus_client
-from servitor.paths import JobExecutionPathsBuilder, JobPathsBuilder
+from servitor.framework.logging import log
+from servitor.paths import JobExecutionPathsBuilder, JobPathsBuilder, StatePathsBuilder
 from servitor.shared_memory import get_shared_memory
+from servitor.sqlite_state import SQLiteStateBackend
 
+# Where the state of executions is kept: `files`, a directory per execution, or
+# `sqlite`, a single database, which executions kept in files are imported
+# into the first time Servitor starts with it.
+STATE_BACKEND = getenv("SERVITOR_STATE_BACKEND", "files")
 
+
+# Reads and writes the state of executions through the configured backend, and
+# notifies every change of status, which is also recorded in the execution
+# feed.
 class State:
-    def get_job_executions(self, job_id: str):
-        def gen():
-            job_paths = JobPathsBuilder(getcwd(), job_id)
-            if not exists(job_paths.executions_dir):
-                return
-            for item in listdir(job_paths.executions_dir):
-                if isdir(join(job_paths.executions_dir, item)):
-                    execution_id = item
-                    yield self.get_job_execution(job_id, execution_id)
-
-        result = sorted(list(gen()), key=lambda x: int(x["execution_id"]), reverse=True)
-        return result
+    _backend: FileStateBackend | SQLiteStateBackend | None
+    _backend_lock: threading.Lock
+
+    def __init__(self) -> None:
+        self._backend = None
+        self._backend_lock = threading.Lock()
+
+    def get_job_executions(
+        self,
+        job_id: str,
+        limit: int | None = None,
+        before: str | None = None,
+        after: str | None = None,
+        statuses: list[str] | None = None,
+    ):
+        return self._get_backend().get_job_executions(
+            job_id, limit, before, after, statuses
+        )
 
     def get_job_execution(self, job_id: str, execution_id: str):
-        job_paths = JobPathsBuilder(getcwd(), job_id)
-        job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
-        try:
-            with open(job_execution_paths.input_values_file, "r") as f:
-                input_values = json.load(f)
-        except FileNotFoundError:
-            input_values = {}
-        return {
-            "execution_id": execution_id,
-            "status": self.get_job_execution_status(job_id, execution_id),
-            "status_history": self.get_job_execution_status_history(
-                job_id, execution_id
-            ),
-            "result": self.get_job_execution_result(job_id, execution_id),
-            "input_values": input_values,
-        }
+        return self._get_backend().get_job_execution(job_id, execution_id)
 
     def create_job_execution(self, job_id: str, input_values: Any):
-        shared_memory = get_shared_memory()
-        with shared_memory.state_lock:
-            job_paths = JobPathsBuilder(getcwd(), job_id)
-
-            def creation():
-                makedirs(job_paths.executions_dir, exist_ok=True)
-                if exists(job_paths.last_execution_file):
-                    with open(job_paths.last_execution_file, "r+") as f:
-                        last_execution = int(f.read())
-                        new_execution = str(last_execution + 1)
-                        f.seek(0)
-                        f.write(new_execution)
-                    return new_execution
-                else:
-                    first_execution = "1"
-                    with open(job_paths.last_execution_file, "w") as f:
-                        f.write(first_execution)
-                return first_execution
-
-            execution_id = creation()
-            self.set_job_execution_status(job_id, execution_id, "created")
-            job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
-            with open(job_execution_paths.input_values_file, "w") as f:
-                f.write(json.dumps(input_values, indent=2) + "\n")
-            return execution_id
+        return self.create_job_executions(job_id, [input_values])[0]
+
+    def create_job_executions(self, job_id: str, input_values_list: list[Any]):
+        execution_ids, timestamp = self._get_backend().create_job_executions(
+            job_id, input_values_list
+        )
+        self._notify_job_execution_status(
+            job_id, execution_ids, timestamp, "created"
+        )
+        return execution_ids
+
+    # Returns the id of an execution of the job that's still waiting to run
+    # with the same input values, or creates a new one. The boolean tells
+    # whether the execution was created.
+    def create_job_execution_unless_pending(self, job_id: str, input_values: Any):
+        return self.create_job_executions_unless_pending(job_id, [input_values])[0]
+
+    # Same as `create_job_execution_unless_pending` for many executions at
+    # once. Entries with the same input values share the same execution.
+    def create_job_executions_unless_pending(
+        self, job_id: str, input_values_list: list[Any]
+    ):
+        result, timestamp = self._get_backend().create_job_executions_unless_pending(
+            job_id, input_values_list
+        )
+        created_ids = []
+        for execution_id, created in result:
+            if created and execution_id not in created_ids:
+                created_ids.append(execution_id)
+        self._notify_job_execution_status(job_id, created_ids, timestamp, "created")
+        return result
 
     def get_job_execution_status_history(self, job_id: str, execution_id: str):
-        job_paths = JobPathsBuilder(getcwd(), job_id)
-        job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
-        with open(job_execution_paths.status_history_file, "r") as f:
-            return [
-                {"timestamp": l[0], "status": l[1].strip()}
-                for l in [l.split("\t") for l in f.readlines()]
-            ]
+        return self._get_backend().get_job_execution_status_history(
+            job_id, execution_id
+        )
 
     def get_job_execution_status(self, job_id: str, execution_id: str):
-        return self.get_job_execution_status_history(job_id, execution_id)[-1]["status"]
+        return self._get_backend().get_job_execution_status(job_id, execution_id)
 
     def set_job_execution_status(self, job_id: str, execution_id: str, status: str):
-        shared_memory = get_shared_memory()
-        with shared_memory.state_lock:
-            timestamp = datetime.now(tz=timezone.utc).isoformat()
-            job_execution_paths = JobExecutionPathsBuilder(
-                JobPathsBuilder(getcwd(), job_id), execution_id
-            )
-            makedirs(dirname(job_execution_paths.status_history_file), exist_ok=True)
-            with open(job_execution_paths.status_history_file, "a") as f:
-                f.write(f"{timestamp}\t{status}\n")
-            get_event_bus_client().send(
-                "job_execution_status_changed",
-                {"job_id": job_id, "execution_id": execution_id, "status": status},
-            )
+        timestamp = self._get_backend().set_job_execution_status(
+            job_id, execution_id, status
+        )
+        self._notify_job_execution_status(job_id, [execution_id], timestamp, status)
 
     def set_job_execution_result(
         self, job_id: str, execution_id: str, exit_code: int, message: str | None
     ):
-        shared_memory = get_shared_memory()
-        with shared_memory.state_lock:
-            job_execution_paths = JobExecutionPathsBuilder(
-                JobPathsBuilder(getcwd(), job_id), execution_id
-            )
-            with open(job_execution_paths.result_file, "w") as f:
-                f.write(f"{exit_code}\t{message}\n")
+        self._get_backend().set_job_execution_result(
+            job_id, execution_id, exit_code, message
+        )
 
     def get_job_execution_result(self, job_id: str, execution_id: str):
-        job_execution_paths = JobExecutionPathsBuilder(
-            JobPathsBuilder(getcwd(), job_id), execution_id
+        return self._get_backend().get_job_execution_result(job_id, execution_id)
+
+    # Resource usage of the execution, measured when its process exits.
+    def set_job_execution_resources(
+        self, job_id: str, execution_id: str, resources: dict
+    ):
+        self._get_backend().set_job_execution_resources(
+            job_id, execution_id, resources
         )
-        try:
-            with open(job_execution_paths.result_file, "r") as f:
-                [exit_code, message] = f.read().split("\t")
-                return {"exit_code": int(exit_code), "message": message.strip()}
-        except FileNotFoundError:
-            return None
+
+    def get_job_execution_resources(self, job_id: str, execution_id: str):
+        return self._get_backend().get_job_execution_resources(job_id, execution_id)
+
+    # Moves finished executions into the archive of the job. They disappear
+    # from the listings, but can still be read one by one.
+    def archive_job_executions(self, job_id: str, execution_ids: list[str]):
+        self._get_backend().archive_job_executions(job_id, execution_ids)
+        execution_feed.append_archived(job_id, execution_ids)
+
+    # Returns the executions of every job, newest first, by their last change
+    # of status.
+    def get_executions(
+        self,
+        statuses: list[str] | None = None,
+        since: str | None = None,
+        limit: int | None = None,
+    ):
+        return execution_feed.query(statuses, since, limit)
+
+    def get_archived_job_execution_log(self, job_id: str, execution_id: str):
+        job_paths = JobPathsBuilder(getcwd(), job_id)
+        job_execution_paths = JobExecutionPathsBuilder(job_paths, execution_id)
+        execution_archive = ExecutionArchive(job_paths)
+        path = relpath(
+            job_execution_paths.main_log_file, job_execution_paths.execution_dir
+        )
+        content = execution_archive.read(execution_id, path)
+        if content is None:
+            compressed_path = relpath(
+                job_execution_paths.compressed_main_log_file,
+                job_execution_paths.execution_dir,
+            )
+            compressed_content = execution_archive.read(execution_id, compressed_path)
+            if compressed_content is not None:
+                content = gzip.decompress(compressed_content)
+        return content
+
+    # Must run in the main process before any other process uses the state.
+    def migrate(self):
+        backend = self._get_backend()
+        if isinstance(backend, SQLiteStateBackend):
+            backend.import_executions(FileStateBackend())
+        if not execution_feed.exists():
+            self._build_execution_feed()
+
+    def _get_backend(self):
+        with self._backend_lock:
+            if self._backend is None:
+                if STATE_BACKEND == "sqlite":
+                    self._backend = SQLiteStateBackend(
+                        StatePathsBuilder(getcwd()).database_file
+                    )
+                else:
+                    self._backend = FileStateBackend()
+            return self._backend
+
+    def _build_execution_feed(self):
+        backend = self._get_backend()
+        executions = []
+        for job_id in backend.get_job_ids():
+            for execution in backend.get_job_executions(job_id):
+                status_history = execution["status_history"]
+                executions.append(
+                    {
+                        "job_id": job_id,
+                        "execution_id": execution["execution_id"],
+                        "status": execution["status"],
+                        "created_at": status_history[0]["timestamp"],
+                        "updated_at": status_history[-1]["timestamp"],
+                    }
+                )
+        executions.sort(key=lambda execution: execution["updated_at"])
+        execution_feed.write(executions)
+        log.info(f"built execution feed with {len(executions)} executions")
+
+    # Records the change of status in the execution feed with the timestamp
+    # the backend stored, so both agree on when it happened.
+    def _notify_job_execution_status(
+        self, job_id: str, execution_ids: list[str], timestamp: str, status: str
+    ):
+        if len(execution_ids) == 0:
+            return
+        execution_feed.append_status(job_id, execution_ids, timestamp, status)
+        metrics = get_shared_memory().metrics
+        event_bus_client = get_event_bus_client()
+        for execution_id in execution_ids:
+            metrics.add_status(job_id, status)
+            event_bus_client.send(
+                "job_execution_status_changed",
+                {"job_id": job_id, "execution_id": execution_id, "status": status},
+            )
 
 
 state = State()
@@ -0,0 +1,41 @@
+from servitor.job_queue import job_queue_journal
+from servitor.shared_memory import JobQueueItem, get_shared_memory
+from servitor.state import state
+
+
+# Keeps only the input values declared in the input spec of the job.
+def filter_input_values(job: dict, input_values: dict):
+    return {
+        key: str(value)
+        for key, value in input_values.items()
+        if key in job["input_spec"]
+    }
+
+
+# Creates executions of the job, returning the id of every execution along
+# with whether it was created, as coalescing jobs reuse pending executions.
+def create_job_executions(job: dict, input_values_list: list[dict]):
+    if job["spec"].get("coalesce", False):
+        return state.create_job_executions_unless_pending(
+            job["job_id"], input_values_list
+        )
+    execution_ids = state.create_job_executions(job["job_id"], input_values_list)
+    return [(execution_id, True) for execution_id in execution_ids]
+
+
+def build_job_queue_item(job: dict, execution_id: str, priority: str | None):
+    return JobQueueItem(
+        job["job_id"],
+        execution_id,
+        priority=priority or job["spec"].get("priority", "normal"),
+        max_concurrency=job["spec"].get("max_concurrency"),
+    )
+
+
+# Records the items in the journal before handing them to the dispatcher, so
+# they survive restarts.
+def queue_job_executions(items: list[JobQueueItem]):
+    if len(items) == 0:
+        return
+    job_queue_journal.append_queued(items)
+    get_shared_memory().job_queue.put(items)
@@ -19,6 +19,9 @@ const internalUrl = (() => {
 
 // #region Networking
 
+// Only the end of the log is loaded, so huge logs open right away.
+const LOG_TAIL_LINES = 10000;
+
 const Networking = (() => {
 
   async function fetchChunks(url, controller, onchunk) {
@@ -76,7 +79,7 @@ const Data = (() => {
     async function fetchEventsForever() {
       const decoder = new TextDecoder();
       const controller = new AbortController();
-      await Networking.fetchChunks('/api/events', controller, (chunk) => {
+      await Networking.fetchChunks('/api/events?id=job_execution_status_changed', controller, (chunk) => {
         const newLinesPositions = chunk
           .reduce((result, byte, pos) => {
             if (byte === 10) {
@@ -135,7 +138,8 @@ const Data = (() => {
   }
 
   function useJobExecutions(jobIdSignal) {
-    const jobExecutions = useFetch([], useComputed(() => '/api/jobs/executions/get_list?job_id=' + jobIdSignal.get()))
+    const jobExecutions = useFetch([], useComputed(() => '/api/jobs/executions/get_list?job_id=' + jobIdSignal.get()
+      + '&limit=50&fields=execution_id,status,status_history'))
     useEvents((e) => {
       if (
         e.id === "job_execution_status_changed"
@@ -181,7 +185,7 @@ const Data = (() => {
         try {
           const decoder = new TextDecoder();
           await Networking.fetchChunks(
-            `/api/jobs/executions/logs/get?job_id=${jobId}&execution_id=${executionId}`,
+            `/api/jobs/executions/logs/get?job_id=${jobId}&execution_id=${executionId}&tail=${LOG_TAIL_LINES}`,
             fetchController,
             (chunk) => {
               log.chunks.push(decoder.decode(chunk));
@@ -366,7 +370,7 @@ component('x-job', [], () => {
           [(() => {
             const start = e.status_history.find(i => i.status === "running");
             if (start == null) return '';
-            if (!["success", "failure", "cancelled"].includes(e.status)) {
+            if (!["success", "failure", "cancelled", "timed_out"].includes(e.status)) {
               return h('x-duration-clock', { "start-timestamp": start.timestamp });
             }
             const end = e.status_history.find(i => i.status === e.status);
@@ -389,7 +393,7 @@ component('x-job-execution', [], () => {
   };
 
   const startTimestamp = useComputed(() => (jobExecution.get()?.status_history || []).find(i => i.status === "running")?.timestamp || null);
-  const endTimestamp = useComputed(() => ["success", "failure", "cancelled"].includes(jobExecution.get()?.status)
+  const endTimestamp = useComputed(() => ["success", "failure", "cancelled", "timed_out"].includes(jobExecution.get()?.status)
     ? jobExecution.get().status_history.find(i => i.status === jobExecution.get().status)?.timestamp || null
     : null)
 